@@ -0,0 +1,45 @@
+#!/usr/bin/env python
+"""Time Root.set_dbm_artistids, which sums the tracks by each artist in
+every folder, on a library with many artists under one folder.
+
+The library is built in memory: --artists artist folders directly
+under the root, each of 2 album folders of 5 tracks, every artist
+with an MBID. No files are read.
+
+dbm is imported from the tree given by --checkout: see common.py. To
+compare with the table_union version, give the checkout of the tree
+from before the counts were summed in place:
+
+    python bench/artist_counts.py
+    python bench/artist_counts.py --checkout /tmp/dbm-before"""
+
+import time, shutil, tempfile
+from optparse import OptionParser
+
+import common
+
+def main():
+    op = OptionParser(usage='usage: %prog [options]')
+    common.add_checkout_option(op)
+    op.add_option('', '--artists', dest='artists', default=20000, type='int',
+                  help='Number of artists under the root, defaults to 20000.')
+    options, args = op.parse_args()
+    dbm = common.import_checkout(options.checkout)
+    common.quiet_dbm(dbm)
+
+    path = tempfile.mkdtemp()
+    try:
+        root = dbm.root = dbm.Root(unicode(path), None)
+        st = common.Stat()
+        common.make_library(dbm, root, options.artists, [5, 5],
+                            lambda path, tags: dbm.track.Track(path, tags, st))
+        start = time.time()
+        root.set_dbm_artistids()
+        elapsed = time.time() - start
+    finally:
+        shutil.rmtree(path)
+    print('%d artists under the root: set_dbm_artistids %.2f s' %
+          (len(root.dbm_artistids), elapsed))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+"""What the benchmarks share: importing dbm from another checkout, and
+the synthetic libraries that they measure.
+
+A benchmark with a --checkout option imports dbm's modules from the
+tree that it names, which defaults to this one, so that a change can
+be measured against the code from before it. Make a checkout of the
+commit before the change with e.g.
+
+    git worktree add /tmp/dbm-before <commit>
+
+and run the benchmark again with --checkout /tmp/dbm-before.
+
+The synthetic libraries have artists numbered from 0, each with an
+MBID, and albums numbered from 0 for each artist."""
+
+import sys, os
+
+top = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+class Stat(object):
+    """The result of os.stat() for a music file that is not read."""
+    st_size = 4000000
+    st_mtime = 1.25e9
+
+def quiet(msg, *args, **kwargs):
+    pass
+
+def add_checkout_option(op, module='dbm'):
+    op.add_option('', '--checkout', dest='checkout', default=top,
+                  help='Tree to import %s from, defaults to this one.' % module)
+
+def import_checkout(checkout, module='dbm'):
+    """Import module from the tree checkout, ahead of any other on
+    sys.path, and return it."""
+    sys.path.insert(0, os.path.abspath(checkout))
+    return __import__(module)
+
+def quiet_dbm(dbm):
+    """Silence dbm and give it settings under which nothing is
+    downloaded, cached or checkpointed, and scans read files in this
+    process."""
+    dbm.log = dbm.logi = dbm.elog = dbm.warn = dbm.error = quiet
+    dbm.settings = settings = dbm.Settings()
+    settings.quiet = True
+    settings.show_tracks = False
+    settings.query_lastfm = False
+    settings.scan_workers = 1
+    settings.tag_cache_file = None
+    settings.scan_checkpoint_file = None
+    settings.library_generations = 1
+
+def artist_name(a):
+    return u'Artist %d' % a
+
+def artist_mbid(a):
+    return u'%08d-aaaa-bbbb-cccc-%012d' % (a, a)
+
+def album_name(b):
+    return u'Album %d' % b
+
+def album_tags(a, b):
+    """Return the tags shared by the tracks of album b of artist a."""
+    return {'artistname': artist_name(a), 'artistid': artist_mbid(a),
+            'releasename': album_name(b)}
+
+def make_album_folders(path, artists, albums):
+    """Make the folders of a library at path with `artists' artists
+    of `albums' albums each, and yield (folder, tags) for each album,
+    where tags are as returned by album_tags()."""
+    for a in range(artists):
+        for b in range(albums):
+            folder = os.path.join(path, artist_name(a), album_name(b))
+            os.makedirs(folder)
+            yield folder, album_tags(a, b)
+
+def make_library(dbm, root, artists, album_tracks, make_track):
+    """Give root, an empty dbm.Root, the folders of a library of
+    `artists' artists, each with an album of each number of tracks in
+    album_tracks, without reading or making any files. The Track for
+    each is made by make_track(path, tags), where tags are as returned
+    by album_tags()."""
+    for a in range(artists):
+        artist = dbm.Node(u'%s/%s' % (root.path, artist_name(a)), root)
+        root.subtrees.add(artist)
+        for b, tracks in enumerate(album_tracks):
+            album = dbm.Node(u'%s/%s' % (artist.path, album_name(b)), artist)
+            artist.subtrees.add(album)
+            for t in range(tracks):
+                album.tracks.append(make_track(u'%s/%02d.ogg' % (album.path, t),
+                                               album_tags(a, b)))
+    return root
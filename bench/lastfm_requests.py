@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+"""Measure how many last.fm requests a second pylast gets through, with
+a new connection for each request and with connections kept alive by
+httppool.
+
+The requests are artist.getInfo requests, made with real pylast to
+the stand-in last.fm server, lastfmstub.py, which is started on --port
+and stopped at the end unless --server names one that is running
+already. --requests are made by 1 thread and then by 4, first with
+pylast's own _Request._download_response, which opens a connection for
+each request, and then with lastfmnet.download_response, which takes
+them from httppool. No requests are limited or cached.
+
+    python bench/lastfm_requests.py
+    python bench/lastfm_requests.py --server localhost:8080"""
+
+import sys, os, time, threading, subprocess, signal
+from optparse import OptionParser
+
+top = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, top)
+import pylast.pylast as pylast
+import lastfmnet, httppool
+
+def start_server(port):
+    server = subprocess.Popen([sys.executable, os.path.join(top, 'lastfmstub.py'),
+                               '--port', str(port)], stdout=subprocess.PIPE)
+    # It says when it is listening
+    server.stdout.readline()
+    return server
+
+def stop_server(server):
+    os.kill(server.pid, signal.SIGTERM)
+    report = server.stdout.read()
+    server.wait()
+    return report
+
+def requests_per_second(network, download, requests, threads):
+    def work(n):
+        for i in range(n):
+            download(pylast._Request(network, 'artist.getInfo', {'artist': u'Bj\xf6rk %d' % i}))
+    workers = [threading.Thread(target=work, args=(requests // threads,))
+               for i in range(threads)]
+    start = time.time()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return requests // threads * threads / (time.time() - start)
+
+def main():
+    op = OptionParser(usage='usage: %prog [options]')
+    op.add_option('', '--server', dest='server', default=None,
+                  help='HOST:PORT of a running stand-in server, instead of starting one.')
+    op.add_option('', '--port', dest='port', default=8124, type='int',
+                  help='Port to start the stand-in server on, defaults to 8124.')
+    op.add_option('', '--requests', dest='requests', default=2000, type='int',
+                  help='Number of requests to time each way, defaults to 2000.')
+    options, args = op.parse_args()
+    server = None
+    if options.server is None:
+        server = start_server(options.port)
+        options.server = 'localhost:%d' % options.port
+    try:
+        network = pylast.get_lastfm_network(api_key='key', api_secret='secret')
+        network.ws_server = (options.server, '/2.0/')
+        for threads in [1, 4]:
+            each = requests_per_second(network, pylast._Request._download_response,
+                                       options.requests, threads)
+            httppool.pool = httppool.ConnectionPool()
+            pooled = requests_per_second(network, lastfmnet.download_response,
+                                         options.requests, threads)
+            opened = httppool.pool.opened
+            print('%d thread%s: %.0f requests a second with a new connection each, '
+                  '%.0f pooled, over %d connection%s' %
+                  (threads, 's' if threads > 1 else '', each, pooled,
+                   opened, 's' if opened > 1 else ''))
+    finally:
+        if server:
+            sys.stdout.write(stop_server(server))
+
+if __name__ == '__main__':
+    main()
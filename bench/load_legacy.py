@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+"""Time loading a large library pickled before library files recorded
+a schema version.
+
+With --make, a synthetic library of --artists artists, each with 2
+albums and 25 tracks, is pickled to LIBRARY as dbm pickled libraries
+then; 20,000 artists make 500,000 tracks. This needs --checkout (see
+common.py) to point at a checkout of dbm from before the upgrade
+registry, such as 080b525, whose classes are the ones pickled.
+Nothing is read from disk or from last.fm: the folders and tracks
+are made directly, and each artist is given the last.fm data that a
+download would have stored. With --str-paths the root's path is
+pickled as a str, as very old libraries have it, which makes the
+loader decode every path.
+
+Without --make, LIBRARY is loaded by the dbm in --checkout, from a
+copy so that LIBRARY is left as it was. The dbm from before the
+upgrade registry is timed unpickling and patching the library, which
+it did on every load; this one is timed loading it the first time,
+which upgrades and saves it again, and loading it again.
+
+    python bench/load_legacy.py --make --checkout /tmp/dbm-baseline /tmp/legacy.dbm
+    python bench/load_legacy.py --checkout /tmp/dbm-baseline /tmp/legacy.dbm
+    python bench/load_legacy.py /tmp/legacy.dbm"""
+
+import os, time, shutil, tempfile, gc
+import cPickle as pickle
+from optparse import OptionParser
+
+import common
+
+class Blank:
+    pass
+
+def make_track(track, path, tags):
+    """Return a Track of the checkout's track module with the
+    attributes that Track.__init__ set then, without reading path."""
+    t = Blank()
+    t.__class__ = track.Track
+    t.__dict__.update(path=path, format='ogg',
+                      dbm_artistid=u'', artistid=u'', artistname=u'',
+                      dbm_albumartistid=u'', albumartistid=u'', albumartistname=u'',
+                      releasename=u'', releaseid=u'',
+                      artist=None, albumartist=None, valid=True)
+    t.__dict__.update(tags)
+    return t
+
+def make_library(dbm, artists, output, str_paths):
+    # The folders are made here, not found by scanning
+    dbm.Node.grow = lambda self: None
+    root = dbm.root = dbm.Root(u'/music', None)
+    common.make_library(dbm, root, artists, [13, 12],
+                        lambda path, tags: make_track(dbm.track, path, tags))
+    root.create_artist_name_to_mbid_mapping()
+    root.set_dbm_artistids()
+    root.create_artists()
+    for i, artist in enumerate(sorted(root.artists.values())):
+        root.similar_artists[artist.id] = [(None, u'Similar %d' % i)]
+        root.tags_by_artist[artist.id] = [dbm.Tag(u'tag %d' % (i % 2))]
+        artist.biography.biography = u'Biography of %s' % artist.name
+        root.biographies[artist.id] = artist.biography
+    root.download_artist_lastfm_data_maybe()
+    if str_paths:
+        root.path = root.path.encode('utf-8')
+    with open(output, 'wb') as f:
+        pickle.dump(root, f)
+
+def timed(f, *args):
+    gc.collect()
+    start = time.time()
+    f(*args)
+    return time.time() - start
+
+def time_loading(dbm, library):
+    directory = tempfile.mkdtemp()
+    try:
+        path = os.path.join(directory, os.path.basename(library))
+        shutil.copy(library, path)
+        print('%s: %.1f MB' % (library, os.path.getsize(path) / 1e6))
+        if hasattr(dbm, 'upgrade_library'):
+            print('first load, upgrading and saving: %.1f s' % timed(dbm.load_library, path))
+            dbm.root = None
+            print('later loads: %.1f s' % timed(dbm.load_library, path))
+        else:
+            def load():
+                dbm.root = dbm.load_pickled_object(path)
+            print('unpickling: %.1f s' % timed(load))
+            print('patching: %.2f s' % timed(dbm.patch_out_of_date_data_structures))
+    finally:
+        shutil.rmtree(directory)
+
+def main():
+    op = OptionParser(usage='usage: %prog [options] LIBRARY')
+    common.add_checkout_option(op)
+    op.add_option('', '--make', dest='make', default=False, action='store_true',
+                  help='Pickle a synthetic library to LIBRARY instead of loading it.')
+    op.add_option('', '--artists', dest='artists', default=20000, type='int',
+                  help='Number of artists in the library made by --make, defaults to 20000.')
+    op.add_option('', '--str-paths', dest='str_paths', default=False, action='store_true',
+                  help='Pickle the library made by --make with a str path.')
+    options, args = op.parse_args()
+    if len(args) != 1:
+        op.error('Give the path of the library.')
+    dbm = common.import_checkout(options.checkout)
+    common.quiet_dbm(dbm)
+    if options.make:
+        make_library(dbm, options.artists, args[0], options.str_paths)
+    else:
+        time_loading(dbm, args[0])
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,258 @@
+#!/usr/bin/env python
+"""Time the reading of the tags of music files, by format, on a
+synthetic tree.
+
+The tree, made under --tree unless it is there already, has --artists
+artist folders with an album of --tracks files in each of the formats
+ogg, flac, mp3, mpc and m4a. Each file has the tags that dbm reads,
+written by mutagen as a tagger would write them, followed by --audio
+KB of audio frames that hold silence, or nothing, but are laid out as
+mutagen expects. Each way of reading is timed --repeat times on a
+warm cache and the best time is reported, as files a second.
+
+Tracks are made as a scan makes them, by track.Track. They are timed
+reading every file with mutagen; reading the tag blocks with
+fasttags, falling back to mutagen; with an empty tag cache, which
+reads every file and stores its tags; and with the tag cache full, as
+a scan of an unchanged library finds it, which opens no music file.
+With --drop-caches, the operating system's page cache is dropped
+before each timing, so that the files are read from the disk; this
+needs root on Linux.
+
+track is imported from the tree given by --checkout: see common.py.
+To compare with a Track that read each file's tags twice, give the
+checkout of the tree from before Track read them once; a tree without
+fasttags and the tag cache is timed only making Tracks as it did:
+
+    python bench/scan_tags.py --tree /tmp/tags1k
+    python bench/scan_tags.py --tree /tmp/tags1k --checkout /tmp/dbm-before"""
+
+import os, time, struct, shutil, tempfile
+from optparse import OptionParser
+
+import mutagen.id3, mutagen.flac, mutagen.oggvorbis, mutagen.apev2, mutagen.mp4
+from mutagen.ogg import OggPage
+
+import common
+
+formats = ['ogg', 'flac', 'mp3', 'mpc', 'm4a']
+
+def file_tags(a, b, t):
+    """Return the tags of track t of album b of artist a."""
+    tags = common.album_tags(a, b)
+    tags.update(albumartistname=tags['artistname'], albumartistid=tags['artistid'],
+                releaseid=u'%08d-dddd-eeee-ffff-%012d' % (a, b),
+                trackname=u'Track %d' % t,
+                trackid=u'%08d-1111-2222-%04d-%012d' % (a, b, t))
+    return tags
+
+# Each write_* function writes a file of the format with the audio
+# frames that mutagen needs to read it, then adds the tags with
+# mutagen.
+
+def write_mp3(path, tags, audio):
+    # MPEG-1 layer III frames of 128 kbit/s at 44.1 kHz
+    frame = '\xff\xfb\x90\x00' + '\0' * 413
+    with open(path, 'wb') as f:
+        f.write(frame * (audio // len(frame) + 1))
+    id3 = mutagen.id3.ID3()
+    for frame_id, name in [('TPE1', 'artistname'), ('TPE2', 'albumartistname'),
+                           ('TALB', 'releasename'), ('TIT2', 'trackname')]:
+        id3.add(getattr(mutagen.id3, frame_id)(encoding=3, text=[tags[name]]))
+    for desc, name in [(u'MusicBrainz Artist Id', 'artistid'),
+                       (u'MusicBrainz Album Artist Id', 'albumartistid'),
+                       (u'MusicBrainz Album Id', 'releaseid')]:
+        id3.add(mutagen.id3.TXXX(encoding=3, desc=desc, text=[tags[name]]))
+    id3.add(mutagen.id3.UFID(owner=u'http://musicbrainz.org',
+                             data=tags['trackid'].encode('ascii')))
+    id3.save(path)
+
+vorbis_keys = [('artist', 'artistname'), ('musicbrainz_artistid', 'artistid'),
+               ('albumartist', 'albumartistname'),
+               ('musicbrainz_albumartistid', 'albumartistid'),
+               ('album', 'releasename'), ('musicbrainz_albumid', 'releaseid'),
+               ('title', 'trackname'), ('musicbrainz_trackid', 'trackid')]
+
+def write_flac(path, tags, audio):
+    samples = 44100 * 10
+    # Sample rate, channels - 1, bits per sample - 1 and samples
+    info = struct.pack('>HH3s3sQ16s', 4096, 4096, '\0' * 3, '\0' * 3,
+                       (44100 << 44) | (1 << 41) | (15 << 36) | samples, '\0' * 16)
+    with open(path, 'wb') as f:
+        f.write('fLaC' + struct.pack('>I', (0x80 << 24) | len(info)) + info)
+        f.write('\xff\xf8' + '\0' * (audio - 2))
+    flac = mutagen.flac.FLAC(path)
+    flac.add_tags()
+    for key, name in vorbis_keys:
+        flac[key] = tags[name]
+    flac.save()
+
+def write_ogg(path, tags, audio):
+    def page(packets, sequence, position, first=False, last=False):
+        p = OggPage()
+        p.packets, p.sequence, p.position = packets, sequence, position
+        p.serial, p.first, p.last = 1, first, last
+        return p.write()
+    identification = '\x01vorbis' + struct.pack('<IBIiiiBB', 0, 2, 44100, 0, 128000, 0, 0xb8, 1)
+    comment = '\x03vorbis' + struct.pack('<II', 0, 0) + '\x01'
+    setup = '\x05vorbis' + '\0' * 64
+    packet = '\0' * 4000
+    with open(path, 'wb') as f:
+        f.write(page([identification], 0, 0, first=True))
+        f.write(page([comment, setup], 1, 0))
+        n = audio // len(packet) + 1
+        for i in range(n):
+            f.write(page([packet], 2 + i, 4096 * (i + 1), last=(i == n - 1)))
+    ogg = mutagen.oggvorbis.OggVorbis(path)
+    for key, name in vorbis_keys:
+        ogg[key] = tags[name]
+    ogg.save()
+
+def write_mpc(path, tags, audio):
+    # A Musepack SV7 header: frames, and flags giving 44.1 kHz
+    with open(path, 'wb') as f:
+        f.write('MP+\x17' + struct.pack('<II', audio // 4000 + 1, 0) + '\0' * 20)
+        f.write('\0' * audio)
+    ape = mutagen.apev2.APEv2()
+    for key, name in [('Artist', 'artistname'), ('Musicbrainz_Artistid', 'artistid'),
+                      ('Album Artist', 'albumartistname'),
+                      ('Musicbrainz_Albumartistid', 'albumartistid'),
+                      ('Album', 'releasename'), ('Musicbrainz_Albumid', 'releaseid'),
+                      ('Title', 'trackname'), ('Musicbrainz_Trackid', 'trackid')]:
+        ape[key] = tags[name]
+    ape.save(path)
+
+def mp4_atom(kind, *children):
+    data = ''.join(children)
+    return struct.pack('>I4s', 8 + len(data), kind) + data
+
+def write_m4a(path, tags, audio):
+    # An audio track of 10 s, in units of 1/44100 s
+    mdhd = mp4_atom('mdhd', struct.pack('>4xIIIIHH', 0, 0, 44100, 441000, 0, 0))
+    hdlr = mp4_atom('hdlr', struct.pack('>4x4s4s12x', '\0' * 4, 'soun') + '\0')
+    with open(path, 'wb') as f:
+        f.write(mp4_atom('ftyp', 'M4A \0\0\0\0M4A mp42isom'))
+        f.write(mp4_atom('moov', mp4_atom('trak', mp4_atom('mdia', mdhd, hdlr))))
+        f.write(mp4_atom('mdat', '\0' * audio))
+    mp4 = mutagen.mp4.MP4(path)
+    mp4.add_tags()
+    for key, name in [('\xa9ART', 'artistname'), ('aART', 'albumartistname'),
+                      ('\xa9alb', 'releasename'), ('\xa9nam', 'trackname')]:
+        mp4[key] = [tags[name]]
+    for key, name in [('MusicBrainz Artist Id', 'artistid'),
+                      ('MusicBrainz Album Artist Id', 'albumartistid'),
+                      ('MusicBrainz Album Id', 'releaseid'),
+                      ('MusicBrainz Track Id', 'trackid')]:
+        mp4['----:com.apple.iTunes:' + key] = [mutagen.mp4.MP4FreeForm(tags[name].encode('utf-8'))]
+    mp4.save()
+
+writers = {'mp3': write_mp3, 'flac': write_flac, 'ogg': write_ogg,
+           'mpc': write_mpc, 'm4a': write_m4a}
+
+def make_tree(top, artists, tracks, audio):
+    albums = common.make_album_folders(top, artists, len(formats))
+    for i, (d, tags) in enumerate(albums):
+        a, b = divmod(i, len(formats))
+        format = formats[b]
+        for t in range(tracks):
+            writers[format](os.path.join(d, u'%02d.%s' % (t, format)),
+                            file_tags(a, b, t), audio)
+
+def music_files(top):
+    """Return a dict of the paths of the music files under top, keyed
+    by format."""
+    files = dict([(format, []) for format in formats])
+    for dirpath, dirnames, filenames in os.walk(top):
+        for name in filenames:
+            format = os.path.splitext(name)[1][1:]
+            if format in files:
+                files[format].append(os.path.join(dirpath, name))
+    return files
+
+def drop_caches():
+    os.system('sync')
+    with open('/proc/sys/vm/drop_caches', 'w') as f:
+        f.write('3\n')
+
+def best_time(read, paths, repeat, drop):
+    best = None
+    for i in range(repeat):
+        if drop:
+            drop_caches()
+        start = time.time()
+        read(paths)
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+def ways_of_reading(track, tag_cache_path):
+    """Return the (name, function) pairs of the ways of reading tags
+    that the checkout's track module has. Each function makes the
+    Tracks of a list of paths."""
+    def read(paths):
+        for path in paths:
+            track.Track(path)
+    if not hasattr(track, 'fasttags'):
+        return [('Track', read)]
+    import tagcache
+
+    def read_mutagen(paths):
+        readers = track.fasttags.readers
+        track.fasttags.readers = {}
+        try:
+            read(paths)
+        finally:
+            track.fasttags.readers = readers
+    def read_cache(paths, empty):
+        if empty and os.path.exists(tag_cache_path):
+            os.remove(tag_cache_path)
+        track.tag_cache = tagcache.TagCache(tag_cache_path)
+        try:
+            read(paths)
+        finally:
+            track.tag_cache.close()
+            track.tag_cache = None
+    return [('mutagen', read_mutagen),
+            ('fasttags', read),
+            ('tag cache, empty', lambda paths: read_cache(paths, True)),
+            ('tag cache, full', lambda paths: read_cache(paths, False))]
+
+def main():
+    op = OptionParser(usage='usage: %prog [options]')
+    common.add_checkout_option(op, 'track')
+    op.add_option('', '--tree', dest='tree', default='/tmp/dbm-bench-tags',
+                  help='Folder of the synthetic tree, defaults to /tmp/dbm-bench-tags.')
+    op.add_option('', '--artists', dest='artists', default=20, type='int',
+                  help='Number of artist folders in a new tree, defaults to 20.')
+    op.add_option('', '--tracks', dest='tracks', default=10, type='int',
+                  help='Number of files in each album of a new tree, defaults to 10.')
+    op.add_option('', '--audio', dest='audio', default=256, type='int',
+                  help='KB of audio in each file of a new tree, defaults to 256.')
+    op.add_option('', '--repeat', dest='repeat', default=3, type='int',
+                  help='Number of times to time each way of reading, defaults to 3.')
+    op.add_option('', '--drop-caches', dest='drop', default=False, action='store_true',
+                  help='Drop the page cache before each timing (Linux, as root).')
+    options, args = op.parse_args()
+    top = unicode(os.path.abspath(options.tree))
+    if not os.path.exists(top):
+        make_tree(top, options.artists, options.tracks, options.audio * 1024)
+    track = common.import_checkout(options.checkout, 'track')
+    track.error = common.quiet
+
+    files = music_files(top)
+    directory = tempfile.mkdtemp()
+    try:
+        ways = ways_of_reading(track, os.path.join(directory, 'tags.db'))
+        print('%-6s %s' % ('', ''.join(['%20s' % name for name, read in ways])))
+        for format in formats:
+            paths = files[format]
+            rates = []
+            for name, read in ways:
+                seconds = best_time(read, paths, options.repeat, options.drop)
+                rates.append(len(paths) / seconds)
+            print('%-6s %s' % (format, ''.join(['%12.0f files/s' % r for r in rates])))
+    finally:
+        shutil.rmtree(directory)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+"""Measure the memory taken by the Track objects of a synthetic library.
+
+The library has --tracks tracks by 20,000 artists on 40,000 releases,
+with unique paths, track names and track ids. The tag values are made
+first, so that only the Track objects themselves are measured, and are
+given to Track as the tag cache would give them. The figure is the
+growth of the resident set size, read from /proc/self/status, so this
+runs on Linux only.
+
+Track is imported from the tree given by --checkout: see common.py. To
+compare with a Track that has an instance dict, give the checkout of
+the tree from before Track had __slots__:
+
+    python bench/track_memory.py
+    python bench/track_memory.py --checkout /tmp/dbm-before"""
+
+import gc
+from optparse import OptionParser
+
+import common
+
+def rss():
+    """Return the resident set size of this process in bytes."""
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1]) * 1024
+
+def make_tags(n):
+    artists = [(common.artist_name(i), common.artist_mbid(i)) for i in range(20000)]
+    releases = [(u'Release %d' % i, u'%08d-dddd-eeee-ffff-%012d' % (i, i)) for i in range(40000)]
+    tags = []
+    for i in range(n):
+        artistname, artistid = artists[i % len(artists)]
+        releasename, releaseid = releases[i % len(releases)]
+        tags.append((u'/music/%s/%s/%02d.ogg' % (artistname, releasename, i % 20),
+                     {'artistname': artistname, 'artistid': artistid,
+                      'albumartistname': artistname, 'albumartistid': artistid,
+                      'releasename': releasename, 'releaseid': releaseid,
+                      'trackname': u'Track %d' % i,
+                      'trackid': u'%08d-1111-2222-3333-%012d' % (i, i)}))
+    return tags
+
+def main():
+    op = OptionParser(usage='usage: %prog [options]')
+    common.add_checkout_option(op, 'Track')
+    op.add_option('', '--tracks', dest='tracks', default=500000, type='int',
+                  help='Number of tracks, defaults to 500000.')
+    options, args = op.parse_args()
+    track = common.import_checkout(options.checkout, 'track')
+
+    tags = make_tags(options.tracks)
+    st = common.Stat()
+    gc.collect()
+    before = rss()
+    tracks = [track.Track(path, t, st) for path, t in tags]
+    gc.collect()
+    grown = rss() - before
+    layout = '__slots__' if hasattr(track.Track, '__slots__') else 'instance dict'
+    print('%s: %d tracks, %.1f MB, %d bytes per track' %
+          (layout, len(tracks), grown / 1e6, grown / len(tracks)))
+
+if __name__ == '__main__':
+    main()
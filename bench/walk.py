@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+"""Time the file system calls of a library scan on a synthetic tree.
+
+The tree, made under --tree unless it is there already, has
+--artists artist folders of 10 albums, each of 20 empty .ogg files and
+a cover.jpg; 1000 artists make 200,000 music files. Only the walk is
+timed, not the reading of tags. It is timed the way Node.grow used to
+walk, with os.listdir, track.is_music, os.path.isdir, a check for
+.ignore and a stat of each music file by Track, and the way it walks
+now, with ded.list_directory and one stat of each music file. Each is
+timed --repeat times on a warm cache and the best time is reported.
+
+The scandir entries come from os.scandir or the scandir package if
+either is installed; --no-scandir times the listdir and lstat
+fallback instead.
+
+    python bench/walk.py --tree /tmp/walk200k"""
+
+import sys, os, time
+from optparse import OptionParser
+
+import common
+sys.path.insert(0, common.top)
+import dedpy.ded as ded
+import track
+
+def make_tree(top, artists):
+    for d, tags in common.make_album_folders(top, artists, 10):
+        for t in range(20):
+            open(os.path.join(d, u'%02d.ogg' % t), 'w').close()
+        open(os.path.join(d, u'cover.jpg'), 'w').close()
+
+def listdir_walk(path):
+    """Walk as Node.grow did with os.listdir, returning the number of
+    music files."""
+    os.stat(path)
+    paths = [os.path.join(path, x) for x in os.listdir(path) if isinstance(x, unicode)]
+    ignored = os.path.exists(os.path.join(path, '.ignore'))
+    musicpaths = [] if ignored else filter(track.is_music, paths)
+    for p in musicpaths:
+        # Track.__init__
+        os.stat(p)
+    n = len(musicpaths)
+    for d in filter(os.path.isdir, paths):
+        n += listdir_walk(d)
+    return n
+
+def entry_walk(path):
+    """Walk as Node.grow does with ded.list_directory, returning the
+    number of music files."""
+    os.stat(path)
+    entries = [e for e in ded.list_directory(path) if isinstance(e.name, unicode)]
+    ignored = '.ignore' in [e.name for e in entries]
+    music = [] if ignored else [(e.path, track.entry_stat(e))
+                                for e in entries if track.is_music_entry(e)]
+    n = len(music)
+    for e in entries:
+        if e.is_dir():
+            n += entry_walk(e.path)
+    return n
+
+def best_time(walk, top, repeat):
+    best = None
+    for i in range(repeat):
+        start = time.time()
+        n = walk(top)
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return n, best
+
+def main():
+    op = OptionParser(usage='usage: %prog [options]')
+    op.add_option('', '--tree', dest='tree', default='/tmp/dbm-bench-walk',
+                  help='Folder of the synthetic tree, defaults to /tmp/dbm-bench-walk.')
+    op.add_option('', '--artists', dest='artists', default=1000, type='int',
+                  help='Number of artist folders in a new tree, defaults to 1000.')
+    op.add_option('', '--repeat', dest='repeat', default=3, type='int',
+                  help='Number of times to time each walk, defaults to 3.')
+    op.add_option('', '--no-scandir', dest='scandir', default=True, action='store_false',
+                  help='Time the listdir and lstat fallback of ded.list_directory.')
+    options, args = op.parse_args()
+    top = unicode(os.path.abspath(options.tree))
+    if not os.path.exists(top):
+        make_tree(top, options.artists)
+    if not options.scandir:
+        ded.scandir = None
+    listdir_walk(top)
+    entries = 'scandir' if ded.scandir else 'listdir + lstat fallback'
+    for name, walk in [('listdir, is_music, isdir, Track stat', listdir_walk),
+                       ('list_directory, %s' % entries, entry_walk)]:
+        n, seconds = best_time(walk, top, options.repeat)
+        print('%-44s %d music files  %.2f s' % (name, n, seconds))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,93 @@
+"""Checkpoints of library scans in progress.
+
+While a library is being scanned, the folders that have been finished
+are appended to a checkpoint file every so often. If the scan is
+interrupted, a new scan of the same library can resume from the
+checkpoint: the folders in it are used as an earlier scan of the
+library is, so only folders that have changed since are listed again
+and only music files that have not been read, or have changed, have
+their tags read. The file is deleted when a scan finishes."""
+
+import os, time
+import cPickle as pickle
+
+magic = 'dbm-scan-checkpoint'
+
+def checkpoint_root(path):
+    """Return the path of the library whose scan was checkpointed in
+    the file at path, or None if there is no checkpoint there."""
+    try:
+        with open(path, 'rb') as f:
+            header = pickle.load(f)
+    except Exception:
+        return None
+    if isinstance(header, tuple) and len(header) == 2 and header[0] == magic:
+        return header[1]
+    return None
+
+class ScanCheckpoint(object):
+    # Seconds between writes of the finished folders
+    interval = 30.0
+
+    def __init__(self, path, root_path, resume=False):
+        """Start checkpointing a scan of the library at root_path in
+        the file at path. If resume is True and the file holds a
+        checkpoint of a scan of that library, it is read into
+        self.folders and added to, rather than being replaced."""
+        self.path = path
+        # (mtime, tracks, untagged, sub-folder paths) of the
+        # finished folders in the checkpoint, keyed by path
+        self.folders = {}
+        if resume and checkpoint_root(path) == root_path:
+            end = self.read()
+            self.file = open(path, 'r+b')
+            self.file.truncate(end)
+            self.file.seek(end)
+        else:
+            self.file = open(path, 'wb')
+            pickle.dump((magic, root_path), self.file, pickle.HIGHEST_PROTOCOL)
+        self.unwritten = []
+        self.written = time.time()
+
+    def read(self):
+        """Read the checkpoint and return the offset of the end of the
+        last complete batch of folders in it. A scan that was killed
+        may have left the last batch half written."""
+        with open(self.path, 'rb') as f:
+            pickle.load(f)
+            end = f.tell()
+            while True:
+                try:
+                    batch = pickle.load(f)
+                except Exception:
+                    break
+                for path, folder in batch:
+                    self.folders[path] = folder
+                end = f.tell()
+        return end
+
+    def add(self, node):
+        """Record that node's folder has been scanned."""
+        self.unwritten.append(
+            (node.path, (node.mtime, node.tracks, node.untagged,
+                         [s.path for s in node.subtrees])))
+        if time.time() - self.written >= self.interval:
+            self.write()
+
+    def write(self):
+        if self.unwritten:
+            pickle.dump(self.unwritten, self.file, pickle.HIGHEST_PROTOCOL)
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.unwritten = []
+        self.written = time.time()
+
+    def close(self, completed):
+        """Stop checkpointing. If the scan was completed the
+        checkpoint is no longer needed, and is deleted."""
+        if completed:
+            self.file.close()
+            os.remove(self.path)
+        else:
+            self.write()
+            self.file.close()
@@ -18,12 +18,32 @@ class Dbm(CommandLineApp):
         op.add_option('-o', '--outdir', dest='outdir', type='string', default='.',
                       help='Folder to receive output, defaults to current folder.')
 
-        # op.add_option('-u', '--update', dest='update', default=False, action='store_true',
-        #               help='Don\'t re-scan whole library; instead update saved dbm data base.')
+        op.add_option('-u', '--update', dest='update', default=False, action='store_true',
+                      help='Update the saved library file: only new or modified music files' + \
+                          ' in the library folder are read.')
+
+        op.add_option('-w', '--watch', dest='watch', default=False, action='store_true',
+                      help='After creating the output files, keep watching the library' + \
+                          ' folder and bring the saved library and the output files up to' + \
+                          ' date whenever music is added, removed or modified.')
 
         op.add_option('-f', '--libfile', dest='savefile', type='string', default='library.dbm',
                       help="Saved library file, defaults to 'library.dbm'")
 
+        op.add_option('', '--library-format', dest='library_format', type='choice',
+                      choices=['sqlite', 'shards', 'pickle'], default='sqlite',
+                      help="Format in which to save the library: 'sqlite' (the default)," + \
+                          " 'shards' for a compressed file of shards, or 'pickle'. Any" + \
+                          " of them can be loaded.")
+
+        op.add_option('', '--generations', dest='library_generations', default=3, type='int',
+                      help='Number of earlier versions of the library file to keep when' + \
+                          " saving it, as LIBFILE.1, LIBFILE.2 and so on. Defaults to 3.")
+
+        op.add_option('', '--migrate', dest='migrate', default=False, action='store_true',
+                      help='Convert the pickled library or shard file given by -f to the sqlite' + \
+                          ' format, keeping the pickle as LIBFILE.pickle, and exit.')
+
         op.add_option('-r', '--rockbox', dest='path_to_rockbox', type='string', default=None,
                       help='Location of rockbox digital audio player.')
 
@@ -31,6 +51,73 @@ class Dbm(CommandLineApp):
                       help='Playlists and linkfiles will only be generated for artists with' + \
                           ' more than this number of tracks in the library.')
 
+        op.add_option('-j', '--workers', dest='scan_workers', default=1, type='int',
+                      help='Number of processes to use for reading tags when scanning' + \
+                          ' the library, defaults to 1.')
+
+        op.add_option('', '--tag-cache', dest='tag_cache_file', type='string',
+                      default=os.path.join(os.path.expanduser('~'), '.dbm-tags'),
+                      help="File in which to cache the tags of music files, so that unchanged" + \
+                          " files are not read again. Defaults to '~/.dbm-tags'.")
+
+        op.add_option('', '--no-tag-cache', dest='tag_cache_file', action='store_const', const=None,
+                      help="Don't use the tag cache.")
+
+        op.add_option('', '--lastfm-cache', dest='lastfm_cache_file', type='string',
+                      default=os.path.join(os.path.expanduser('~'), '.dbm-lastfm'),
+                      help="File in which to share the data downloaded from last.fm between" + \
+                          " libraries, so that it is not downloaded again for an artist" + \
+                          " that is in any of them. Defaults to '~/.dbm-lastfm'.")
+
+        op.add_option('', '--no-lastfm-cache', dest='lastfm_cache_file', action='store_const',
+                      const=None, help="Don't use the last.fm cache.")
+
+        op.add_option('', '--response-cache', dest='lastfm_response_cache_file', type='string',
+                      default=os.path.join(os.path.expanduser('~'), '.dbm-responses'),
+                      help="File in which to cache the responses to last.fm requests, so that" + \
+                          " a request is not made again until its response is out of date." + \
+                          " Defaults to '~/.dbm-responses'.")
+
+        op.add_option('', '--no-response-cache', dest='lastfm_response_cache_file',
+                      action='store_const', const=None,
+                      help="Don't use the last.fm response cache.")
+
+        op.add_option('', '--import-lastfm', dest='import_lastfm', type='string', default=None,
+                      help="Merge the last.fm cache file IMPORT_LASTFM, e.g. one exported from" + \
+                          " another machine, into the last.fm cache before loading the library.")
+
+        op.add_option('', '--export-lastfm', dest='export_lastfm', type='string', default=None,
+                      help="Put the data downloaded from last.fm for the library's artists" + \
+                          " into the last.fm cache file EXPORT_LASTFM, which is created if" + \
+                          " need be, replacing what it has for those artists.")
+
+        op.add_option('', '--resume', dest='resume', default=False, action='store_true',
+                      help='Resume an interrupted scan of the library from its checkpoint,' + \
+                          ' rather than starting again.')
+
+        op.add_option('', '--checkpoint', dest='scan_checkpoint_file', type='string',
+                      default=os.path.join(os.path.expanduser('~'), '.dbm-checkpoint'),
+                      help="File in which to checkpoint the scan of the library, so that" + \
+                          " an interrupted scan can be resumed. Defaults to '~/.dbm-checkpoint'.")
+
+        op.add_option('', '--no-checkpoint', dest='scan_checkpoint_file', action='store_const',
+                      const=None, help="Don't checkpoint the scan of the library.")
+
+        op.add_option('', '--lastfm-workers', dest='lastfm_workers', default=4, type='int',
+                      help='Number of artists whose last.fm data is downloaded at once,' + \
+                          ' defaults to 4. However many there are, no more than' + \
+                          ' LASTFM_RATE requests a second are made to last.fm.')
+
+        op.add_option('', '--lastfm-rate', dest='lastfm_rate', default=5.0, type='float',
+                      help='Number of requests a second to make to last.fm, at most.' + \
+                          ' Defaults to 5, the most that last.fm allows. Requests that' + \
+                          ' last.fm throttles are retried after an exponential backoff.')
+
+        op.add_option('', '--lastfm-server', dest='lastfm_server', type='string', default=None,
+                      help='HOST:PORT of a stand-in for the last.fm web service, such as' + \
+                          ' lastfmstub.py, to make requests to instead. The last.fm and' + \
+                          ' response caches are not used, and the library is not saved.')
+
         op.add_option('', '--numtries', dest='numtries', default=3, type='int',
                       help='Number of times to attempt web query for an artist before giving up.')
 
@@ -116,15 +203,26 @@ class Dbm(CommandLineApp):
         self.check_settings()
         settings.show()
 
+        if settings.migrate:
+            if store.is_library_store(settings.savefile):
+                log('%s is already in the sqlite format' % settings.savefile)
+            else:
+                log('Converting %s to the sqlite format' % settings.savefile)
+                migrate_library(settings.savefile)
+            self.exit(0)
+
+        if settings.import_lastfm:
+            if not open_lastfm_cache():
+                raise DbmError('--import-lastfm needs a last.fm cache to import into')
+            log('Merging %s into the last.fm cache' % settings.import_lastfm)
+            n = open_lastfm_cache().merge(settings.import_lastfm)
+            log('%d artists added to the last.fm cache' % n)
+
         if not settings.libdir:
             print 'loading saved library'
             log('Loading saved library file %s' % settings.savefile)
             try:
-                root = load_pickled_object(settings.savefile)
-                # Pickles made by previous versions may have stored
-                # paths as strings a.o.t. unicode
-                if isinstance(root.path, str):
-                    root.decode_strings()
+                root = load_library(settings.savefile)
             except:
                 raise DbmError('Could not load saved dbm library file %s' % settings.savefile)
             log('Loaded library with %d artists' % len(root.artists))
@@ -135,22 +233,33 @@ class Dbm(CommandLineApp):
             root.artists = {}
             root.artistids = {}
             root.artistnames = {}
+            log('Constructing database of artists in library')
+            root.prepare_library()
         else:
+            previous = None
+            if settings.update:
+                log('Loading saved library file %s' % settings.savefile)
+                try:
+                    previous = load_library(settings.savefile, prepare=False)
+                except:
+                    raise DbmError('Could not load saved dbm library file %s' % settings.savefile)
+            root = Root(settings.libdir, None, scan=False)
+            if previous:
+                # Keep the data downloaded from last.fm
+                for attr in ['biographies', 'similar_artists', 'tags_by_artist', 'lastfm_users']:
+                    setattr(root, attr, getattr(previous, attr))
+            # The artist database is built, and last.fm data for
+            # artists with MBIDs downloaded, while the scan goes on.
             log('Scanning library rooted at %s' % settings.libdir)
-            root = Root(settings.libdir, None)
+            root.scan_and_prepare(previous, resume=settings.resume)
+            previous = None
 
         if settings.create_files and settings.libdir:
             # was and (settings.libdir or not settings.update):
-            log('Saving library to %s' % settings.savefile)
-            pickle_object(root, settings.savefile)
+            self.save_library()
 
         settings.libdir = None # Not used subsequently! Use root.path instead.
 
-        log('Constructing database of artists in library')
-        root.create_artist_name_to_mbid_mapping()
-        root.set_dbm_artistids()
-        root.create_artists()
-
         if settings.show_tree or settings.show_tracks:
             root.show()
             self.exit(0)
@@ -176,49 +285,94 @@ class Dbm(CommandLineApp):
 
         if settings.query_lastfm:
             log('Retrieving similar artist lists from last.fm')
-        root.download_lastfm_data() # Call this even if not making web queries
+        root.download_artist_lastfm_data_maybe() # Call this even if not making web queries
+
+        if settings.export_lastfm:
+            log('Exporting last.fm data to %s' % settings.export_lastfm)
+            cache = lastfmcache.LastfmCache(settings.export_lastfm)
+            try:
+                log('%d artists exported' % root.export_lastfm_data(cache))
+            finally:
+                cache.close()
 
         if settings.create_files:
-            log('Saving library to %s' % settings.savefile)
-            pickle_object(root, settings.savefile)
+            self.save_library()
 
             log('Creating playlists and rockbox database')
+            self.write_output_files()
 
-            links_dir = os.path.join(settings.outdir, 'Links')
-            lastfm_similar_links_dir = os.path.join(links_dir, 'Last.fm_Similar')
-            musicspace_similar_links_dir = os.path.join(links_dir, 'Musicspace_Similar')
-            az_links_dir = os.path.join(links_dir, 'A-Z')
-
-            playlists_dir = os.path.join(settings.outdir, 'Playlists')
-            single_artists_playlists_dir = os.path.join(playlists_dir, 'Single_Artists')
-            all_artists_playlists_dir = os.path.join(playlists_dir, 'All_Artists')
-            lastfm_similar_playlists_dir = os.path.join(playlists_dir, 'Last.fm_Similar')
-            musicspace_similar_playlists_dir = os.path.join(playlists_dir, 'Musicspace_Similar')
-
-            rec_dir = os.path.join(settings.outdir, 'Recommended')
-
-            for d in [links_dir, rec_dir, playlists_dir,
-                      az_links_dir, lastfm_similar_links_dir, musicspace_similar_links_dir,
-                      single_artists_playlists_dir, all_artists_playlists_dir,
-                      lastfm_similar_playlists_dir, musicspace_similar_playlists_dir]:
-                if not os.path.exists(d):
-                    os.mkdir(d)
-
-            root.write_lastfm_similar_and_present_linkfiles(lastfm_similar_links_dir)
-            if settings.musicspace_ready:
-                root.write_musicspace_similar_artists_linkfiles(musicspace_similar_links_dir)
-            root.write_similar_but_absent_linkfiles(rec_dir)
-            root.write_a_to_z_linkfiles(az_links_dir)
-
-            if settings.musicspace_ready:
-                root.write_musicspace_similar_artists_playlists(musicspace_similar_playlists_dir)
-            root.write_lastfm_similar_and_present_playlists(lastfm_similar_playlists_dir)
-            root.write_single_artists_playlists(single_artists_playlists_dir)
-            root.write_all_artists_playlist(all_artists_playlists_dir)
+            if settings.watch:
+                self.watch_library()
 
             log('Done')
             self.exit(0)
 
+    def save_library(self):
+        if settings.lastfm_server:
+            # What the stand-in served must not replace the library's
+            # last.fm data
+            log('Not saving library to %s: last.fm requests go to %s' %
+                (settings.savefile, settings.lastfm_server))
+            return
+        log('Saving library to %s' % settings.savefile)
+        save_library(root, settings.savefile)
+
+    def write_output_files(self):
+        links_dir = os.path.join(settings.outdir, 'Links')
+        lastfm_similar_links_dir = os.path.join(links_dir, 'Last.fm_Similar')
+        musicspace_similar_links_dir = os.path.join(links_dir, 'Musicspace_Similar')
+        az_links_dir = os.path.join(links_dir, 'A-Z')
+
+        playlists_dir = os.path.join(settings.outdir, 'Playlists')
+        single_artists_playlists_dir = os.path.join(playlists_dir, 'Single_Artists')
+        all_artists_playlists_dir = os.path.join(playlists_dir, 'All_Artists')
+        lastfm_similar_playlists_dir = os.path.join(playlists_dir, 'Last.fm_Similar')
+        musicspace_similar_playlists_dir = os.path.join(playlists_dir, 'Musicspace_Similar')
+
+        rec_dir = os.path.join(settings.outdir, 'Recommended')
+
+        for d in [links_dir, rec_dir, playlists_dir,
+                  az_links_dir, lastfm_similar_links_dir, musicspace_similar_links_dir,
+                  single_artists_playlists_dir, all_artists_playlists_dir,
+                  lastfm_similar_playlists_dir, musicspace_similar_playlists_dir]:
+            if not os.path.exists(d):
+                os.mkdir(d)
+
+        root.write_lastfm_similar_and_present_linkfiles(lastfm_similar_links_dir)
+        if settings.musicspace_ready:
+            root.write_musicspace_similar_artists_linkfiles(musicspace_similar_links_dir)
+        root.write_similar_but_absent_linkfiles(rec_dir)
+        root.write_a_to_z_linkfiles(az_links_dir)
+
+        if settings.musicspace_ready:
+            root.write_musicspace_similar_artists_playlists(musicspace_similar_playlists_dir)
+        root.write_lastfm_similar_and_present_playlists(lastfm_similar_playlists_dir)
+        root.write_single_artists_playlists(single_artists_playlists_dir)
+        root.write_all_artists_playlist(all_artists_playlists_dir)
+
+    def watch_library(self):
+        """Apply changes in the library folder to the library and the
+        output files as they happen, until interrupted."""
+        log('Watching %s for changes' % root.path)
+        watcher = watch.make_watcher(root.path)
+        try:
+            while True:
+                changed = watcher.wait()
+                if not changed:
+                    continue
+                log('Updating %d changed folders' % len(changed))
+                root.update_folders(changed)
+                if not root.dirty_artistids:
+                    continue
+                root.download_artist_lastfm_data_maybe()
+                self.write_output_files()
+                root.dirty_artistids = set([])
+                self.save_library()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            watcher.close()
+
     def usage(self):
         print('dbm version %s' % __version__)
         print('Use -i and -o options to specify location of music library and output folder. E.g.\n')
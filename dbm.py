@@ -37,11 +37,22 @@
 #    ---------------------------------------------------------------------
 
 from __future__ import with_statement
-import sys, os, re, time, urllib, codecs, shutil
+import sys, os, re, time, codecs, shutil, copy, collections
+import threading, Queue
 import random, csv, math
 import optparse, logging
 import pylast.pylast as pylast
 import track
+import tagcache
+import lastfmcache
+import lastfmnet
+import httppool
+import responsecache
+import watch
+import checkpoint
+import store
+import shards
+import safefile
 from dedpy.ded import *
 __version__ = '0.9.50'
 __progname__ = 'dbm'
@@ -49,56 +60,158 @@ __root_path__ = None
 
 class Node(object):
     """A tree representation of a music library."""
+    # The LibraryIndex that a node of a library loaded lazily reads
+    # its sub-folders and tracks from. See LazyNode.
+    index = None
+
     def __init__(self, path, parent):
         self.path = path
         self.parent = parent
         self.subtrees = set([])
         self.tracks = []
+        # Music files lacking the tags needed to identify an artist
+        self.untagged = []
         self.dbm_artistids = {}
-        try:
-            self.grow()
-        except Exception, e:
-            error('Failed to scan library: %s' % e)
         self.mtime = None
 
-    def grow(self):
-        # contents = [x.decode('utf-8') for x in os.listdir(self.path)]
-
-        # print 'self.path %s unicode' % isinstance(self.path, unicode)
-        # x = filter(lambda(xi): not isinstance(xi, unicode), os.listdir(self.path))
-        # print 'not unicode:'
-        # print x
-
-        paths = os.listdir(self.path)
-        # Bjork and Sigur Ros are not unicode despite self.path being unicode: ???
-        paths = filter(lambda(x): isinstance(x, unicode), paths)
-
-        paths = [os.path.join(self.path, x) for x in paths]
-
-        if not os.path.exists(os.path.join(self.path, '.ignore')):
+    def walk(self, pre=None, post=None):
+        """Visit every node in this subtree, without recursion. pre
+        is called with each node before its subtrees are visited, and
+        post after they have all been visited. The nodes are visited
+        in the same order as by a recursive traversal."""
+        stack = [(self, False)]
+        while stack:
+            node, visited = stack.pop()
+            if visited:
+                post(node)
+                continue
+            if pre:
+                pre(node)
+            if post:
+                stack.append((node, True))
+            stack.extend([(subtree, False) for subtree in reversed(list(node.subtrees))])
+
+    def grow(self, scanner=None, previous=None):
+        """Build the tree of folders below this node, and their tracks.
+
+        If a ParallelScanner is given, the music files are handed
+        to it rather than being read here, and the workers read them
+        while the folders are being listed.
+
+        previous is a dict of the nodes of an earlier scan of the
+        library, keyed by path. Tracks whose files have not changed
+        since then are re-used rather than read again, and a folder
+        whose modification time is unchanged is not listed again."""
+        for node in self.scan(scanner, previous):
+            pass
+
+    def scan(self, scanner=None, previous=None):
+        """Grow the tree as grow() does, yielding each node as soon as
+        its tracks have been read, so that the nodes can be put to use
+        while the rest of the library is being scanned. A node is
+        yielded after its parent, but its sub-folders may not have
+        been added to the tree yet."""
+        stack = [self]
+        while stack:
+            node = stack.pop()
+            try:
+                for d in node.grow_node(scanner, previous):
+                    node.subtrees.add(Node(d, node))
+            except Exception, e:
+                error('Failed to scan library: %s' % e)
+            stack.extend(reversed(list(node.subtrees)))
+            if scanner:
+                scanner.listed(node)
+                for done in scanner.completed():
+                    yield done
+            else:
+                yield node
+        if scanner:
+            for done in scanner.completed(wait=True):
+                yield done
+
+    def grow_node(self, scanner=None, previous=None):
+        """Add the tracks in this folder and return the paths of its
+        sub-folders."""
+        self.mtime = os.stat(self.path).st_mtime
+        old = previous.get(self.path) if previous else None
+
+        if old is not None and old.mtime == self.mtime:
+            # Nothing has been added to or removed from this folder
+            # since the earlier scan.
+            musicfiles = [(p, None) for p in [t.path for t in old.tracks] + old.untagged]
+            dirs = [s.path for s in old.subtrees]
+            ignored = False
+        else:
+            # The entry types come with the directory listing, so this
+            # costs one stat per music file and nothing per folder.
+            entries = list_directory(self.path)
+            # Bjork and Sigur Ros are not unicode despite self.path being unicode: ???
+            entries = filter(lambda(e): isinstance(e.name, unicode), entries)
+
+            ignored = '.ignore' in [e.name for e in entries]
+            musicfiles = [] if ignored else \
+                [(e.path, track.entry_stat(e)) for e in entries if track.is_music_entry(e)]
+            dirs = [e.path for e in entries if e.is_dir()]
+
+        if not ignored:
             if not settings.quiet:
                 logi("\t\t%s" % library_relative_path(self.path))
-            musicpaths = filter(track.is_music, paths)
-            self.tracks = filter(lambda(t): t.valid, [track.Track(p) for p in musicpaths])
-        for d in filter(os.path.isdir, paths):
-            self.subtrees.add(Node(d, self))
+            self.add_tracks(musicfiles, scanner, old)
+        return dirs
+
+    def add_tracks(self, musicfiles, scanner=None, old=None):
+        """Create tracks for the music files in musicfiles, a list of
+        (path, stat result) pairs, in which the stat result may be
+        None if it is not known. If old is the node for this folder
+        from an earlier scan, its tracks are re-used for files that
+        have not been modified since."""
+        old_tracks = dict([(t.path, t) for t in old.tracks]) if old else {}
+        unread = []
+        for path, st in musicfiles:
+            t = old_tracks.get(path)
+            if t is not None and t.is_unchanged(st):
+                t.reset_artists()
+                self.tracks.append(t)
+                if track.scan_stats:
+                    track.scan_stats.reused += 1
+            else:
+                unread.append((path, st))
+        if scanner:
+            scanner.submit(self, unread)
+        else:
+            self.add_read_tracks([track.Track(p, st=st) for p, st in unread])
+
+    def add_read_tracks(self, tracks):
+        self.tracks.extend(filter(lambda(t): t.valid, tracks))
+        self.untagged.extend([t.path for t in tracks if not t.valid])
+
+    def nodes_by_path(self):
+        """Return a dict of the nodes in this subtree, keyed by path."""
+        nodes = {}
+        self.walk(lambda(node): nodes.__setitem__(node.path, node))
+        return nodes
 
     def is_pure_subtree(self):
         return len(self.dbm_artistids) == 1
 
     def show(self):
+        self.walk(Node.show_node)
+
+    def show_node(self):
         print('%s %d %s' % (self.path.ljust(75), len(self.dbm_artistids), self.dbm_artistids))
         if settings.show_tracks:
             for t in self.tracks:
                 t.show()
-        for subtree in self.subtrees:
-            subtree.show()
 
     def create_artist_name_to_mbid_mapping(self):
         """artistids is a dict of artistids keyed by artistnames, that
         is maintained at the root of the tree in an attempt to
         synonymise artists when some of their music lacks musicbrainz
         artistid tags."""
+        self.walk(Node.add_node_artist_names_to_mbid_mapping)
+
+    def add_node_artist_names_to_mbid_mapping(self):
         for t in self.tracks:
             for aid, aname in [(t.artistid,     t.artistname),
                                (t.albumartistid, t.albumartistname)]:
@@ -110,9 +223,6 @@ class Node(object):
                         warn('artistname "%s" associated with multiple artist IDs: "%s" "%s"\n' %
                             (aname, aid, root.artistids[dbm_aname]))
 
-        for subtree in self.subtrees:
-            subtree.create_artist_name_to_mbid_mapping()
-
     def set_dbm_artistids(self):
         """Each node has a dict node.dbm_artistids containing the counts of
         tracks by each artist in that subtree. This function traverses the
@@ -121,41 +231,53 @@ class Node(object):
         function also sets the dbm_artistid of the music."""
 
         # The design of this function is key to the behaviour of dbm
+        self.walk(Node.set_node_dbm_artistids, Node.add_subtree_dbm_artistids)
 
+    def set_node_dbm_artistids(self):
         # Set dbm_artistid and dbm_albumartistid of tracks
         for t in self.tracks:
             for aid, aname, attr in [(t.artistid, t.artistname, 'dbm_artistid'),
                                      (t.albumartistid, t.albumartistname, 'dbm_albumartistid')]:
-                dbm_aid = root.make_dbm_artistid(aid, aname)
+                dbm_aid = track.intern_string(root.make_dbm_artistid(aid, aname))
                 # If MBID and name tags are lacking, this track does
                 # not contribute an artist
                 if dbm_aid:
                     setattr(t, attr, dbm_aid)
                     if not root.artistnames.has_key(dbm_aid):
-                        root.artistnames[dbm_aid] = []
+                        root.artistnames[dbm_aid] = {}
                     if aname:
-                        root.artistnames[dbm_aid].append(aname)
+                        names = root.artistnames[dbm_aid]
+                        names[aname] = names.get(aname, 0) + 1
 
         # Determine if we are in a pure directory
         # FIXME this is strange
+        self.dbm_artistids = {}
         dbm_aids = unique(filter(None, [t.dbm_artistid for t in self.tracks]))
         if len(dbm_aids) == 1: self.dbm_artistids = {dbm_aids[0]:1}
 
+    def add_subtree_dbm_artistids(self):
+        # Called once the subtrees' dicts are complete. This node's
+        # dict was made afresh by set_node_dbm_artistids, so it can be
+        # added to in place.
         for subtree in self.subtrees:
-            subtree.set_dbm_artistids()
-            self.dbm_artistids = table_union(self.dbm_artistids, subtree.dbm_artistids)
+            table_add(self.dbm_artistids, subtree.dbm_artistids)
 
     def set_track_artists(self):
+        self.walk(Node.set_node_track_artists)
+
+    def set_node_track_artists(self):
         for t in self.tracks:
             # All tracks are 'valid', i.e. have artist MBID or artist
             # name, hence must have dbm_artistid
             t.artist = root.artists[t.dbm_artistid]
             if t.dbm_albumartistid:
                 t.albumartist = root.artists[t.dbm_albumartistid]
-        for subtree in self.subtrees:
-            subtree.set_track_artists()
 
     def download_albumart(self):
+        self.walk(Node.download_node_albumart)
+        log_lastfm_stats()
+
+    def download_node_albumart(self):
         def isok(track):
             if not track.artistname or not track.releasename:
                 return False
@@ -190,7 +312,7 @@ class Node(object):
                 error('Error obtaining album art URL for %s: %s' % (unicode(ar), e))
             if url:
                 try:
-                    urllib.urlretrieve(url, target)
+                    httppool.download(url, target)
                     gotit = True
                     if ar[1] == albumart_releasename:
                         logi("%s: %s" % ar)
@@ -199,10 +321,15 @@ class Node(object):
                 except Exception, e:
                     logi("%s: %s      Failed: %s" % (ar[0], ar[1], e))
 
-        for subtree in self.subtrees:
-            subtree.download_albumart()
-
     def set_artist_subtrees_and_tracks(self):
+        self.walk(Node.set_node_artist_subtrees_and_tracks)
+
+    def set_node_artists(self):
+        """Both of the per-node steps of Root.create_artists()"""
+        self.set_node_track_artists()
+        self.set_node_artist_subtrees_and_tracks()
+
+    def set_node_artist_subtrees_and_tracks(self):
         if self.is_pure_subtree():
             if not self.parent or not self.parent.is_pure_subtree(): # At root of a maximal pure subtree
                 dbm_aid = self.dbm_artistids.keys()[0]
@@ -215,51 +342,60 @@ class Node(object):
             t.artist.tracks.append(t)
             if t.albumartist:
                 t.albumartist.tracks_as_albumartist.append(t)
-        for subtree in self.subtrees:
-            subtree.set_artist_subtrees_and_tracks()
 
     def gather_subtree_tracks(self, node):
         """Add all tracks in subtree to self.tracks"""
-        node.subtree_tracks.extend(self.tracks)
-        for subtree in self.subtrees:
-            subtree.gather_subtree_tracks(node)
+        self.walk(lambda(n): node.subtree_tracks.extend(n.tracks))
 
     def decode_strings(self):
-        self.path = self.path.decode('utf-8')
-        for t in self.tracks:
-            decode_strings(t)
-        for s in self.subtrees:
-            s.decode_strings()
+        def decode_node_strings(node):
+            node.path = node.path.decode('utf-8')
+            for t in node.tracks:
+                decode_strings(t)
+        self.walk(decode_node_strings)
 
     def delete_attributes(self, attr_names):
-        for attr_name in attr_names:
-            if (hasattr(self, attr_name)):
-                setattr(self, attr_name, None)
-        for subtree in self.subtrees:
-            subtree.delete_attributes(attr_names)
+        def delete_node_attributes(node):
+            for attr_name in attr_names:
+                if (hasattr(node, attr_name)):
+                    setattr(node, attr_name, None)
+        self.walk(delete_node_attributes)
 
     def __cmp__(self, other):
         return cmp(self.path, other.path)
 
     def gather_terminal_nodes(self):
-        if len(self.subtrees) == 0:
-            root.terminal_nodes.append(self)
-        else:
-            for subtree in self.subtrees:
-                subtree.gather_terminal_nodes()
+        def gather_node(node):
+            if len(node.subtrees) == 0:
+                root.terminal_nodes.append(node)
+        self.walk(gather_node)
 
 class Root(Node):
     """The root node has and does certain things that the internal
     nodes don't."""
-    def __init__(self, path, parent):
-        global __root_path__
-        __root_path__ = path
-        track.error = error
+    # dbm_artistids of the artists whose output files have been made
+    # out of date by update_folders(). The class attribute is for
+    # libraries saved before this existed.
+    dirty_artistids = frozenset([])
+    # The ShardedLibrary that a library loaded lazily from a shard
+    # file has still to read its biographies from
+    unread_shards = None
+    # The version of the library's data structures, which
+    # upgrade_library() brings pickles up to date from. The class
+    # attribute is for libraries saved before versions were recorded.
+    schema_version = 0
+
+    def __init__(self, path, parent, previous=None, scan=True):
+        """If previous is the root of an earlier scan of the library,
+        only new and modified music files have their tags read. If
+        scan is False the library is not scanned here: use stream()
+        or scan_and_prepare() to do that."""
         Node.__init__(self, path, parent)
-        __root_path__ = None
         # artistids is a dict of artist MBIDs, keyed by dbm_artistid
         self.artistids = {}
-        # artistnames is a dict of artist names, keyed by dbm_artistid
+        # artistnames is a dict, keyed by dbm_artistid, of the names
+        # used in the tags for that artist, with the number of times
+        # each occurs
         self.artistnames = {}
         # artists is a dict of Artist instances, keyed by dbm_artistid
         self.artists = {}
@@ -271,19 +407,124 @@ class Root(Node):
         self.biographies = {}
         self.lastfm_users = {}
         self.terminal_nodes = []
-        
+        self.dirty_artistids = set([])
+        # What has changed since the library was last saved to, or
+        # loaded from, a library store
+        self.unsaved = store.Changes()
+        self.schema_version = library_schema_version
+        if scan:
+            for node in self.stream(previous):
+                pass
+
+    def stream(self, previous=None, resume=False):
+        """Scan the library, yielding each node of the tree as soon
+        as its tracks have been read. See Node.scan().
+
+        The finished folders are checkpointed in
+        settings.scan_checkpoint_file. If resume is True and there is
+        a checkpoint of an interrupted scan of this library, its
+        folders are used as those of an earlier scan are."""
+        global __root_path__
+        __root_path__ = self.path
+        track.error = error
+        scanner = ParallelScanner(settings.scan_workers) \
+            if settings.scan_workers > 1 else None
+        previous = previous.nodes_by_path() if previous is not None else {}
+        scan_checkpoint = None
+        if settings.scan_checkpoint_file:
+            try:
+                scan_checkpoint = checkpoint.ScanCheckpoint(
+                    settings.scan_checkpoint_file, self.path, resume)
+            except Exception, e:
+                error('Failed to open scan checkpoint %s: %s' % (settings.scan_checkpoint_file, e))
+        if scan_checkpoint and scan_checkpoint.folders:
+            log('Resuming scan: %d folders were scanned before' % len(scan_checkpoint.folders))
+            previous.update(checkpointed_nodes(scan_checkpoint.folders))
+        begin_scan()
+        completed = False
+        try:
+            for node in self.scan(scanner, previous):
+                if scan_checkpoint:
+                    scan_checkpoint.add(node)
+                yield node
+            completed = True
+        finally:
+            if scanner:
+                scanner.close()
+            if scan_checkpoint:
+                scan_checkpoint.close(completed)
+            end_scan()
+            __root_path__ = None
+
     def prepare_library(self):
+        """Three walks of the tree. Each depends on the previous one
+        having finished: dbm artist ids use the name to MBID mapping
+        from anywhere in the library, and the Artist objects can only
+        be made once all the tracks' names have been counted."""
         self.create_artist_name_to_mbid_mapping()
         self.set_dbm_artistids()
         self.create_artists()
 
+    def scan_and_prepare(self, previous=None, prefetch=True, visit=None, resume=False):
+        """Scan the library and prepare it as prepare_library() does,
+        overlapping the scan with the work that can be done before it
+        is finished. The name to MBID mapping is built as the nodes
+        arrive, and, if prefetch is True, last.fm data for the
+        artists with MBIDs is downloaded by a LastfmPrefetcher while
+        the scan goes on. visit, if given, is called with each node
+        as it arrives. resume is as for stream(). The global root
+        must already be this node."""
+        prefetcher = LastfmPrefetcher(self) \
+            if prefetch and settings.query_lastfm else None
+        try:
+            for node in self.stream(previous, resume):
+                node.add_node_artist_names_to_mbid_mapping()
+                if prefetcher:
+                    prefetcher.add_node(node)
+                if visit:
+                    visit(node)
+        except:
+            if prefetcher:
+                prefetcher.cancel()
+            raise
+        self.set_dbm_artistids()
+        self.create_artists()
+        if prefetcher:
+            prefetcher.finish()
+
+    def materialise(self):
+        """Read the whole of a library that was loaded lazily, as is
+        needed before anything that uses all the tracks or all the
+        folders. Libraries that were not loaded lazily are whole
+        already, except that one loaded from a shard file has to read
+        its biographies shard.
+
+        Those biographies were given to the artists empty when the
+        library was loaded. Anything that has been added to them
+        since is kept."""
+        library = self.unread_shards
+        if library is None:
+            return
+        with library.lock:
+            if self.unread_shards is None:
+                return
+            for aid, biography, metadata, downloaded in library.biographies():
+                bio = self.biographies.get(aid)
+                if bio is None:
+                    continue
+                bio.biography = bio.biography or biography
+                bio.downloaded = bio.downloaded or downloaded
+                for k, v in metadata.iteritems():
+                    bio.metadata.setdefault(k, set()).update(v)
+            library.forget('biographies')
+            self.unread_shards = None
+
     def create_artists(self):
         dbm_artistids = self.artistnames.keys()
         self.artists = dict(zip(dbm_artistids,
                                 map(Artist, dbm_artistids)))
         self.all_artists = self.artists.copy()
-        self.set_track_artists()
-        self.set_artist_subtrees_and_tracks()
+        self.walk(Node.set_node_artists)
         self.sanitise_artists()
 
     def sanitise_artists(self):
@@ -317,27 +558,77 @@ class Root(Node):
         2. Tag data
         3. Biography contents
         Unless all three are available for an artist, the full artist data
-        is (re-)downloaded from last.fm
+        is (re-)downloaded from last.fm. The downloads are made
+        settings.lastfm_workers at a time.
         """
-        artists = [a for a in self.artists.values() if a.subtrees]
-        attrs = ['biographies', 'similar_artists', 'tags_by_artist']
-        persistent_dicts_exist = all([hasattr(self, attr) for attr in attrs])
-        if persistent_dicts_exist:
-            persistent_dicts = [getattr(self, attr) for attr in attrs]
+        artists = sorted([a for a in self.artists.values() if a.subtrees])
         n = len(artists)
-        i = 1
-        for artist in sorted(artists):
-            persistent_dicts_contain_artist = [d.has_key(artist.id) for d in persistent_dicts]
-            if persistent_dicts_exist and all(persistent_dicts_contain_artist):
-                for attr, pdict in zip(attrs, persistent_dicts):
-                    setattr(artist, attr, pdict[artist.id])
-            else:
-                try:
-                    artist.download_lastfm_data(msg_prefix="\t\t[%d / %d]\t" % (i, n))
-                except Exception, e:
-                    error('Failed to download last.fm data for %s: %s' % (artist.name, e))
-            i += 1
+        def download(artist, i):
+            try:
+                artist.download_lastfm_data(msg_prefix="\t\t[%d / %d]\t" % (i, n))
+            except Exception, e:
+                error('Failed to download last.fm data for %s: %s' % (artist.name, e))
+        jobs = [lambda artist=artist, i=i: download(artist, i)
+                for i, artist in enumerate(artists, 1)
+                if not self.restore_artist_lastfm_data(artist)]
+        lastfmnet.fetch_all(jobs, settings.lastfm_workers)
         self.tabulate_tags()
+        log_lastfm_stats()
+
+    def restore_artist_lastfm_data(self, artist):
+        """Give artist its similar artists, tags and biography from the
+        persistent dicts, if all three are there, or else from the
+        shared last.fm cache, and return whether they were."""
+        if not (self.similar_artists.has_key(artist.id) and
+                self.tags_by_artist.has_key(artist.id) and
+                self.biographies.has_key(artist.id)) and \
+                not self.restore_cached_lastfm_data(artist):
+            return False
+        artist.similar_artists = self.similar_artists[artist.id]
+        artist.tags = self.tags_by_artist[artist.id]
+        artist.biography = self.biographies[artist.id]
+        artist.biography.artist = artist
+        return True
+
+    def restore_cached_lastfm_data(self, artist):
+        """Copy artist's last.fm data from the shared last.fm cache
+        into the persistent dicts, and return whether it was there."""
+        cache = open_lastfm_cache()
+        cached = cache and cache.get(artist.id)
+        if not cached:
+            return False
+        name, lastfm_name, similar, tags, biography, metadata, updated = cached
+        if not artist.lastfm_name:
+            artist.lastfm_name = lastfm_name
+        self.similar_artists[artist.id] = similar
+        self.tags_by_artist[artist.id] = map(Tag, tags)
+        artist.biography.biography = artist.biography.biography or biography
+        for k, v in metadata.iteritems():
+            artist.biography.metadata.setdefault(k, set()).update(v)
+        artist.biography.downloaded = updated
+        self.biographies[artist.id] = artist.biography
+        self.unsaved.artistids.add(artist.id)
+        return True
+
+    def export_lastfm_data(self, cache, artistids=None):
+        """Put the last.fm data of the artists in artistids, or of
+        every artist that has all of it, into the LastfmCache cache,
+        and return the number of artists put there. Each goes in with
+        the time its data was downloaded, if that is known."""
+        if artistids is None:
+            artistids = self.biographies.keys()
+        records = []
+        for aid in artistids:
+            bio = self.biographies.get(aid)
+            if bio is None or aid not in self.similar_artists or \
+                    aid not in self.tags_by_artist:
+                continue
+            artist = self.artists.get(aid) or bio.artist
+            records.append((aid, artist.name, artist.lastfm_name, self.similar_artists[aid],
+                            [tag.name for tag in self.tags_by_artist[aid]],
+                            bio.biography, bio.metadata, bio.downloaded))
+        cache.put(records)
+        return len(records)
 
     def tabulate_tags(self):
         self.tags = {}
@@ -393,6 +684,8 @@ class Root(Node):
             return False
         user.get_artist_counts()
         self.lastfm_users[name] = user
+        self.unsaved.users.add(name)
+        log_lastfm_stats()
         return True
 
     def write_lastfm_similar_and_present_playlists(self, direc):
@@ -403,7 +696,7 @@ class Root(Node):
         for artist in artists:
             i += 1
             path = os.path.join(direc, artist.clean_name() + '.m3u')
-            if os.path.exists(path): continue
+            if self.output_is_current(path, [artist]): continue
             if i % 10 == 0 or i == nok:
                 log('Last.fm similar artists playlists: \t[%d / %d]' % (i, nok))
             tracks = generate_playlist(artist.lastfm_similar_and_present_artists())
@@ -422,7 +715,7 @@ class Root(Node):
         for artist in artists:
             i += 1
             path = os.path.join(direc, artist.clean_name() + '.m3u')
-            if os.path.exists(path): continue
+            if self.output_is_current(path, [artist]): continue
             if i % 10 == 0 or i == nok:
                 log('\tMusicspace similar artists playlists \t[%d / %d]' % (i, nok))
             tracks = artist.musicspace_similar_artists_playlist()
@@ -437,7 +730,7 @@ class Root(Node):
         for artist in artists:
             i += 1
             path = os.path.join(direc, artist.clean_name() + '.m3u')
-            if os.path.exists(path): continue
+            if self.output_is_current(path, [artist]): continue
             if i % 10 == 0 or i == nok:
                 log('\tSingle artist playlists: \t[%d / %d]' % (i, nok))
             try:
@@ -457,7 +750,7 @@ class Root(Node):
             chunk_start = chunk_end
             chunk_end = min(chunk_start + chunk_size, num_tracks)
             path = os.path.join(direc, ('0' if plist < 10 else '') + str(plist) + '.m3u')
-            if os.path.exists(path): continue
+            if os.path.exists(path) and not self.dirty_artistids: continue
             tracks = self.subtree_tracks[chunk_start:chunk_end]
             try:
                 write_playlist(tracks, path)
@@ -472,7 +765,7 @@ class Root(Node):
         for artist in artists:
             i += 1
             path = os.path.join(direc, artist.clean_name() + '.link')
-            if os.path.exists(path): continue
+            if self.output_is_current(path, [artist]): continue
             if i % 10 == 0 or i == nok:
                 log('\tLast.fm similar artists link files: \t[%d / %d]' % (i, nok))
             try:
@@ -489,7 +782,7 @@ class Root(Node):
         for tag in tags:
             i += 1
             path = os.path.join(direc, tag.name + '.link')
-            if os.path.exists(path): continue
+            if self.output_is_current(path, tag.artists): continue
             if i % 10 == 0 or i == n:
                 log('\tLast.fm tag link files: \t[%d / %d]' % (i, n))
             try:
@@ -505,7 +798,7 @@ class Root(Node):
         for tag in tags:
             i += 1
             path = os.path.join(direc, tag.name + '.m3u')
-            if os.path.exists(path): continue
+            if self.output_is_current(path, tag.artists): continue
             if i % 10 == 0 or i == n:
                 log('\tLast.fm tag playlists: \t[%d / %d]' % (i, n))
             try:
@@ -527,6 +820,7 @@ class Root(Node):
             except Exception, e:
                 error('Error updating biography for %s: %s' % (artist.name, e))
         log('%d/%d successful artist biography updates' % (success, n))
+        log_lastfm_stats()
 
     def write_present_artist_biographies(self, filepath):
         artists = [a for a in self.artists.values() if a.is_present()]
@@ -543,7 +837,7 @@ class Root(Node):
         for a in artists:
             i += 1
             path = os.path.join(direc, a.clean_name() + '.link')
-            if os.path.exists(path): continue
+            if self.output_is_current(path, [a]): continue
             if i % 10 == 0 or i == 1 or i == n:
                 logi('\tSimilar but absent biography links : \t%d / %d' % (i, n))
             try:
@@ -564,7 +858,7 @@ class Root(Node):
         for artist in artists:
             i += 1
             path = os.path.join(direc, artist.clean_name() + '.link')
-            if os.path.exists(path): continue
+            if self.output_is_current(path, [artist]): continue
             if i % 10 == 0 or i == nok:
                 log('Musicspace similar artists link files: \t%d / %d' % (i, nok))
             try:
@@ -581,9 +875,9 @@ class Root(Node):
         for i in range(len(index)):
             c = index[i]
             path = os.path.join(direc, c + '.link')
-            if os.path.exists(path): continue
-            log('Artist index link files: \t%s' % ' '.join(index[0:i]))
             artists = [a for a in self.artists.values() if a.name[0].upper() == c]
+            if self.output_is_current(path, artists): continue
+            log('Artist index link files: \t%s' % ' '.join(index[0:i]))
             try:
                 write_linkfile(sorted(artists), path)
             except Exception, e:
@@ -638,27 +932,239 @@ class Root(Node):
         for a in self.artists.values():
             a.write_music_space_entry(fileobj)
 
+    def update_folders(self, paths):
+        """Bring the tree up to date with changes in the folders in
+        paths, such as those reported by a watch.Watcher: music files
+        and sub-folders added, removed or modified. Only those folders
+        are listed again and only new or modified files are read. The
+        artist counts of their ancestors and the affected Artist
+        objects are updated in place, rather than by prepare_library,
+        and the affected artists are added to dirty_artistids. If any
+        of paths is not in the library, DbmError is raised and nothing
+        is changed."""
+        global __root_path__
+        for path in paths:
+            if path != self.path and not path.startswith(os.path.join(self.path, '')):
+                raise DbmError('%s is not in the library rooted at %s' % (path, self.path))
+        __root_path__ = self.path
+        nodes = self.nodes_by_path()
+        # A change in a folder that is not in the tree, or that has
+        # gone, is found by listing its nearest ancestor that is.
+        folders = set([])
+        for path in paths:
+            while path != self.path and (path not in nodes or not os.path.isdir(path)):
+                parent = os.path.dirname(path)
+                if parent == path: break
+                path = parent
+            if path in nodes:
+                folders.add(path)
+
+        removed, added, affected = [], [], set([])
+        # Nodes made by this update
+        grown = set([])
+        begin_scan()
+        try:
+            for path in sorted(folders):
+                # Folders removed or grown afresh by an earlier listing
+                # are skipped
+                node = nodes.get(path)
+                if node is not None and node not in grown:
+                    affected.update(self.relist_folder(node, nodes, removed, added, grown))
+        finally:
+            end_scan()
+            __root_path__ = None
+        self.update_artists(removed, added, affected, nodes)
+
+    def relist_folder(self, node, nodes, removed, added, grown):
+        """List the folder of node again, replacing its tracks and
+        sub-folders. Tracks that are no longer in the tree are
+        appended to removed and new ones to added. nodes is kept up
+        to date, and new nodes are added to grown. Return the
+        dbm_artistids whose artist folders may have changed."""
+        old_counts = node.dbm_artistids
+        affected = set([single_artistid(node)])
+        self.unsaved.folders[node.path] = node
+        removed.extend(node.tracks)
+        self.forget_tracks(node.tracks)
+        old = copy.copy(node)
+        node.tracks, node.untagged = [], []
+        try:
+            dirs = node.grow_node(None, {node.path: old})
+        except Exception, e:
+            error('Failed to scan library: %s' % e)
+            dirs = []
+
+        subtrees = dict([(subtree.path, subtree) for subtree in node.subtrees])
+        new_subtrees = []
+        for d in dirs:
+            if d not in subtrees:
+                subtree = Node(d, node)
+                subtree.grow()
+                node.subtrees.add(subtree)
+                new_subtrees.append(subtree)
+                for n in subtree.nodes_by_path().values():
+                    nodes[n.path] = n
+                    grown.add(n)
+                    self.unsaved.folders[n.path] = n
+        for path in set(subtrees) - set(dirs):
+            subtree = subtrees[path]
+            node.subtrees.discard(subtree)
+            self.unsaved.folders[path] = None
+            for n in subtree.nodes_by_path().values():
+                nodes.pop(n.path, None)
+                removed.extend(n.tracks)
+                self.forget_tracks(n.tracks)
+
+        node.add_node_artist_names_to_mbid_mapping()
+        for subtree in new_subtrees:
+            subtree.create_artist_name_to_mbid_mapping()
+        node.set_node_dbm_artistids()
+        for subtree in new_subtrees:
+            subtree.set_dbm_artistids()
+        node.add_subtree_dbm_artistids()
+        added.extend(node.tracks)
+        for subtree in new_subtrees:
+            subtree.walk(lambda(n): added.extend(n.tracks))
+        affected.add(single_artistid(node))
+
+        # Pass the change in counts up to the ancestors
+        delta = dict(node.dbm_artistids)
+        table_add(delta, dict([(k, -n) for k, n in old_counts.iteritems()]))
+        parent = node.parent
+        while parent:
+            before = single_artistid(parent)
+            for k, n in delta.iteritems():
+                if n:
+                    parent.dbm_artistids[k] = parent.dbm_artistids.get(k, 0) + n
+                    if parent.dbm_artistids[k] <= 0:
+                        del parent.dbm_artistids[k]
+                    self.unsaved.folders[parent.path] = parent
+            after = single_artistid(parent)
+            if before != after:
+                # The maximal pure subtrees of these artists have moved
+                affected.update([before, after])
+            parent = parent.parent
+        return affected
+
+    def forget_tracks(self, tracks):
+        """Remove tracks from the artist name counts and from their
+        Artist objects."""
+        gone = set(tracks)
+        artists = set([])
+        for t in tracks:
+            for dbm_aid, aname in [(t.dbm_artistid, t.artistname),
+                                   (t.dbm_albumartistid, t.albumartistname)]:
+                names = self.artistnames.get(dbm_aid)
+                if names and aname in names:
+                    names[aname] -= 1
+                    if not names[aname]:
+                        del names[aname]
+            artists.update(filter(None, [t.artist, t.albumartist]))
+        for artist in artists:
+            artist.tracks = [t for t in artist.tracks if t not in gone]
+            artist.tracks_as_albumartist = [t for t in artist.tracks_as_albumartist
+                                            if t not in gone]
+
+    def update_artists(self, removed, added, affected, nodes):
+        """Attach the added tracks to their Artist objects, creating
+        new ones as needed, and recompute the artist folders of the
+        affected artists."""
+        present = set(self.artists)
+        affected = set(affected)
+        for t in removed + added:
+            affected.update([t.dbm_artistid, t.dbm_albumartistid])
+        for t in added:
+            for dbm_aid in filter(None, [t.dbm_artistid, t.dbm_albumartistid]):
+                if not self.artists.has_key(dbm_aid):
+                    artist = self.all_artists.get(dbm_aid) or Artist(dbm_aid)
+                    self.artists[dbm_aid] = self.all_artists[dbm_aid] = artist
+            t.artist = self.artists[t.dbm_artistid]
+            t.artist.tracks.append(t)
+            if t.dbm_albumartistid:
+                t.albumartist = self.artists[t.dbm_albumartistid]
+                t.albumartist.tracks_as_albumartist.append(t)
+
+        affected.discard(None)
+        affected.discard(u'')
+        for dbm_aid in affected:
+            artist = self.artists.get(dbm_aid)
+            if artist is None:
+                continue
+            if not artist.tracks and not artist.tracks_as_albumartist:
+                self.artists.pop(dbm_aid)
+                continue
+            artist.subtrees = self.artist_subtrees(artist, nodes)
+            artist.unite_spuriously_separated_subtrees()
+        self.dirty_artistids = self.dirty_artistids | affected
+        self.unsaved.artistids.update(affected)
+
+        # Artists that have appeared or disappeared change the
+        # similar-and-present lists of the artists similar to them
+        appeared_or_gone = present.symmetric_difference(self.artists)
+        if appeared_or_gone:
+            for artist in self.artists.values():
+                if any([self.make_dbm_artistid(*x) in appeared_or_gone
+                        for x in artist.similar_artists]):
+                    self.dirty_artistids = self.dirty_artistids | set([artist.id])
+            self.unsaved.artistids.update(appeared_or_gone)
+
+    def artist_subtrees(self, artist, nodes):
+        """Return the set of ArtistNodes for artist, as made by
+        Node.set_node_artist_subtrees_and_tracks, but looking only at
+        the folders containing the artist's tracks and their
+        ancestors."""
+        anodes = []
+        folders = set([nodes.get(os.path.dirname(t.path)) for t in artist.tracks])
+        folders.discard(None)
+        tops = set([])
+        for folder in folders:
+            node = folder
+            while node:
+                if single_artistid(node) == artist.id and \
+                        (not node.parent or not node.parent.is_pure_subtree()):
+                    tops.add(node)
+                node = node.parent
+            if not folder.dbm_artistids:
+                t = [t for t in folder.tracks if t.artist is artist][0]
+                anodes.append(ArtistNode(folder, artist, t.albumartist, t.releasename))
+        anodes.extend([ArtistNode(node, artist, artist, None) for node in tops])
+        return set(anodes)
+
+    def output_is_current(self, path, artists=[]):
+        """Does the output file at path exist, and not need to be
+        written again because of changes to any of artists?"""
+        return os.path.exists(path) and \
+            not any([a.id in self.dirty_artistids for a in artists])
+
     def graft_subtree(self, subtree):
-        '''Use path of new subtree to find graft point, and graft.'''
+        '''Use path of new subtree to find graft point, and graft. If
+        the tree already contains a node with the same path, the new
+        subtree replaces it.'''
         # All paths are absolute, so root_path and path are identical
         # up to the length of root path.
-        if not subtree.path.startswith(self.path):
+        if not subtree.path.startswith(self.path) or subtree.path == self.path:
             raise DbmError("new subtree %s must lie within the tree rooted at %s" %
-                           (path, self.path))
+                           (subtree.path, self.path))
+        subdirs = subtree.path.replace(self.path, '', 1).split(os.path.sep)
+        subdirs = filter(None, subdirs)
+        node = self
         path = self.path
-        subdirs = subtree.path.replace(self.path, '', 1)#.split(os.path.sep)
-        next_node = [self]
-        for d in subdirs:
+        for d in subdirs[:-1]:
             path += os.path.sep + d
-            node = next_node
-            next_node = [s for s in node[0].subtrees if s.path == path]
+            next_node = [s for s in node.subtrees if s.path == path]
             if len(next_node) == 0:
-                # Subtree did not previously exist in the tree
-                node[0].subtrees.add(subtree)
+                # Folders between the graft point and the subtree
+                # did not previously exist in the tree
                 break
-            elif len(node) > 1:
-                raise DbmError('More than one subtree with path %s' % p)
-        subtree.parent = node[0]
+            elif len(next_node) > 1:
+                raise DbmError('More than one subtree with path %s' % path)
+            node = next_node[0]
+        for s in [s for s in node.subtrees if s.path == subtree.path]:
+            node.subtrees.remove(s)
+        node.subtrees.add(subtree)
+        subtree.parent = node
+        self.unsaved.folders[node.path] = node
+        self.unsaved.folders.update(subtree.nodes_by_path())
 
     def recently_added_nodes(self):
         # I don't think this is working correctly, and I am not using
@@ -671,6 +1177,323 @@ class Root(Node):
         # anodes = filter(lambda anode: len(anode.node.subtrees) == 0, anodes)
         return sorted(anodes, key=lambda anode: anode.node.mtime, reverse=True)
         
+class StoredAttribute(object):
+    """An attribute of a LazyNode that is read from the library store
+    the first time it is used."""
+    def __init__(self, name):
+        self.name = '_' + name
+
+    def __get__(self, node, cls):
+        if node is None:
+            return self
+        value = node.__dict__.get(self.name)
+        if value is None:
+            node.index.load_node(node)
+            value = node.__dict__[self.name]
+        return value
+
+    def __set__(self, node, value):
+        node.__dict__[self.name] = value
+
+class LazyNode(Node):
+    """A node of a library loaded lazily from a library store. Its
+    sub-folders, tracks and untagged files are read the first time
+    they are used; its dbm_artistids come from the index stored with
+    the library."""
+    subtrees = StoredAttribute('subtrees')
+    tracks = StoredAttribute('tracks')
+    untagged = StoredAttribute('untagged')
+
+    def __init__(self, path, parent, index, node_id):
+        Node.__init__(self, path, parent)
+        self.subtrees = self.tracks = self.untagged = None
+        self.index = index
+        self.node_id = node_id
+
+class LazyRoot(Root):
+    """The root of a library loaded lazily. Its artists are made from
+    the stored index and have their folders, as StoredArtistNodes,
+    but their lists of tracks are empty until materialise() is
+    called."""
+    subtrees = StoredAttribute('subtrees')
+    tracks = StoredAttribute('tracks')
+    untagged = StoredAttribute('untagged')
+
+    def __init__(self, path, index, node_id):
+        Root.__init__(self, path, None, scan=False)
+        self.subtrees = self.tracks = self.untagged = None
+        self.index = index
+        self.node_id = node_id
+
+    def materialise(self):
+        if self.index is not None:
+            self.index.materialise()
+
+class LibraryIndex(object):
+    """Makes the nodes of a library loaded lazily from a LibraryStore,
+    as they are needed. The nodes may be used from any thread."""
+    def __init__(self, library):
+        self.store = library
+        self.lock = threading.RLock()
+        # LazyNodes keyed by id
+        self.nodes = {}
+        self.root = None
+        # The tag strings shared by the tracks read, as track.interned
+        self.interned = {}
+
+    def load_root(self):
+        i, parent, path, mtime = self.store.root_node()
+        self.root = LazyRoot(path, self, i)
+        self.root.mtime = mtime
+        self.root.dbm_artistids = self.store.node_artists([i]).get(i, {})
+        self.nodes[i] = self.root
+        return self.root
+
+    def load_artists(self, artists):
+        """Make the root's Artists, with their folders, from the
+        index. artists is as returned by LibraryStore.artists(). The
+        root must be the global root."""
+        root = self.root
+        root.artistids = self.store.artist_mbids()
+        root.artistnames = self.store.artist_names()
+        root.all_artists = dict([(aid, Artist(aid)) for aid in root.artistnames])
+        root.artists = dict([(aid, root.all_artists[aid])
+                             for aid, name, lastfm_name, in_library in artists
+                             if in_library and aid in root.all_artists])
+        for aid, i, albumartist, album in self.store.artist_folders():
+            artist = root.artists.get(aid)
+            if artist is not None:
+                artist.subtrees.add(StoredArtistNode(self, i, artist,
+                                                     root.all_artists.get(albumartist), album))
+
+    def node(self, i):
+        """Return the node with id i, making it and its ancestors if
+        need be."""
+        with self.lock:
+            if i not in self.nodes:
+                i, parent, path, mtime = self.store.node(i)
+                self.make_node(i, self.node(parent), path, mtime,
+                               self.store.node_artists([i]).get(i, {}))
+            return self.nodes[i]
+
+    def make_node(self, i, parent, path, mtime, dbm_artistids):
+        if i not in self.nodes:
+            node = self.nodes[i] = LazyNode(path, parent, self, i)
+            node.mtime = mtime
+            node.dbm_artistids = dbm_artistids
+        return self.nodes[i]
+
+    def load_node(self, node):
+        """Read the sub-folders, tracks and untagged files of node."""
+        with self.lock:
+            d = node.__dict__
+            if d['_subtrees'] is None:
+                rows = self.store.children(node.node_id)
+                counts = self.store.node_artists([row[0] for row in rows])
+                node.subtrees = set([self.make_node(i, node, path, mtime, counts.get(i, {}))
+                                     for i, parent, path, mtime in rows])
+            if d['_tracks'] is None:
+                interned = track.interned
+                track.interned = self.interned
+                try:
+                    tracks = [t for i, t in self.store.tracks(node.node_id)]
+                    self.set_track_artists(tracks)
+                finally:
+                    track.interned = interned
+                node.tracks = tracks
+            if d['_untagged'] is None:
+                node.untagged = [path for i, path in self.store.untagged(node.node_id)]
+
+    def set_track_artists(self, tracks):
+        """Set the dbm artist ids and the Artists of tracks, as
+        prepare_library does."""
+        for t in tracks:
+            for aid, aname, attr in [(t.artistid, t.artistname, 'dbm_artistid'),
+                                     (t.albumartistid, t.albumartistname, 'dbm_albumartistid')]:
+                dbm_aid = track.intern_string(self.root.make_dbm_artistid(aid, aname))
+                if dbm_aid:
+                    setattr(t, attr, dbm_aid)
+            t.artist = self.root.all_artists.get(t.dbm_artistid)
+            if t.dbm_albumartistid:
+                t.albumartist = self.root.all_artists.get(t.dbm_albumartistid)
+
+    def materialise(self):
+        """Read every node that has not been read yet, give the
+        artists their tracks, and close the store."""
+        with self.lock:
+            if self.store is None:
+                return
+            root = self.root
+            rows = self.store.nodes()
+            counts = self.store.node_artists()
+            children = {}
+            for i, parent, path, mtime in rows:
+                if parent is not None:
+                    node = self.make_node(i, self.nodes[parent], path, mtime, counts.get(i, {}))
+                    children.setdefault(parent, []).append(node)
+            tracks, untagged = {}, {}
+            for i, t in self.store.tracks():
+                tracks.setdefault(i, []).append(t)
+            for i, path in self.store.untagged():
+                untagged.setdefault(i, []).append(path)
+            for i, node in self.nodes.iteritems():
+                d = node.__dict__
+                if d['_subtrees'] is None:
+                    node.subtrees = set(children.get(i, []))
+                if d['_tracks'] is None:
+                    node.tracks = tracks.get(i, [])
+                    self.set_track_artists(node.tracks)
+                if d['_untagged'] is None:
+                    node.untagged = untagged.get(i, [])
+                node.index = None
+            for artist in root.all_artists.values():
+                for anode in artist.subtrees:
+                    if isinstance(anode, StoredArtistNode):
+                        anode.get_node()
+                        anode.index = None
+            def add_artist_tracks(node):
+                for t in node.tracks:
+                    if t.artist:
+                        t.artist.tracks.append(t)
+                    if t.albumartist:
+                        t.albumartist.tracks_as_albumartist.append(t)
+            root.walk(add_artist_tracks)
+            self.store.close()
+            self.store = None
+
+class ParallelScanner(object):
+    """Reads music file tags in a pool of worker processes.
+
+    While Node.scan() lists the directories of the library, each
+    directory's music files are put on the pool's work queue with
+    submit(), so the workers are parsing tags while the listing
+    proceeds. completed() attaches the Track objects to their nodes
+    as the results arrive, which gives the same tree as a serial
+    scan."""
+    chunksize = 16
+
+    def __init__(self, workers):
+        import multiprocessing
+        self.pool = multiprocessing.Pool(workers)
+        # Listed nodes, in the order they were listed
+        self.listed_nodes = collections.deque()
+        # (files, result) of the reads submitted for each node
+        self.pending = {}
+
+    def submit(self, node, files):
+        """files is a list of (path, stat result) pairs, as for
+        Node.add_tracks()."""
+        if track.tag_cache:
+            cached = [track.cached_track(p, st) for p, st in files]
+            node.add_read_tracks(filter(None, cached))
+            files = [f for f, t in zip(files, cached) if t is None]
+        if files:
+            paths = [p for p, st in files]
+            self.pending[node] = \
+                (files, self.pool.map_async(track.read_tags, paths, self.chunksize))
+
+    def listed(self, node):
+        """Note that node's folder has been listed, and that any reads
+        for it have been submitted."""
+        self.listed_nodes.append(node)
+
+    def completed(self, wait=False):
+        """Yield the listed nodes whose tracks have all been read, in
+        the order in which they were listed. Unless wait is True,
+        stop at the first node whose results are not in yet."""
+        while self.listed_nodes:
+            node = self.listed_nodes[0]
+            if node in self.pending:
+                files, result = self.pending[node]
+                if not (wait or result.ready()):
+                    return
+                del self.pending[node]
+                try:
+                    self.add_results(node, files, result.get())
+                except Exception, e:
+                    error('Failed to scan library: %s' % e)
+            self.listed_nodes.popleft()
+            yield node
+
+    def add_results(self, node, files, results):
+        tracks = []
+        for (path, st), (tags, seconds, nbytes) in zip(files, results):
+            if tags is None:
+                error('failed to read tags for %s' % path)
+                tags = {}
+            t = track.Track(path, tags, st)
+            if track.scan_stats:
+                track.scan_stats.add(t.format, seconds, nbytes)
+            if track.tag_cache and tags:
+                track.tag_cache.put(t)
+            tracks.append(t)
+        node.add_read_tracks(tracks)
+
+    def close(self):
+        self.listed_nodes.clear()
+        self.pending = {}
+        self.pool.close()
+        self.pool.join()
+
+class LastfmPrefetcher(object):
+    """Downloads last.fm data in background threads while the library
+    is being scanned. Only artists with an MBID are fetched, since the
+    dbm_artistid of an artist known only by name is not settled until
+    the whole library has been seen. Like Artist.download_lastfm_data()
+    the downloads go into the root's persistent dicts, from which
+    Root.download_artist_lastfm_data_maybe() later takes them."""
+    def __init__(self, root):
+        self.root = root
+        self.cache = open_lastfm_cache()
+        self.queue = Queue.Queue()
+        # MBIDs that have been looked at
+        self.seen = set([])
+        self.workers = [threading.Thread(target=self.work)
+                        for i in range(settings.lastfm_workers)]
+        for worker in self.workers:
+            worker.setDaemon(True)
+            worker.start()
+
+    def add_node(self, node):
+        """Queue downloads for the artists of node's tracks that have
+        no stored last.fm data."""
+        pdicts = [self.root.biographies, self.root.similar_artists, self.root.tags_by_artist]
+        for t in node.tracks:
+            for aid, aname in [(t.artistid,      t.artistname),
+                               (t.albumartistid, t.albumartistname)]:
+                if aid and aname and aid not in self.seen:
+                    self.seen.add(aid)
+                    if not all([d.has_key(aid) for d in pdicts]) and \
+                            not (self.cache and aid in self.cache):
+                        self.queue.put((aid, aname))
+
+    def work(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            aid, aname = item
+            try:
+                Artist(aid, aname).download_lastfm_data(msg_prefix='\t\t')
+            except Exception, e:
+                error('Failed to download last.fm data for %s: %s' % (aname, e))
+
+    def cancel(self):
+        """Drop the downloads that have not started, and stop."""
+        try:
+            while True:
+                self.queue.get_nowait()
+        except Queue.Empty:
+            pass
+        self.finish()
+
+    def finish(self):
+        """Wait for the queued downloads to finish."""
+        for worker in self.workers:
+            self.queue.put(None)
+        for worker in self.workers:
+            worker.join()
+
 class ArtistNode(object):
     """A node may be associated with an artist for a variety of
     reasons. E.g.
@@ -713,10 +1536,28 @@ class ArtistNode(object):
                 ans = cmp(self.album, other.album)
         return ans
 
+class StoredArtistNode(ArtistNode):
+    """An ArtistNode of a library loaded lazily, whose node is only
+    made when it is used."""
+    def __init__(self, index, node_id, artist, albumartist, album):
+        self.index = index
+        self.node_id = node_id
+        ArtistNode.__init__(self, None, artist, albumartist, album)
+
+    def get_node(self):
+        if self._node is None:
+            self._node = self.index.node(self.node_id)
+        return self._node
+
+    def set_node(self, node):
+        self._node = node
+
+    node = property(get_node, set_node)
+
 class Artist(object):
     def __init__(self, dbm_aid, name=None):
         self.id = dbm_aid
-        self.name = name or most_frequent_element(root.artistnames[dbm_aid]) or '<no name>'
+        self.name = name or most_frequent_key(root.artistnames[dbm_aid]) or '<no name>'
         self.subtrees = set([])
         self.similar_artists = []
         self.tracks = []
@@ -755,7 +1596,9 @@ class Artist(object):
                         t.name = canonicalise_tag_name(t.name)
                     root.similar_artists[self.id] = self.similar_artists
                     root.tags_by_artist[self.id] = self.tags
+                    self.biography.downloaded = time.time()
                     root.biographies[self.id] = self.biography
+                    root.unsaved.artistids.add(self.id)
                     logi(msg_prefix + self.download_message(name, True))
                 else:
                     logi(msg_prefix + self.biography_download_message(name, True))
@@ -766,7 +1609,14 @@ class Artist(object):
                 name = self.lastfm_name or self.name
                 error('%s: %s' % (msg_prefix + self.download_message(name, False), e))
                 i = i+1
-                time.sleep(.1)
+                if i < settings.numtries:
+                    time.sleep(lastfmnet.backoff_delay(i - 1))
+        cache = open_lastfm_cache()
+        if cache and not waiting and not biography_only:
+            try:
+                root.export_lastfm_data(cache, [self.id])
+            except Exception, e:
+                error('Failed to add %s to the last.fm cache: %s' % (self.name, e))
         return not waiting
 
     def download_message(self, name, successful):
@@ -951,10 +1801,16 @@ class Biography(object):
     stored as an instance attribute.
     """
     metadata_marker = '-------------------'
+    # When the artist's last.fm data was downloaded, in seconds since
+    # the epoch, or None if that is not known. The class attribute is
+    # for biographies saved before the time was recorded.
+    downloaded = None
+
     def __init__(self, artist):
         self.artist = artist
         self.biography = ''
         self.metadata = {}
+        self.downloaded = None
 
     def make_path(self):
         return os.path.join(settings.all_biographies_dir,
@@ -970,6 +1826,7 @@ class Biography(object):
             if self.biography:
                 self.write(strip_html_tags(self.biography))
                 self.biography = ''
+                root.unsaved.artistids.add(self.artist.id)
                 return True
             return False
         elif settings.update_biography_metadata and self.metadata:
@@ -999,6 +1856,7 @@ class Biography(object):
             error('Failed to write biography for artist %s: %s' % (artist.name, e))
 
     def merge_metadata(self, new_metadata):
+        root.unsaved.artistids.add(self.artist.id)
         for k in new_metadata:
             if self.metadata.has_key(k):
                 self.metadata[k].add(new_metadata[k])
@@ -1102,6 +1960,10 @@ class Settings(object):
                                  '[0-9a-fA-F]'*4 + '-' + \
                                  '[0-9a-fA-F]'*4 + '-' + \
                                  '[0-9a-fA-F]'*12)
+    # Requests a second to make to last.fm
+    lastfm_rate = lastfmnet.max_rate
+    # 'host:port' of a stand-in for last.fm, such as lastfmstub.py
+    lastfm_server = None
     def __init__(self, options=None):
         self.gui = False
         if options:
@@ -1109,6 +1971,13 @@ class Settings(object):
             for attr in attributes:
                 setattr(self, attr, getattr(options, attr))
         self.network = pylast.get_lastfm_network(**self.lastfm)
+        lastfmnet.throttle(pylast, open_response_cache)
+        lastfmnet.limiter.set_rate(self.lastfm_rate)
+        if self.lastfm_server:
+            self.network.ws_server = (self.lastfm_server, '/2.0/')
+            # What a stand-in serves must not be kept as last.fm data,
+            # and save_library() refuses to save the library
+            self.lastfm_cache_file = self.lastfm_response_cache_file = None
     def show(self):
         public = filter(lambda(x): x[0] != '_', dir(self))
         noshow = ['read_file', 'read_module', 'show', 'ensure_value', 'mbid_regexp']
@@ -1185,6 +2054,301 @@ def dbm_split_into_chunks(objects, filepath):
 def artist_nodes(artists):
     return flatten([sorted(list(artist.subtrees)) for artist in artists])
 
+def single_artistid(node):
+    "Return the dbm_artistid of a pure subtree, otherwise None."
+    if node.is_pure_subtree():
+        return node.dbm_artistids.keys()[0]
+    return None
+
+def checkpointed_nodes(folders):
+    """Return a dict, keyed by path, of nodes made from the folders
+    of a ScanCheckpoint, to be used as the nodes of an earlier scan."""
+    nodes = {}
+    for path, (mtime, tracks, untagged, dirs) in folders.iteritems():
+        node = Node(path, None)
+        node.mtime = mtime
+        node.tracks = tracks
+        node.untagged = untagged
+        node.subtrees = set([Node(d, node) for d in dirs])
+        nodes[path] = node
+    return nodes
+
+# The shared cache of last.fm data, once open_lastfm_cache() has
+# opened it
+lastfm_cache = None
+lastfm_cache_lock = threading.Lock()
+
+def open_lastfm_cache():
+    """Return the LastfmCache in settings.lastfm_cache_file, opening
+    it the first time, or None if there is none."""
+    global lastfm_cache
+    with lastfm_cache_lock:
+        if lastfm_cache is None and settings.lastfm_cache_file:
+            try:
+                lastfm_cache = lastfmcache.LastfmCache(settings.lastfm_cache_file)
+            except Exception, e:
+                error('Failed to open last.fm cache %s: %s' % (settings.lastfm_cache_file, e))
+                settings.lastfm_cache_file = None
+    return lastfm_cache
+
+# The cache of responses to last.fm requests, once
+# open_response_cache() has opened it
+response_cache = None
+response_cache_lock = threading.Lock()
+
+def open_response_cache():
+    """Return the ResponseCache in settings.lastfm_response_cache_file,
+    opening it the first time, or None if there is none."""
+    global response_cache
+    with response_cache_lock:
+        if response_cache is None and settings.lastfm_response_cache_file:
+            try:
+                response_cache = responsecache.ResponseCache(settings.lastfm_response_cache_file)
+            except Exception, e:
+                error('Failed to open last.fm response cache %s: %s' %
+                      (settings.lastfm_response_cache_file, e))
+                settings.lastfm_response_cache_file = None
+    return response_cache
+
+def log_lastfm_stats():
+    lines = lastfmnet.stats.report()
+    if response_cache:
+        lines += response_cache.report()
+    for line in lines:
+        log(line)
+
+def begin_scan():
+    """Open the tag cache, start counting the files read and start
+    interning the tracks' tag strings."""
+    track.scan_stats = track.ScanStats()
+    track.interned = {}
+    if settings.tag_cache_file:
+        try:
+            track.tag_cache = tagcache.TagCache(settings.tag_cache_file)
+        except Exception, e:
+            error('Failed to open tag cache %s: %s' % (settings.tag_cache_file, e))
+
+def end_scan():
+    if track.tag_cache:
+        track.tag_cache.close()
+        track.tag_cache = None
+    for line in track.scan_stats.report():
+        log(line)
+    track.scan_stats = None
+    track.interned = None
+
+def load_library(path, prepare=True, lazy=False):
+    """Load the library saved at path, which may be a library store,
+    a shard file or a pickled library, and make it the global root. A
+    pickle is returned as it was saved; a library store or shard file
+    is prepared as by Root.prepare_library(), unless prepare is False,
+    and has its artists' last.fm data restored.
+
+    If lazy is True, a library store is loaded as a LazyRoot: only
+    the artists and the top of the tree are read, from the index
+    stored with the library, and the rest is read as it is used.
+    Libraries saved before the index was stored are loaded in full.
+    A shard file loaded lazily reads its biographies shard when
+    root.materialise() is called.
+
+    A pickle saved by an earlier version of dbm is upgraded, and
+    saved again, as it is loaded: see upgrade_library()."""
+    global root
+    # The tracks loaded share their tag strings, as they did when
+    # they were scanned
+    track.interned = {}
+    try:
+        if store.is_library_store(path):
+            root = load_library_store(path, prepare, lazy)
+        elif shards.is_shard_file(path):
+            root = load_shard_file(path, prepare, lazy)
+        else:
+            root = load_pickled_object(path)
+            if upgrade_library(path):
+                log('Upgraded %s to the current version of the library format' % path)
+    finally:
+        track.interned = None
+    return root
+
+def saved_library_format(path):
+    """Return the format of the library saved at path: 'sqlite',
+    'shards' or 'pickle'."""
+    if store.is_library_store(path):
+        return 'sqlite'
+    if shards.is_shard_file(path):
+        return 'shards'
+    return 'pickle'
+
+def load_library_store(path, prepare=True, lazy=False):
+    global root
+    # A lazily loaded library is read from whichever thread uses it
+    library = store.LibraryStore(path, check_same_thread=not lazy)
+    lazy = lazy and library.meta('indexed')
+    try:
+        if lazy:
+            index = LibraryIndex(library)
+            root = index.load_root()
+        else:
+            load_library_store_tree(library)
+        read_lastfm_data(library)
+        artists = library.artists()
+        biographies = library.biographies()
+        users = library.users()
+        root.unsaved = store.Changes(library.meta('token'))
+        if lazy:
+            index.load_artists(artists)
+    except:
+        library.close()
+        raise
+    if not lazy:
+        library.close()
+        if prepare:
+            root.prepare_library()
+    restore_library_data(artists, biographies, users)
+    return root
+
+def load_shard_file(path, prepare=True, lazy=False):
+    global root
+    names = [name for name in shards.shard_names
+             if not (lazy and name == 'biographies')]
+    library = shards.ShardedLibrary(path, names)
+    load_library_store_tree(library)
+    library.forget('tree')
+    read_lastfm_data(library)
+    if prepare:
+        root.prepare_library()
+    if lazy:
+        # The artists are given empty biographies for now
+        biographies = [(aid, u'', {}, None) for aid in library.biography_ids()]
+    else:
+        biographies = library.biographies()
+    restore_library_data(library.artists(), biographies, library.users())
+    for name in names:
+        library.forget(name)
+    if lazy:
+        root.unread_shards = library
+    return root
+
+def read_lastfm_data(library):
+    """Give the global root the last.fm data in a LibraryStore or
+    ShardedLibrary."""
+    root.dirty_artistids = library.dirty_artistids()
+    root.similar_artists = library.similar_artists()
+    root.tags_by_artist = dict([(aid, map(Tag, names))
+                                for aid, names in library.artist_tags().iteritems()])
+
+def restore_library_data(artists, biographies, users):
+    """Give the global root's artists their last.fm names and data,
+    and their biographies, and make its last.fm users, from the
+    records read from a LibraryStore or ShardedLibrary."""
+    names = {}
+    for aid, name, lastfm_name, in_library in artists:
+        names[aid] = (name, lastfm_name or '')
+        if aid in root.all_artists:
+            root.all_artists[aid].lastfm_name = lastfm_name or ''
+    for aid, biography, metadata, downloaded in biographies:
+        artist = root.all_artists.get(aid)
+        if artist is None:
+            # Only artists in the library have their biographies
+            # stored, but this one may have gone from it.
+            artist = Artist(aid, names[aid][0])
+            artist.lastfm_name = names[aid][1]
+        artist.biography.biography = biography
+        artist.biography.metadata = metadata
+        artist.biography.downloaded = downloaded
+        root.biographies[aid] = artist.biography
+    for name, counts in users.iteritems():
+        user = LastFmUser(name)
+        for aid, aname, count in counts:
+            artist = root.all_artists.get(aid) or Artist(aid, aname)
+            user.artist_counts[artist] = count
+        root.lastfm_users[name] = user
+    for artist in root.artists.values():
+        root.restore_artist_lastfm_data(artist)
+    root.tabulate_tags()
+
+def load_library_store_tree(library):
+    """Make the global root from the folders and tracks in a
+    LibraryStore or ShardedLibrary."""
+    global root
+    nodes = {}
+    for i, parent, node_path, mtime in library.nodes():
+        if parent is None:
+            node = root = Root(node_path, None, scan=False)
+        else:
+            node = Node(node_path, nodes[parent])
+            node.parent.subtrees.add(node)
+        node.mtime = mtime
+        nodes[i] = node
+    if not nodes:
+        raise DbmError('%s holds no library' % library.path)
+    for i, t in library.tracks():
+        nodes[i].tracks.append(t)
+    for i, untagged_path in library.untagged():
+        nodes[i].untagged.append(untagged_path)
+
+def save_library(root, path):
+    """Save the library in the format given by
+    settings.library_format: 'sqlite' for a library store, 'shards'
+    for a shard file, or 'pickle'. A pickled library or shard file
+    already at path is kept at path.pickle or path.shards when a
+    library store replaces it.
+
+    Saving to the library store that the library was last saved to,
+    or loaded from, only writes the records in root.unsaved, in a
+    single transaction. Otherwise the library is written in full to a
+    new file, which replaces the file at path once it is complete and
+    on disk. The file that it replaces is kept as path.1, and earlier
+    ones as path.2 and so on, up to settings.library_generations.
+
+    Libraries are not saved while settings.lastfm_server is set, as
+    the data that a stand-in for last.fm serves would be saved as the
+    artists' last.fm data."""
+    if settings.lastfm_server:
+        raise DbmError('Libraries are not saved while last.fm requests go to %s'
+                       % settings.lastfm_server)
+    generations = settings.library_generations
+    if settings.library_format == 'pickle':
+        root.materialise()
+        safefile.pickle_object(root, path, generations)
+        return
+    if settings.library_format == 'shards':
+        shards.save_shards(root, path, generations)
+        return
+    # Changes made while saving, such as by a LastfmPrefetcher, are
+    # noted for the next save
+    changes, root.unsaved = root.unsaved, store.Changes()
+    try:
+        if changes.token is not None and store.library_token(path) == changes.token:
+            library = store.LibraryStore(path)
+            try:
+                root.unsaved.token = library.save(root, changes)
+            finally:
+                library.close()
+        else:
+            temp = safefile.temp_path(path)
+            root.unsaved.token = store.create_library_store(root, temp)
+            if os.path.exists(path) and not store.is_library_store(path):
+                safefile.keep(path, path + '.' + saved_library_format(path))
+            safefile.replace(temp, path, generations)
+    except:
+        changes.update(root.unsaved)
+        root.unsaved = changes
+        raise
+
+def migrate_library(path, root=None):
+    """Replace the pickled library or shard file at path with a
+    library store holding the same library, keeping the old file at
+    path.pickle or path.shards. root is the library, if it has
+    already been loaded."""
+    format = saved_library_format(path)
+    if root is None:
+        root = load_library(path)
+    temp = safefile.temp_path(path)
+    root.unsaved = store.Changes(store.create_library_store(root, temp))
+    safefile.keep(path, path + '.' + format)
+    safefile.replace(temp, path)
+
 def library_relative_path(path):
     "Return path relative to root path"
     if __root_path__:
@@ -1248,19 +2412,81 @@ def rockbox_clean_name(s):
     s = s.replace('"', "'")
     return s
 
-def patch_out_of_date_data_structures():
+#------------------------------------------------------------------------------
+# Upgrading pickled libraries
+#
+# A pickled library records the version of its data structures in
+# root.schema_version. When the structures change,
+# library_schema_version goes up by one and a function that upgrades
+# a library from the previous version is registered for it with
+# @upgrades_from. A library store or shard file is made afresh from
+# its records whenever it is loaded, so needs none of this.
+
+library_schema_version = 1
+
+# Functions that upgrade the global root from a version, keyed by
+# that version
+library_upgrades = {}
+
+def upgrades_from(version):
+    def register(upgrade):
+        library_upgrades[version] = upgrade
+        return upgrade
+    return register
+
+def upgrade_library(path):
+    """Run the upgrades that the pickled library at the global root,
+    which was loaded from path, needs to bring it up to date, in
+    order, and save it to path again so that they are not needed
+    next time. Return whether there were any. If the library cannot
+    be saved, e.g. because its folder is read-only, the upgraded
+    library is used all the same."""
+    if root.schema_version > library_schema_version:
+        raise DbmError('%s was saved by a later version of %s' % (path, __progname__))
+    if root.schema_version == library_schema_version:
+        return False
+    while root.schema_version < library_schema_version:
+        library_upgrades[root.schema_version]()
+        root.schema_version += 1
+    try:
+        safefile.pickle_object(root, path, settings.library_generations)
+    except (IOError, OSError), e:
+        warn('Failed to save the upgraded library to %s: %s' % (path, e))
+    return True
+
+@upgrades_from(0)
+def upgrade_unversioned_library():
+    """Libraries saved before versions were recorded may lack
+    attributes that have been added since, and may have stored paths
+    as strings rather than unicode."""
+    # Folders saved before untagged files were recorded lack
+    # `untagged', and tracks saved before the tag cache lack the size
+    # and mtime of their files. The tracks' slots must be set before
+    # their strings can be decoded.
+    def upgrade_node(node):
+        if not hasattr(node, 'untagged'):
+            node.untagged = []
+        for t in node.tracks:
+            if not hasattr(t, 'size'):
+                t.size = t.mtime = None
+    root.walk(upgrade_node)
     if isinstance(root.path, str):
         root.decode_strings()
     if not hasattr(root, 'all_artists'):
         root.all_artists = root.artists.copy()
     if not hasattr(root, 'lastfm_users'):
-            root.lastfm_users = {}
+        root.lastfm_users = {}
     if not hasattr(root, 'biographies'):
-            root.biographies = {}
+        root.biographies = {}
+    if not hasattr(root, 'unsaved'):
+        root.unsaved = store.Changes()
+    for dbm_aid, names in root.artistnames.items():
+        if isinstance(names, list):
+            root.artistnames[dbm_aid] = tabulate(names)
 
     for artist in root.all_artists.values():
         if not hasattr(artist, 'biography'):
-            artist.biography = Biography(a)
+            artist.biography = Biography(artist)
         m = artist.biography.metadata
         for k in m: m[k] = set(m[k])
 
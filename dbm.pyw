@@ -66,6 +66,7 @@
 from __future__ import with_statement
 import os, sys, time, codecs
 import platform
+import multiprocessing
 from PyQt4.QtCore import *
 from PyQt4.QtGui import *
 import ui_settings_dlg
@@ -342,6 +343,8 @@ class MainWindow(QMainWindow):
             self.connect(thread, SIGNAL("logi(QString)"), self.logi)
             self.connect(thread, SIGNAL("logic(QString)"), self.logic)
             self.connect(thread, SIGNAL("finished(bool)"), finisher)
+        self.connect(self.libraryScanner, SIGNAL("scannedNode(PyQt_PyObject)"),
+                     self.scannedNode)
 
     def refreshDiskAndArtistsView(self):
         if dbm.root is not None:
@@ -506,6 +509,7 @@ class MainWindow(QMainWindow):
         # for ideas on doing that.
         if not self.okToContinue(): return
         if root is not None:
+            # Re-scan: only new or modified files will have their tags read
             path = root.path
             biographies = root.biographies
             similar_artists = root.similar_artists
@@ -520,6 +524,17 @@ class MainWindow(QMainWindow):
             similar_artists = {}
             tags_by_artist = {}
  
+        resume = False
+        if settings.scan_checkpoint_file and \
+                dbm.checkpoint.checkpoint_root(settings.scan_checkpoint_file) == path:
+            resume = QMessageBox.question(
+                self,
+                "%s - Resume interrupted scan?" % __progname__,
+                "A scan of %s was interrupted before it finished. " % path +\
+                    "Do you want to resume it, rather than scanning the whole " +\
+                    "library again?",
+                QMessageBox.Yes|QMessageBox.No) == QMessageBox.Yes
+
         if download_after_scan == 'Ask':
             download_after_scan = QMessageBox.question(
                 self,
@@ -542,14 +557,14 @@ class MainWindow(QMainWindow):
                     return False
 
         settings.download_after_scan = download_after_scan
-        self.libraryScanner.initialize(path, biographies, similar_artists, tags_by_artist)
+        self.libraryScanner.initialize(path, biographies, similar_artists, tags_by_artist,
+                                       previous=root, resume=resume)
         self.libraryScanner.start()
 
     def libraryRefresh(self):
         if not self.okToContinue(): return
         if self.alertIfNoLibrary(): return
-        self.libraryScan(dbm.root.path, dbm.root.biographies, dbm.root.similar_artists, dbm.root.tags_by_artist,
-                         download_after_scan=False)
+        self.libraryScan(dbm.root, download_after_scan=False)
 
     def libraryAdd(self):
         if not self.okToContinue(): return
@@ -707,9 +722,9 @@ class MainWindow(QMainWindow):
         return True
 
     def check_network_connection(self):
-        remotes = [dict(hostname='www.last.fm', url='/')]
+        remotes = ['http://www.last.fm/']
         try:
-            for resp in (ded.read_url(**remote) for remote in remotes):
+            for resp in (dbm.httppool.fetch(remote) for remote in remotes):
                 return True
         except Exception, e:
             self.warn('Warning: network connection check failed: %s' % e)
@@ -809,6 +824,11 @@ class MainWindow(QMainWindow):
         self.biographiesFetcher.initialize(dirs)
         self.biographiesFetcher.start()
         
+    def scannedNode(self, node):
+        self.diskTreeWidget.addScannedNode(node)
+        if node.parent is None:
+            self.diskViewDockWidget.setWidget(self.diskTreeWidget)
+
     def finishedScanningLibrary(self, completed):
         # descended from Form.finished() and Form.finishedIndexing()
         # rgpwpyqt/chap19/pageindexer.pyw
@@ -956,6 +976,14 @@ class MainWindow(QMainWindow):
 
 
 class DiskTreeWidget(QTreeWidget):
+    def __init__(self, parent=None):
+        super(DiskTreeWidget, self).__init__(parent)
+        # The nodes of a library loaded lazily whose items have not
+        # been expanded yet, keyed by item. Their sub-folders and
+        # tracks are added when they are.
+        self.unexpanded = {}
+        self.connect(self, SIGNAL("itemExpanded(QTreeWidgetItem*)"), self.expandItem)
+
     def toggleExpansion(self):
         if self.is_expanded:
             self.collapseAll()
@@ -989,16 +1017,39 @@ class DiskTreeWidget(QTreeWidget):
         return [(name, att[name]) for name in attr_names]
 
     def addNode(self, node, parent):
+        if node.index is not None:
+            self.addNodeItem(node, parent)
+            node.diskTreeWidgetItem.setChildIndicatorPolicy(QTreeWidgetItem.ShowIndicator)
+            self.unexpanded[node.diskTreeWidgetItem] = node
+            return
+        self.addNodeItems(node, parent)
+        for subtree in sorted(node.subtrees):
+            self.addNode(subtree, node.diskTreeWidgetItem)
+
+    def expandItem(self, item):
+        node = self.unexpanded.pop(item, None)
+        if node is not None:
+            self.addTrackItems(node, item)
+            for subtree in sorted(node.subtrees):
+                self.addNode(subtree, item)
+
+    def addNodeItems(self, node, parent):
+        self.addNodeItem(node, parent)
+        self.addTrackItems(node, node.diskTreeWidgetItem)
+
+    def addNodeItem(self, node, parent):
         # parent =  node.parent.diskTreeWidgetItem \
         #     if node.parent else self
         node.diskTreeWidgetItem = QTreeWidgetItem(
             parent,
             [a[1] for a in self.node_attributes(node)])
+
+    def addTrackItems(self, node, nodeItem):
         for track in sorted(node.tracks):
             attrs = self.node_attributes(track)
             attr_names = [a[0] for a in attrs]
             attrs = [a[1] for a in attrs]
-            trackItem = QTreeWidgetItem(node.diskTreeWidgetItem, attrs)
+            trackItem = QTreeWidgetItem(nodeItem, attrs)
             column = dict(zip(attr_names, range(len(attr_names))))
             trackItem.setTextColor(column['Artist'],
                                    Qt.darkGreen if track.artistid else Qt.red)
@@ -1007,14 +1058,28 @@ class DiskTreeWidget(QTreeWidget):
             trackItem.setTextColor(column['Album artist'],
                                    Qt.darkGreen if track.albumartistid else Qt.red)
 
-        for subtree in sorted(node.subtrees):
-            self.addNode(subtree, node.diskTreeWidgetItem)
-
+    def addScannedNode(self, node):
+        """Add a node of a library that is being scanned. Its parent
+        has been added already. The tree is populated afresh when the
+        scan is finished."""
+        if node.parent is None:
+            self.clear()
+            self.unexpanded = {}
+            item_attrs = self.node_attributes(node)
+            self.setColumnCount(len(item_attrs))
+            self.setHeaderLabels([a[0] for a in item_attrs])
+            self.setItemsExpandable(True)
+            self.addNodeItems(node, self)
+            self.topLevelItem(0).setExpanded(True)
+            self.is_expanded = False
+        else:
+            self.addNodeItems(node, node.parent.diskTreeWidgetItem)
 
     def populate(self, root, selectedNode = None):
         # descended from populateTree() in rgpwpyqt/chap14/ships-dict.pyw
         selected = None # not maintaining selectedness at the moment
         self.clear()
+        self.unexpanded = {}
         item_attrs = self.node_attributes(root)
         self.setColumnCount(len(item_attrs))
         self.setHeaderLabels([a[0] for a in item_attrs])
@@ -1029,6 +1094,11 @@ class DiskTreeWidget(QTreeWidget):
             self.setCurrentItem(selected)
 
 class ArtistsTreeWidget(DiskTreeWidget):
+    def __init__(self, parent=None):
+        super(ArtistsTreeWidget, self).__init__(parent)
+        # As DiskTreeWidget.unexpanded, for the artists' items
+        self.unexpandedArtists = {}
+
     def artist_attributes(self, artist):
         attr_names = ['', 'Similar Artists']
         att = dict(zip(attr_names, [''] * len(attr_names)))
@@ -1038,6 +1108,8 @@ class ArtistsTreeWidget(DiskTreeWidget):
 
     def populate(self, artists):
         self.clear()
+        self.unexpanded = {}
+        self.unexpandedArtists = {}
         if len(artists) == 0: return
         self.setItemsExpandable(True)
         first = True
@@ -1050,9 +1122,21 @@ class ArtistsTreeWidget(DiskTreeWidget):
                 self.setHeaderLabels(attr_names)
                 first = False
             artistItem = QTreeWidgetItem(self, attrs)
+            if dbm.root.index is not None:
+                artistItem.setChildIndicatorPolicy(QTreeWidgetItem.ShowIndicator)
+                self.unexpandedArtists[artistItem] = artist
+                continue
             for artist_node in artist.subtrees:
                 self.addNode(artist_node.node, parent=artistItem)
 
+    def expandItem(self, item):
+        artist = self.unexpandedArtists.pop(item, None)
+        if artist is None:
+            DiskTreeWidget.expandItem(self, item)
+            return
+        for artist_node in artist.subtrees:
+            self.addNode(artist_node.node, parent=item)
+
 class Settings(dbm.Settings):
     def __init__(self):
         dbm.Settings.__init__(self)
@@ -1081,6 +1165,21 @@ class Settings(dbm.Settings):
         self.lastfm_user_names = []
         self.lastfm_user_history_nweeks = 4
         self.numtries = 2
+        # Number of artists whose last.fm data is downloaded at once
+        self.lastfm_workers = 4
+        self.scan_workers = 1
+        # Shared with the command line program
+        self.tag_cache_file = os.path.join(os.path.expanduser('~'), '.dbm-tags')
+        self.scan_checkpoint_file = os.path.join(os.path.expanduser('~'), '.dbm-checkpoint')
+        self.lastfm_cache_file = os.path.join(os.path.expanduser('~'), '.dbm-lastfm')
+        self.lastfm_response_cache_file = os.path.join(os.path.expanduser('~'), '.dbm-responses')
+        # 'sqlite', 'shards' or 'pickle'
+        self.library_format = 'sqlite'
+        # Number of earlier versions of the library file to keep
+        self.library_generations = 3
+        # Read a library store's folders and tracks only as they are
+        # shown or used
+        self.lazy_load = True
         # FAT32 invalid chars in file/dir name
         # http://www.comentum.com/File-Systems-HFS-FAT-UFS.html
         self.fs_bad_chars = list('"/\*?<>|:')
@@ -1094,7 +1193,6 @@ class Settings(dbm.Settings):
         self.target = 'rockbox'
         self.quiet = False
         self.albumartdir = None
-        self.patch_out_of_date_data_structures = True
         self.download_after_scan = False
         ## This is fairly obscure.
         ## See the code [[for%20setting%20in%20settings%20persistent_settings][here]]
@@ -1106,6 +1204,7 @@ class Settings(dbm.Settings):
              ('minArtistTracks', lambda(qv): qv.toInt()[0]),
              ('minTagArtists', lambda(qv): qv.toInt()[0]),
              ('numtries', lambda(qv): qv.toInt()[0]),
+             ('scan_workers', lambda(qv): qv.toInt()[0]),
              ('lastfm_user_names', lambda(qv): map(str, qv.toStringList())),
              ('target', lambda(qv): unicode(qv.toString(), 'utf-8'))]
 
@@ -1136,6 +1235,7 @@ class SettingsDlg(QDialog, ui_settings_dlg.Ui_Dialog):
         self.minArtistTracksComboBox.addItems(map(str, range(1, 11)))
         self.minTagArtistsComboBox.addItems(map(str, range(1, 20)))
         self.numSimArtBiogsComboBox.addItems(map(str, range(1, 100)))
+        self.scanWorkersComboBox.addItems(map(str, range(1, 17)))
 
         self.update()
         
@@ -1168,7 +1268,10 @@ class SettingsDlg(QDialog, ui_settings_dlg.Ui_Dialog):
             ('lastfmQueriesHelpButton', '', 'lastfmQueriesHelp'),
 
             ('musicspaceDropoffSpinBox', 'valueChanged(double)', 'setMusicspaceDropoff'),
-            ('musicspaceDropoffHelpButton', '', 'musicspaceDropoffHelp')]
+            ('musicspaceDropoffHelpButton', '', 'musicspaceDropoffHelp'),
+
+            ('scanWorkersComboBox', 'currentIndexChanged(int)', 'setScanWorkers'),
+            ('scanWorkersHelpButton', '', 'scanWorkersHelp')]
         
         for ui_element, signal, action in connections:
             try:
@@ -1193,6 +1296,7 @@ class SettingsDlg(QDialog, ui_settings_dlg.Ui_Dialog):
         self.lastfmQueriesComboBox.setCurrentIndex(settings.numtries - 1)
         self.minArtistTracksComboBox.setCurrentIndex(settings.minArtistTracks - 1)
         self.minTagArtistsComboBox.setCurrentIndex(settings.minTagArtists - 1)
+        self.scanWorkersComboBox.setCurrentIndex(settings.scan_workers - 1)
 
     def setTarget(self):
         settings.target = unicode(self.targetComboBox.currentText(), 'utf-8')
@@ -1259,6 +1363,10 @@ class SettingsDlg(QDialog, ui_settings_dlg.Ui_Dialog):
     def setMusicspaceDropoff(self):
         settings.musicspace_dropoff_param = float(self.musicspaceDropoffSpinBox.value())
 
+    def setScanWorkers(self):
+        settings.scan_workers = int(self.scanWorkersComboBox.currentText())
+        self.parent.log('Set number of library scan processes to %d' % settings.scan_workers)
+
     def targetDevHelp(self):
         QMessageBox.information(
             self,
@@ -1313,6 +1421,12 @@ class SettingsDlg(QDialog, ui_settings_dlg.Ui_Dialog):
             "%s - help" % __progname__,
             "A musicspace file allows you to create playlists and links based on your personal notions of music similarity, rather than using similarity data from e.g. last.fm. If you have created a musicspace file, then select it here.\n\nA musicspace file is a .csv spreadsheet file: i.e. it's a plain text file with one row per artist, and with columns separated by commas. The first two columns contain the artist name and the artist MusicBrainz ID. You can leave the MusicBrainz ID empty, and %s will do its best to work out what artist you are referring to. The subsequent columns are where you define the position of artists relative to each other. There can be an arbitrary number of these columns, each corresponding to some axis in a multi-dimensional music space. The axes can be anything you like. One possibility is associating each axis with a musical genre. Or perhaps each axis should be defined by what lies at its opposite ends. However you define your dimensions, each artist must have a numeric entry in each of the columns, indicating that artist's position in music space." % __progname__)
 
+    def scanWorkersHelp(self):
+        QMessageBox.information(
+            self,
+            "%s - help" % __progname__,
+            "How many processes should %s use to read the tags of your music files when scanning the library? Reading tags is the slow part of a scan, so on a computer with several cores a large library will be scanned much faster if this is set to the number of cores. A value of 1 scans the library in a single process." % __progname__)
+
     def musicspaceDropoffHelp(self):
         QMessageBox.information(self,
                                 "%s - help" % __progname__,
@@ -1414,23 +1528,35 @@ class NewThread(QThread):
         while not self.isStopped():
             time.sleep(5)
 class LibraryScanner(NewThread):
-    def initialize(self, path, biographies={}, similar_artists={}, tags_by_artist={}):
+    def initialize(self, path, biographies={}, similar_artists={}, tags_by_artist={},
+                   previous=None, resume=False):
         NewThread.initialize(self)
         self.path = path
         self.biographies = biographies
         self.similar_artists = similar_artists
         self.tags_by_artist = tags_by_artist
+        self.previous = previous
+        self.resume = resume
         
     def run(self):
         self.logc('Scanning library at %s' % self.path)
         self.log('')
-        self.dbm.root = dbm.Root(self.path, None)
+        if self.previous is not None:
+            self.previous.materialise()
+        self.dbm.root = dbm.Root(self.path, None, scan=False)
         self.dbm.root.biographies = self.biographies
         self.dbm.root.similar_artists = self.similar_artists
         self.dbm.root.tags_by_artist = self.tags_by_artist
-        self.dbm.root.prepare_library()
+        # The disk view is filled in, and if the downloads are to
+        # follow the scan they are started, as the folders are read.
+        self.dbm.root.scan_and_prepare(self.previous, settings.download_after_scan,
+                                       self.scannedNode, self.resume)
+        self.previous = None
         self.finishUp()
 
+    def scannedNode(self, node):
+        self.emit(SIGNAL("scannedNode(PyQt_PyObject)"), node)
+
 class LibraryLoader(NewThread):
     def initialize(self, path):
         NewThread.initialize(self)
@@ -1438,9 +1564,18 @@ class LibraryLoader(NewThread):
 
     def run(self):
         try:
-            self.dbm.root = ded.load_pickled_object(self.path)
-            if settings.patch_out_of_date_data_structures:
-                self.dbm.patch_out_of_date_data_structures()
+            # Only the index of a library store, or the shards of a
+            # shard file other than the biographies, are read here if
+            # settings.lazy_load is set; the rest is read as it is
+            # used. A shard file's shards are read in parallel.
+            format = self.dbm.saved_library_format(self.path)
+            # A pickle saved by an earlier version is upgraded here,
+            # once.
+            self.dbm.load_library(self.path, lazy=settings.lazy_load)
+            if settings.library_format == 'sqlite' and format == 'pickle':
+                self.log('Converting %s to the sqlite format; the old file is kept as %s' %
+                         (self.path, self.path + '.pickle'))
+                self.dbm.migrate_library(self.path, self.dbm.root)
             self.settings.savefile = self.path
         except Exception, e:
             self.error('Failed to load library at %s: %s' % (self.path, e))
@@ -1454,8 +1589,9 @@ class LibrarySaver(NewThread):
 
     def run(self):
         try:
-            self.dbm.root.delete_attributes(['diskTreeWidgetItem'])
-            ded.pickle_object(self.dbm.root, self.path)
+            if settings.library_format == 'pickle':
+                self.dbm.root.delete_attributes(['diskTreeWidgetItem'])
+            self.dbm.save_library(self.dbm.root, self.path)
             self.settings.savefile = self.path
             self.finishUp()
         except Exception, e:
@@ -1465,6 +1601,7 @@ class AlbumArtDownloader(NewThread):
     def run(self):
         self.log('Downloading album art')
         try:
+            self.dbm.root.materialise()
             self.dbm.root.download_albumart()
         except Exception, e:
             self.error('Error downloading album art: %s' % e)
@@ -1477,13 +1614,14 @@ class LibraryGrafter(NewThread):
 
     def run(self):
         self.log('Scanning library subtree rooted at %s for addition to library' % self.path)
-        self.dbm.root.graft_subtree(dbm.Root(self.path, None))
-        self.log('Reconstructing database of artists in library')
-        self.dbm.root.artists = {}
-        self.dbm.root.artistids = {}
-        self.dbm.root.artistnames = {}
-        self.dbm.root.prepare_library()
-        self.finishUp()
+        # Only the folders of the subtree are listed, and the artists
+        # updated in place, rather than re-preparing the whole library
+        try:
+            self.dbm.root.materialise()
+            self.dbm.root.update_folders(dbm.watch.library_folders(self.path))
+            self.finishUp()
+        except dbm.DbmError, e:
+            self.error('Failed to add %s to the library: %s' % (self.path, e.value))
 
 class LastfmSimilarArtistSetter(NewThread):
     def run(self):
@@ -1504,6 +1642,7 @@ class PlaylistGenerator(NewThread):
         dbm.log = self.logi
 
     def run(self):
+        self.dbm.root.materialise()
         self.log('\tLast.fm user playlists')
 
         for name in settings.lastfm_user_names:
@@ -1549,6 +1688,7 @@ class LinksCreator(NewThread):
         dbm.log = self.logi
 
     def run(self):
+        self.dbm.root.materialise()
         self.log('\tMusic listened to by last.fm users')
         for name in settings.lastfm_user_names:
             self.log('\t\t%s' % name)
@@ -1602,6 +1742,7 @@ class BiographiesFetcher(NewThread):
         self.dirs = dirs
 
     def run(self):
+        self.dbm.root.materialise()
         linkfiles = {}
         self.log('\tCollecting last.fm user listening data')
         self.log('') ;
@@ -1645,6 +1786,8 @@ def processPath(path):
         raise
 
 if __name__ == '__main__':
+    # Needed for the library scan worker processes in a frozen executable
+    multiprocessing.freeze_support()
     app = QApplication(sys.argv)
     app.setOrganizationName(__progname__)
     app.setApplicationName(__progname__)
@@ -1,7 +1,14 @@
 from __future__ import with_statement
-import os, math, random, datetime, re, codecs
+import os, stat, math, random, datetime, re, codecs
 import subprocess
 import cPickle as pickle
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
 
 unique = lambda(lizt): list(set(lizt))
 any_duplicated = lambda(lizt): len(unique(lizt)) < len(lizt)
@@ -14,7 +21,11 @@ def tabulate(x):
 
 def most_frequent_element(lizt):
     if not lizt: return None
-    tab = tabulate(lizt)
+    return most_frequent_key(tabulate(lizt))
+
+def most_frequent_key(tab):
+    """Return the key of dict tab that has the largest count."""
+    if not tab: return None
     return tab.keys()[which_max(tab.values())]
     
 def diversity(x):
@@ -26,11 +37,14 @@ def diversity(x):
 
 def table_union(t1, t2):
     t = dict(t1)
-    for k in t2.keys():
-        if not k in t.keys(): t[k] = 0
-        t[k] += t2[k]
+    table_add(t, t2)
     return t
 
+def table_add(t1, t2):
+    """Add the counts in table t2 to those in t1, in place."""
+    for k, n in t2.iteritems():
+        t1[k] = t1.get(k, 0) + n
+
 which_max = lambda(x): x.index(max(x))
 which_min = lambda(x): x.index(min(x))
 
@@ -155,6 +169,46 @@ def decode_strings(obj):
         attr = getattr(obj, s)
         if isinstance(attr, str):
             setattr(obj, s, attr.decode('utf-8'))
+def list_directory(path):
+    """Return a list of the entries in directory `path', as returned
+    by scandir. Entry types come from the directory listing itself,
+    so is_dir(), is_file() and is_symlink() usually need no further
+    system calls. If scandir is not available, an equivalent is
+    constructed using os.listdir and one lstat per entry."""
+    if scandir is not None:
+        return list(scandir(path))
+    return [DirEntry(path, name) for name in os.listdir(path)]
+
+class DirEntry(object):
+    """Stand-in for the entries of scandir when it is not available."""
+    def __init__(self, directory, name):
+        self.name = name
+        self.path = os.path.join(directory, name)
+        self._lstat = None
+        self._stat = None
+
+    def stat(self):
+        if self._stat is None:
+            self._stat = os.stat(self.path) if self.is_symlink() else self._lstat
+        return self._stat
+
+    def is_symlink(self):
+        if self._lstat is None:
+            self._lstat = os.lstat(self.path)
+        return stat.S_ISLNK(self._lstat.st_mode)
+
+    def is_dir(self):
+        try:
+            return stat.S_ISDIR(self.stat().st_mode)
+        except OSError:
+            return False
+
+    def is_file(self):
+        try:
+            return stat.S_ISREG(self.stat().st_mode)
+        except OSError:
+            return False
+
 def mkdirp(d):
     if not os.path.exists(d):
         os.mkdir(d)
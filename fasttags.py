@@ -0,0 +1,391 @@
+"""Fast reading of the tags of music files.
+
+mutagen parses the whole structure of a file, including stream
+information that dbm does not use. The readers here only read the
+tag block of a file, seeking past audio data, cover art and the tag
+fields that dbm does not use, and never read more than max_bytes of
+a file. read_tags() returns None for files whose tags cannot be read
+this way, such as MP3s with ID3 unsynchronisation or only ID3v1
+tags, and track.Track then reads them with mutagen.
+
+The values are those that Track.parse_mutagen_tags_* would get from
+mutagen: unicode where mutagen decodes the text, and str where it
+gives the raw bytes."""
+
+import struct
+
+# The most bytes that are read to find the tags of one file
+max_bytes = 1 << 20
+
+class Unsupported(Exception):
+    """The tags of the file cannot be read without mutagen."""
+
+class BoundedFile(object):
+    """A file that counts the bytes read from it and refuses to read
+    more than max_bytes."""
+    def __init__(self, f):
+        self.f = f
+        self.nbytes = 0
+
+    def read(self, n):
+        if self.nbytes + n > max_bytes:
+            raise Unsupported('tags are too large')
+        data = self.f.read(n)
+        self.nbytes += len(data)
+        if len(data) < n:
+            raise Unsupported('unexpected end of file')
+        return data
+
+    def skip(self, n):
+        self.f.seek(n, 1)
+
+    def seek(self, offset, whence=0):
+        self.f.seek(offset, whence)
+
+    def tell(self):
+        return self.f.tell()
+
+def read_tags(path, format):
+    """Return a (tags, bytes read) tuple for the music file at path,
+    where tags is a dict keyed by track.tag_names, or None if the
+    file has to be read with mutagen."""
+    reader = readers.get(format)
+    if reader is None:
+        return None, 0
+    with open(path, 'rb') as f:
+        bf = BoundedFile(f)
+        try:
+            tags = reader(bf)
+        except (Unsupported, struct.error, LookupError, UnicodeDecodeError):
+            tags = None
+    return tags, bf.nbytes
+
+def syncsafe(data):
+    n = 0
+    for c in data:
+        n = (n << 7) | (ord(c) & 0x7f)
+    return n
+
+#------------------------------------------------------------------------------
+# ID3v2 (mp3)
+
+id3_text_frames = {'TPE1': 'artistname', 'TPE2': 'albumartistname',
+                   'TALB': 'releasename', 'TIT2': 'trackname'}
+
+id3_txxx_frames = {u'MusicBrainz Artist Id': 'artistid',
+                   u'MusicBrainz Album Artist Id': 'albumartistid',
+                   u'MusicBrainz Album Id': 'releaseid'}
+
+# mutagen upgrades ID3v2.2 frames to their ID3v2.3 names
+id3v22_frames = {'TP1': 'TPE1', 'TP2': 'TPE2', 'TAL': 'TALB', 'TT2': 'TIT2',
+                 'TXX': 'TXXX', 'UFI': 'UFID'}
+
+id3_encodings = ['latin-1', 'utf-16', 'utf-16-be', 'utf-8']
+
+def id3_terminator(data, encoding):
+    """Return the offset of the null that ends the first string in
+    data, or -1."""
+    if encoding in (1, 2):
+        for i in range(0, len(data) - 1, 2):
+            if data[i:i + 2] == '\0\0':
+                return i
+        return -1
+    return data.find('\0')
+
+def id3_text(data, encoding):
+    """The first of the null-separated values of an ID3 text."""
+    return data.decode(id3_encodings[encoding]).split(u'\0')[0]
+
+def read_id3(f):
+    header = f.read(10)
+    if header[:3] != 'ID3':
+        raise Unsupported('no ID3v2 tag')
+    major, flags = ord(header[3]), ord(header[5])
+    if major not in (2, 3, 4) or flags & 0x80:
+        # Unknown version, or unsynchronisation
+        raise Unsupported('ID3v2.%d tag with flags %x' % (major, flags))
+    end = 10 + syncsafe(header[6:10])
+    if flags & 0x40:
+        if major == 2:
+            # Compression
+            raise Unsupported('compressed ID3v2.2 tag')
+        size = f.read(4)
+        f.skip(struct.unpack('>I', size)[0] if major == 3 else syncsafe(size) - 4)
+
+    tags = {}
+    header_size = 6 if major == 2 else 10
+    while f.tell() + header_size <= end:
+        frame_header = f.read(header_size)
+        if frame_header[0] == '\0':
+            # Padding
+            break
+        if major == 2:
+            frame_id = id3v22_frames.get(frame_header[:3], frame_header[:3])
+            size = struct.unpack('>I', '\0' + frame_header[3:6])[0]
+            frame_flags = 0
+        else:
+            frame_id = frame_header[:4]
+            if major == 4:
+                if any([ord(c) & 0x80 for c in frame_header[4:8]]):
+                    raise Unsupported('frame size is not syncsafe')
+                size = syncsafe(frame_header[4:8])
+            else:
+                size = struct.unpack('>I', frame_header[4:8])[0]
+            frame_flags = ord(frame_header[9])
+        if not frame_id.isalnum() or f.tell() + size > end:
+            raise Unsupported('bad frame %r' % frame_id)
+        if frame_id not in id3_text_frames and frame_id not in ('TXXX', 'UFID'):
+            f.skip(size)
+            continue
+        data = f.read(size)
+        if major == 4:
+            if frame_flags & 0x0e:
+                # Compression, encryption or unsynchronisation
+                raise Unsupported('frame flags %x' % frame_flags)
+            if frame_flags & 0x40:
+                # Grouping identity
+                data = data[1:]
+            if frame_flags & 0x01:
+                # Data length indicator
+                data = data[4:]
+        elif major == 3:
+            if frame_flags & 0xc0:
+                raise Unsupported('frame flags %x' % frame_flags)
+            if frame_flags & 0x20:
+                data = data[1:]
+        if not data:
+            continue
+        if frame_id == 'UFID':
+            i = data.find('\0')
+            if i >= 0 and data[:i] == 'http://musicbrainz.org':
+                tags['trackid'] = data[i + 1:]
+            continue
+        encoding = ord(data[0])
+        if encoding > 3:
+            raise Unsupported('text encoding %d' % encoding)
+        if frame_id == 'TXXX':
+            i = id3_terminator(data[1:], encoding)
+            if i < 0:
+                continue
+            step = 2 if encoding in (1, 2) else 1
+            description = id3_text(data[1:i + 1], encoding)
+            if description in id3_txxx_frames:
+                tags[id3_txxx_frames[description]] = \
+                    id3_text(data[i + 1 + step:], encoding)
+        else:
+            tags[id3_text_frames[frame_id]] = id3_text(data[1:], encoding)
+    return tags
+
+#------------------------------------------------------------------------------
+# Vorbis comments (ogg and flac)
+
+vorbis_keys = {'artist': 'artistname',
+               'musicbrainz_artistid': 'artistid',
+               'albumartist': 'albumartistname',
+               'musicbrainz_albumartistid': 'albumartistid',
+               'album': 'releasename',
+               'musicbrainz_albumid': 'releaseid',
+               'title': 'trackname',
+               'musicbrainz_trackid': 'trackid'}
+
+def parse_vorbis_comment(data):
+    tags = {}
+    pos = 4 + struct.unpack_from('<I', data, 0)[0]
+    count = struct.unpack_from('<I', data, pos)[0]
+    pos += 4
+    for i in xrange(count):
+        n = struct.unpack_from('<I', data, pos)[0]
+        pos += 4
+        comment = data[pos:pos + n]
+        if len(comment) < n:
+            raise Unsupported('truncated comment')
+        pos += n
+        key, sep, value = comment.partition('=')
+        name = vorbis_keys.get(key.lower())
+        # As with mutagen, the first value is the one used
+        if name and name not in tags:
+            tags[name] = value.decode('utf-8', 'replace')
+    return tags
+
+def read_ogg_vorbis(f):
+    """Read Ogg pages until the first two packets of the first
+    logical stream, the Vorbis identification and comment headers,
+    are complete."""
+    packets, packet = [], []
+    serial = None
+    while len(packets) < 2:
+        header = f.read(27)
+        if header[:4] != 'OggS':
+            raise Unsupported('not an Ogg page')
+        lacing = [ord(c) for c in f.read(ord(header[26]))]
+        data = f.read(sum(lacing))
+        if serial is None:
+            serial = header[14:18]
+        elif header[14:18] != serial:
+            continue
+        pos = 0
+        for n in lacing:
+            packet.append(data[pos:pos + n])
+            pos += n
+            if n < 255:
+                packets.append(''.join(packet))
+                packet = []
+    if not packets[0].startswith('\x01vorbis') or not packets[1].startswith('\x03vorbis'):
+        raise Unsupported('not Ogg Vorbis')
+    return parse_vorbis_comment(packets[1][7:])
+
+def read_flac(f):
+    magic = f.read(4)
+    if magic[:3] == 'ID3':
+        # mutagen skips an ID3 tag before the FLAC stream
+        header = magic + f.read(6)
+        f.skip(syncsafe(header[6:10]) + (10 if ord(header[5]) & 0x10 else 0))
+        magic = f.read(4)
+    if magic != 'fLaC':
+        raise Unsupported('not FLAC')
+    while True:
+        header = f.read(4)
+        block_type = ord(header[0]) & 0x7f
+        size = struct.unpack('>I', '\0' + header[1:])[0]
+        if block_type == 4:
+            return parse_vorbis_comment(f.read(size))
+        if ord(header[0]) & 0x80:
+            # The last metadata block
+            return {}
+        f.skip(size)
+
+#------------------------------------------------------------------------------
+# MP4 (m4a)
+
+mp4_text_atoms = {'\xa9ART': 'artistname', 'aART': 'albumartistname',
+                  '\xa9alb': 'releasename', '\xa9nam': 'trackname'}
+
+mp4_freeform_atoms = {'com.apple.iTunes:MusicBrainz Artist Id': 'artistid',
+                      'com.apple.iTunes:MusicBrainz Album Artist Id': 'albumartistid',
+                      'com.apple.iTunes:MusicBrainz Album Id': 'releaseid',
+                      'com.apple.iTunes:MusicBrainz Track Id': 'trackid'}
+
+def mp4_atom(f):
+    """Read an atom header and return the atom's type and the offset
+    of the end of its data, or None if it extends to the end of the
+    file."""
+    size, kind = struct.unpack('>I4s', f.read(8))
+    if size == 1:
+        size = struct.unpack('>Q', f.read(8))[0] - 16
+    elif size == 0:
+        return kind, None
+    else:
+        size -= 8
+    if size < 0:
+        raise Unsupported('bad atom size')
+    return kind, f.tell() + size
+
+def find_mp4_atom(f, kind, end):
+    """Skip to the data of the atom of type kind among the atoms
+    from here to end, and return the offset of the end of its data,
+    or None if there is no such atom before end."""
+    while end is None or f.tell() < end:
+        atom_kind, atom_end = mp4_atom(f)
+        if atom_kind == kind:
+            return atom_end
+        if atom_end is None:
+            break
+        f.seek(atom_end)
+    return None
+
+def mp4_data(f, end):
+    """Return the type and value of the first data atom from here
+    to end."""
+    data_end = find_mp4_atom(f, 'data', end)
+    if data_end is None:
+        return None, None
+    header = f.read(8)
+    return struct.unpack('>I', header[:4])[0] & 0xffffff, f.read(data_end - f.tell())
+
+def read_mp4(f):
+    end = find_mp4_atom(f, 'moov', None)
+    if end is None:
+        raise Unsupported('no moov atom')
+    # mutagen only looks for tags in moov.udta.meta.ilst
+    end = find_mp4_atom(f, 'udta', end)
+    if end is not None:
+        end = find_mp4_atom(f, 'meta', end)
+    if end is not None:
+        f.skip(4)
+        end = find_mp4_atom(f, 'ilst', end)
+    tags = {}
+    if end is None:
+        return tags
+    while f.tell() < end:
+        kind, item_end = mp4_atom(f)
+        if item_end is None:
+            raise Unsupported('bad ilst item')
+        if kind in mp4_text_atoms:
+            data_type, value = mp4_data(f, item_end)
+            if value is not None:
+                if data_type != 1:
+                    raise Unsupported('text of type %d' % data_type)
+                tags[mp4_text_atoms[kind]] = value.decode('utf-8', 'replace')
+        elif kind == '----':
+            names = []
+            for child in ('mean', 'name'):
+                child_end = find_mp4_atom(f, child, item_end)
+                if child_end is None:
+                    raise Unsupported('freeform atom without %s' % child)
+                names.append(f.read(child_end - f.tell())[4:])
+            name = mp4_freeform_atoms.get(':'.join(names))
+            if name:
+                value = mp4_data(f, item_end)[1]
+                if value is not None:
+                    tags[name] = value
+        f.seek(item_end)
+    return tags
+
+#------------------------------------------------------------------------------
+# APEv2 (mpc)
+
+ape_keys = {'artist': 'artistname',
+            'musicbrainz_artistid': 'artistid',
+            'album artist': 'albumartistname',
+            'musicbrainz_albumartistid': 'albumartistid',
+            'album': 'releasename',
+            'musicbrainz_albumid': 'releaseid',
+            'title': 'trackname',
+            'musicbrainz_trackid': 'trackid'}
+
+def read_ape(f):
+    """Read an APEv2 tag at the end of the file, which may be
+    followed by an ID3v1 tag."""
+    f.seek(0, 2)
+    footer_pos = f.tell() - 32
+    if footer_pos >= 128:
+        f.seek(-128, 2)
+        if f.read(3) == 'TAG':
+            footer_pos -= 128
+    if footer_pos < 0:
+        raise Unsupported('no APEv2 footer')
+    f.seek(footer_pos)
+    footer = f.read(32)
+    if footer[:8] != 'APETAGEX':
+        raise Unsupported('no APEv2 footer')
+    size, count = struct.unpack('<4xII', footer[8:20])
+    if not 32 <= size <= footer_pos + 32:
+        raise Unsupported('bad APEv2 tag size')
+    f.seek(footer_pos + 32 - size)
+    data = f.read(size - 32)
+    tags = {}
+    pos = 0
+    for i in xrange(count):
+        value_size = struct.unpack_from('<I', data, pos)[0]
+        key_end = data.index('\0', pos + 8)
+        name = ape_keys.get(data[pos + 8:key_end].lower())
+        pos = key_end + 1 + value_size
+        if name:
+            tags[name] = data[key_end + 1:pos]
+    return tags
+
+readers = {'mp3': read_id3,
+           'ogg': read_ogg_vorbis,
+           'flac': read_flac,
+           'm4a': read_mp4,
+           'mpc': read_ape}
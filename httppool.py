@@ -0,0 +1,158 @@
+"""Keeping HTTP connections open between requests.
+
+Each request that pylast makes, and each album art image that is
+downloaded, used to open a new connection, paying for a TCP handshake
+every time. fetch() instead takes a connection to the host from a
+ConnectionPool shared by all threads, makes the request over it with
+HTTP/1.1 keep-alive, and puts the connection back for the next request
+to the same host, unless the server closed it. A connection that the
+server has closed while it was idle is found out when it is next used,
+and the request is made again on a new one.
+
+A request is only made again when it failed in a way that shows that
+the server never received it: the connection was reset or closed
+before any of the response came back. A request that timed out, or
+whose response failed part way, may have been acted on by the server,
+so the error is raised instead."""
+
+import httplib, urlparse, threading, socket, errno
+import safefile
+
+# The errors of sending on, or reading from, a connection that the
+# server has closed
+closed_errnos = (errno.EPIPE, errno.ECONNRESET, errno.ECONNABORTED)
+# The line of the httplib.BadStatusLine raised when a connection is
+# closed before any of the response comes; older versions of httplib
+# give repr('')
+no_status_lines = (repr(''), 'No status line received - the server has closed the connection')
+
+def is_closed_connection(e):
+    """Is e, raised in sending a request over an idle connection or
+    reading the status line of its response, a sign that the server
+    had closed the connection, so that the request never reached
+    it?"""
+    if isinstance(e, httplib.BadStatusLine):
+        # The connection was closed before any of the response came
+        return e.line in no_status_lines
+    if isinstance(e, socket.timeout):
+        return False
+    return isinstance(e, socket.error) and e.errno in closed_errnos
+
+class Response(object):
+    """A response that has been read in full, so that its connection
+    can be used again."""
+    def __init__(self, response):
+        self.status = response.status
+        self.reason = response.reason
+        self.headers = dict(response.getheaders())
+        self.body = response.read()
+
+    def getheader(self, name, default=None):
+        return self.headers.get(name.lower(), default)
+
+    def read(self):
+        return self.body
+
+class ConnectionPool(object):
+    # Idle connections kept to each host
+    max_idle = 8
+    # Seconds to wait for a server
+    timeout = 30
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # Lists of idle connections, keyed by (scheme, host, port)
+        self.idle = {}
+        self.opened = self.requests = 0
+
+    def connection(self, key):
+        """Return an idle connection to the host of key, or a new one,
+        and whether it is new."""
+        with self.lock:
+            self.requests += 1
+            if self.idle.get(key):
+                return self.idle[key].pop(), False
+            self.opened += 1
+        scheme, host, port = key
+        if scheme == 'https':
+            return httplib.HTTPSConnection(host, port, timeout=self.timeout), True
+        return httplib.HTTPConnection(host, port, timeout=self.timeout), True
+
+    def release(self, key, conn):
+        with self.lock:
+            idle = self.idle.setdefault(key, [])
+            if len(idle) < self.max_idle:
+                idle.append(conn)
+                return
+        conn.close()
+
+    def request(self, method, url, body=None, headers={}, proxy=None):
+        """Make an HTTP request for url, through the (host, port) of an
+        HTTP proxy if one is given, and return its Response."""
+        parts = urlparse.urlsplit(url)
+        if proxy:
+            key = ('http', proxy[0], int(proxy[1]))
+            path = url
+        else:
+            key = (parts.scheme, parts.hostname,
+                   parts.port or (443 if parts.scheme == 'https' else 80))
+            path = parts.path or '/'
+            if parts.query:
+                path += '?' + parts.query
+        while True:
+            conn, new = self.connection(key)
+            try:
+                conn.request(method, path, body, headers)
+                raw = conn.getresponse()
+            except (httplib.HTTPException, socket.error), e:
+                conn.close()
+                if new or not is_closed_connection(e):
+                    raise
+                # The server closed the connection while it was idle
+                continue
+            try:
+                response = Response(raw)
+            except:
+                conn.close()
+                raise
+            if raw.will_close:
+                conn.close()
+            else:
+                self.release(key, conn)
+            return response
+
+    def close(self):
+        with self.lock:
+            for idle in self.idle.values():
+                for conn in idle:
+                    conn.close()
+            self.idle = {}
+
+pool = ConnectionPool()
+
+def fetch(url, method='GET', body=None, headers={}, proxy=None):
+    """Make a request with a connection from `pool', and return its
+    Response, whatever its status."""
+    return pool.request(method, url, body, headers, proxy)
+
+# Statuses whose Location header says where the resource is instead
+redirect_statuses = (301, 302, 303, 307)
+# Redirects followed before giving up
+max_redirects = 5
+
+def download(url, path):
+    """Save what is at url in the file at path, following redirects.
+    The file is written as by safefile.atomic_file(), so a download
+    that fails leaves no file behind."""
+    for hop in range(max_redirects + 1):
+        response = fetch(url)
+        location = response.getheader('location')
+        if response.status not in redirect_statuses or not location:
+            break
+        url = urlparse.urljoin(url, location)
+    else:
+        raise IOError('Failed to download %s: more than %d redirects' % (url, max_redirects))
+    if response.status != 200:
+        raise IOError('Failed to download %s: %d %s' % (url, response.status, response.reason))
+    with safefile.atomic_file(path) as f:
+        f.write(response.body)
@@ -0,0 +1,133 @@
+"""A cache of the data downloaded from last.fm, kept apart from any
+library.
+
+The similar artists, tags and biography of each artist are what take
+days of rate-limited last.fm queries to collect, so they are worth
+keeping independently of the library tree that they were collected
+for. The cache is an SQLite database keyed by dbm_artistid, which can
+be shared by several libraries, and by the GUI and the command line
+program, and copied between machines. A cache from elsewhere is added
+to one with merge(), which keeps the more recent data for an artist
+that both have.
+
+Only complete records are kept: an artist is in the cache only if
+its similar artists, tags and biography all are, as
+Root.restore_artist_lastfm_data() needs all three."""
+
+import sqlite3, json, threading
+
+schema = ['CREATE TABLE IF NOT EXISTS artists ' +
+          '(id TEXT PRIMARY KEY, name TEXT, lastfm_name TEXT, updated REAL)',
+          'CREATE TABLE IF NOT EXISTS similar_artists ' +
+          '(artist TEXT, rank INTEGER, mbid TEXT, name TEXT)',
+          'CREATE TABLE IF NOT EXISTS artist_tags (artist TEXT, rank INTEGER, tag TEXT)',
+          'CREATE TABLE IF NOT EXISTS biographies ' +
+          '(artist TEXT PRIMARY KEY, biography TEXT, metadata TEXT)',
+          'CREATE INDEX IF NOT EXISTS similar_artists_artist ON similar_artists (artist)',
+          'CREATE INDEX IF NOT EXISTS artist_tags_artist ON artist_tags (artist)']
+
+# Tables holding rows for each artist, and the column naming it
+artist_tables = [('artists', 'id'), ('similar_artists', 'artist'),
+                 ('artist_tags', 'artist'), ('biographies', 'artist')]
+
+class LastfmCache(object):
+    # Bytes of the database file to memory-map, where SQLite can
+    mmap_size = 256 * 1024 * 1024
+
+    def __init__(self, path):
+        """Open the cache at path, creating it if need be. The cache
+        may be used from any thread."""
+        self.path = path
+        self.lock = threading.RLock()
+        self.db = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self.db.execute('PRAGMA mmap_size = %d' % self.mmap_size)
+        with self.db:
+            for statement in schema:
+                self.db.execute(statement)
+
+    def close(self):
+        self.db.close()
+
+    def __contains__(self, aid):
+        with self.lock:
+            return self.db.execute('SELECT 1 FROM artists WHERE id = ?',
+                                   (aid,)).fetchone() is not None
+
+    def artistids(self):
+        with self.lock:
+            return set([aid for (aid,) in self.db.execute('SELECT id FROM artists')])
+
+    def get(self, aid):
+        """Return the (name, lastfm_name, similar artists, tag names,
+        biography, biography metadata, updated) of the artist with
+        dbm_artistid aid, or None if it is not in the cache. The similar
+        artists are (mbid, name) pairs and the metadata is a dict of
+        sets, as in a Root. updated is when the data was downloaded, or
+        None if that is not known."""
+        with self.lock:
+            row = self.db.execute('SELECT name, lastfm_name, updated FROM artists WHERE id = ?',
+                                  (aid,)).fetchone()
+            if row is None:
+                return None
+            similar = self.db.execute('SELECT mbid, name FROM similar_artists ' +
+                                      'WHERE artist = ? ORDER BY rank', (aid,)).fetchall()
+            tags = [tag for (tag,) in self.db.execute(
+                    'SELECT tag FROM artist_tags WHERE artist = ? ORDER BY rank', (aid,))]
+            biography, metadata = self.db.execute(
+                'SELECT biography, metadata FROM biographies WHERE artist = ?',
+                (aid,)).fetchone()
+        return (row[0], row[1] or '', map(tuple, similar), tags, biography or u'',
+                dict([(k, set(v)) for k, v in json.loads(metadata).items()]),
+                row[2] or None)
+
+    def put(self, records):
+        """Add or replace the artists in the list records, each of
+        which is an (id, name, lastfm_name, similar artists, tag
+        names, biography, biography metadata, updated) tuple, as
+        returned by get() but with the id first. An artist whose
+        updated is None is stored as downloaded before any other, so
+        that merge() replaces it with any download of the artist whose
+        time is known."""
+        with self.lock:
+            with self.db:
+                self.delete([r[0] for r in records])
+                self.db.executemany('INSERT INTO artists VALUES (?, ?, ?, ?)',
+                                    [(r[0], r[1], r[2], r[7] or 0) for r in records])
+                self.db.executemany('INSERT INTO similar_artists VALUES (?, ?, ?, ?)',
+                                    [(r[0], rank, mbid, name) for r in records
+                                     for rank, (mbid, name) in enumerate(r[3])])
+                self.db.executemany('INSERT INTO artist_tags VALUES (?, ?, ?)',
+                                    [(r[0], rank, tag) for r in records
+                                     for rank, tag in enumerate(r[4])])
+                self.db.executemany(
+                    'INSERT INTO biographies VALUES (?, ?, ?)',
+                    [(r[0], r[5], json.dumps(dict([(k, sorted(v)) for k, v in r[6].items()])))
+                     for r in records])
+
+    def delete(self, artistids):
+        for table, column in artist_tables:
+            self.db.executemany('DELETE FROM %s WHERE %s = ?' % (table, column),
+                                [(aid,) for aid in artistids])
+
+    def merge(self, path):
+        """Add the artists in the cache at path, replacing those that
+        were downloaded less recently here. Return the number of
+        artists added or replaced."""
+        with self.lock:
+            self.db.execute('ATTACH DATABASE ? AS other', (path,))
+            self.db.execute('CREATE TEMP TABLE merged (id TEXT PRIMARY KEY)')
+            try:
+                with self.db:
+                    self.db.execute('INSERT INTO merged SELECT o.id FROM other.artists o ' +
+                                    'LEFT JOIN main.artists a ON a.id = o.id ' +
+                                    'WHERE a.id IS NULL OR a.updated < o.updated')
+                    for table, column in artist_tables:
+                        self.db.execute('DELETE FROM main.%s WHERE %s IN (SELECT id FROM merged)' %
+                                        (table, column))
+                        self.db.execute('INSERT INTO main.%s SELECT * FROM other.%s ' % (table, table) +
+                                        'WHERE %s IN (SELECT id FROM merged)' % column)
+                    n = self.db.execute('SELECT COUNT(*) FROM merged').fetchone()[0]
+            finally:
+                self.db.execute('DROP TABLE merged')
+                self.db.execute('DETACH DATABASE other')
+        return n
@@ -0,0 +1,220 @@
+"""Talking to last.fm from several threads at once.
+
+Downloading the last.fm data of an artist takes several requests, each
+of which spends most of its time waiting for last.fm to answer, so
+fetch_all() makes the requests for many artists at once, in a pool of
+threads. last.fm asks that a client makes no more than five requests a
+second, so every request that pylast sends, from whichever thread,
+first takes a token from the one TokenBucket, `limiter'. throttle()
+puts it in the way of pylast's requests, behind a
+responsecache.ResponseCache that answers the requests that have been
+made before without asking last.fm at all. The requests that are sent
+go over kept-alive connections from httppool, rather than a new
+connection each.
+
+When last.fm answers that it is overloaded, or that the client is
+making too many requests, or the request fails to get an answer at
+all, the request is made again after an exponential backoff, during
+which `limiter' gives out no tokens to any thread. Such throttle
+events are counted in `stats'. pylast checks each response for
+last.fm's errors before it gets back to send(), raising a WSError
+that carries the error's code, so throttling is detected from these
+exceptions, never from the text of a response. Other errors, such as
+an unknown artist, are raised at once."""
+
+import time, threading, Queue, random, socket, httplib, urllib
+import httppool
+
+# Requests a second that last.fm allows
+max_rate = 5.0
+
+class TokenBucket(object):
+    """Lets calls to wait() through at an average of `rate' a second,
+    however many threads make them, allowing bursts of up to `burst'
+    calls after a quiet spell."""
+    def __init__(self, rate, burst=None):
+        self.lock = threading.Lock()
+        self.set_rate(rate, burst)
+        self.tokens = self.burst
+        self.updated = time.time()
+
+    def set_rate(self, rate, burst=None):
+        with self.lock:
+            self.rate = float(rate)
+            self.burst = burst or max(1.0, self.rate)
+
+    def wait(self):
+        with self.lock:
+            now = time.time()
+            if now > self.updated:
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+            # A token that is not there yet is taken in advance, and
+            # waited for outside the lock
+            self.tokens -= 1
+            delay = self.updated - now + max(0.0, -self.tokens) / self.rate
+        if delay > 0:
+            time.sleep(delay)
+
+    def pause(self, seconds):
+        """Give out no tokens for the next `seconds', and none saved
+        up before then."""
+        with self.lock:
+            self.updated = max(self.updated, time.time() + seconds)
+            self.tokens = min(self.tokens, 0.0)
+
+limiter = TokenBucket(max_rate)
+
+# Times a request is made again after a throttle event
+max_retries = 4
+
+# Seconds of the first backoff, which doubles with each retry, and of
+# the longest
+backoff_base = 1.0
+backoff_max = 60.0
+
+# The codes of last.fm errors that are worth waiting out: operation
+# failed, service offline, temporarily unavailable and rate limit
+# exceeded
+retry_error_codes = set(['8', '11', '16', '29'])
+
+def backoff_delay(attempt):
+    """Return the seconds to wait before retrying something that has
+    failed attempt + 1 times: exponentially longer each time, with
+    jitter so that threads that fail together do not retry
+    together."""
+    return min(backoff_max, backoff_base * 2 ** attempt) * random.uniform(0.5, 1.0)
+
+class Stats(object):
+    """Counts of what has happened to requests sent to last.fm."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = self.throttled = self.failed = 0
+        self.backoff = 0.0
+        # When the first and the latest requests were sent
+        self.first = self.latest = None
+
+    def add(self, **counts):
+        with self.lock:
+            for name, n in counts.items():
+                setattr(self, name, getattr(self, name) + n)
+            if 'requests' in counts:
+                self.latest = time.time()
+                self.first = self.first or self.latest
+
+    def report(self):
+        """Return lines of text saying how requests have fared."""
+        elapsed = self.first and self.latest - self.first
+        rate = elapsed and ' (%.1f a second)' % ((self.requests - 1) / elapsed) or ''
+        return ['last.fm requests: %d sent%s, %d throttled, %d failed after retrying, ' %
+                (self.requests, rate, self.throttled, self.failed) +
+                '%.1f s spent backing off' % self.backoff]
+
+stats = Stats()
+
+def is_retryable(e):
+    """Is the exception e, raised in sending a request, one that is
+    worth waiting out: a failure to get an answer, or one of the
+    last.fm errors in retry_error_codes?"""
+    if isinstance(e, (socket.error, httplib.HTTPException)):
+        return True
+    if hasattr(e, 'get_id'):
+        # pylast's WSError
+        return str(e.get_id()) in retry_error_codes
+    # pylast's NetworkError and MalformedResponseError wrap the error
+    # from the connection
+    return isinstance(getattr(e, 'underlying_error', None),
+                      (socket.error, httplib.HTTPException))
+
+def send(download_response, request):
+    """Send request with the function download_response, waiting for
+    `limiter' first and backing off and retrying while the request is
+    throttled."""
+    attempt = 0
+    while True:
+        limiter.wait()
+        stats.add(requests=1)
+        try:
+            return download_response(request)
+        except Exception, e:
+            if not is_retryable(e):
+                raise
+            if attempt == max_retries:
+                stats.add(failed=1)
+                raise
+        delay = backoff_delay(attempt)
+        stats.add(throttled=1, backoff=delay)
+        limiter.pause(delay)
+        attempt += 1
+
+headers = {'Content-type': 'application/x-www-form-urlencoded',
+           'Accept-Charset': 'utf-8',
+           'User-Agent': 'dbm (pylast)'}
+
+def encode(value):
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return str(value)
+
+def download_response(request):
+    """Do what pylast's _Request._download_response() does, but over
+    a kept-alive connection from httppool."""
+    network = request.network
+    host, path = network.ws_server
+    body = urllib.urlencode([(name, encode(value)) for name, value in request.params.items()])
+    proxy = network.is_proxy_enabled() and network._get_proxy() or None
+    response = httppool.fetch('http://' + host + path, 'POST', body, headers, proxy)
+    text = response.body.decode('utf-8')
+    request._check_response_for_errors(text)
+    return text
+
+# A function returning the ResponseCache that answers requests, or
+# None. It is called at each request, so that the cache can be opened
+# once the settings are known.
+open_response_cache = lambda: None
+
+def throttle(pylast, open_cache=None):
+    """Make the pylast module send its requests to last.fm with
+    download_response(), taking a token from `limiter' before each and
+    retrying throttled requests, and answer the requests that it can
+    from the ResponseCache returned by open_cache, if any. Requests
+    that are answered from a cache are not held up."""
+    global open_response_cache
+    if open_cache:
+        open_response_cache = open_cache
+    request = pylast._Request
+    if getattr(request, 'throttled', False):
+        return
+    def throttled_download_response(self):
+        cache = open_response_cache()
+        response = cache and cache.get(self.params)
+        if response is None:
+            response = send(download_response, self)
+            if cache:
+                cache.put(self.params, response)
+        return response
+    request._download_response = throttled_download_response
+    request.throttled = True
+
+def fetch_all(jobs, workers):
+    """Call each of the functions in the list jobs, in a pool of
+    `workers' threads, and return when they have all returned. The
+    jobs must deal with their own exceptions."""
+    queue = Queue.Queue()
+    for job in jobs:
+        queue.put(job)
+    def work():
+        while True:
+            try:
+                job = queue.get_nowait()
+            except Queue.Empty:
+                return
+            job()
+    threads = [threading.Thread(target=work) for i in range(min(workers, len(jobs)))]
+    for thread in threads:
+        thread.setDaemon(True)
+        thread.start()
+    for thread in threads:
+        # Joining with a timeout lets a KeyboardInterrupt through
+        while thread.isAlive():
+            thread.join(1)
@@ -0,0 +1,224 @@
+#!/usr/bin/env python
+"""A stand-in for the last.fm web service, for measuring how fast dbm
+downloads from it.
+
+The server answers the requests that dbm makes -- artist.getSimilar,
+artist.getInfo, artist.getTopTags, album.getInfo,
+user.getWeeklyChartList and user.getWeeklyArtistChart -- with the
+responses in fixtures/lastfm, one file for each method, in which
+$artist, $user and so on are replaced by the request's parameters.
+The images that album.getInfo names are served too. Given a
+responsecache.ResponseCache file made by running dbm against last.fm
+itself, it replays the responses recorded there instead, for the
+requests that were recorded.
+
+So that downloads can be measured as they would be from last.fm, the
+server can be made to answer each request only after a delay, to fail
+a fraction of requests with last.fm's 'Operation failed' error, and to
+refuse requests beyond a rate with last.fm's 'Rate limit exceeded'
+error. Point dbm at it with --lastfm-server, under which dbm does not
+save the library, so that what the server answers is not kept as the
+artists' last.fm data:
+
+    python lastfmstub.py --port 8080 --latency 0.2 --rate-limit 5
+    python dbm-cmdline.py --lastfm-server localhost:8080 ..."""
+
+from __future__ import with_statement
+import os, sys, time, random, string, threading, collections, urlparse, signal
+import BaseHTTPServer, SocketServer
+from xml.sax.saxutils import escape
+from cmdline.cmdline import CommandLineApp
+import responsecache
+
+fixtures_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures', 'lastfm')
+
+# A placeholder JPEG, served for every image
+image = ('\xff\xd8\xff\xe0\x00\x10JFIF\x00\x01\x01\x00\x00\x01\x00\x01\x00\x00'
+         '\xff\xdb\x00C\x00' + '\x01' * 64 +
+         '\xff\xc0\x00\x0b\x08\x00\x01\x00\x01\x01\x01\x11\x00'
+         '\xff\xc4\x00\x14\x00\x01' + '\x00' * 15 + '\x03'
+         '\xff\xc4\x00\x14\x10\x01' + '\x00' * 16 +
+         '\xff\xda\x00\x08\x01\x01\x00\x00\x3f\x00\x37\xff\xd9')
+
+error_template = ('<?xml version="1.0" encoding="utf-8"?>\n'
+                  '<lfm status="failed">\n<error code="%d">%s</error>\n</lfm>\n')
+
+def error_response(code, message):
+    return error_template % (code, message)
+
+class Fixtures(object):
+    def __init__(self, directory=fixtures_dir, replay=None):
+        """Serve the responses in the files method.xml in directory,
+        and those recorded in the ResponseCache file replay, if
+        given."""
+        self.templates = {}
+        for name in os.listdir(directory):
+            if name.endswith('.xml'):
+                with open(os.path.join(directory, name)) as f:
+                    self.templates[name[:-len('.xml')]] = string.Template(f.read().decode('utf-8'))
+        self.recorded = replay and responsecache.ResponseCache(replay)
+
+    def response(self, params, host):
+        """Return the response to a request with the dict params, or
+        None if its method is not known."""
+        if self.recorded:
+            recorded = self.recorded.recorded(params)
+            if recorded is not None:
+                return recorded
+        template = self.templates.get(params.get('method'))
+        if template is None:
+            return None
+        values = dict(artist=params.get('artist') or 'Artist %s' % params.get('mbid', ''),
+                      mbid=params.get('mbid', ''),
+                      album=params.get('album', ''),
+                      user=params.get('user', ''),
+                      image=str(abs(hash((params.get('artist'), params.get('album'))))))
+        values['from'] = params.get('from', '')
+        values['to'] = params.get('to', '')
+        values = dict([(k, escape(v)) for k, v in values.items()])
+        values['host'] = host
+        return template.safe_substitute(values)
+
+class Stats(object):
+    """Counts of the requests the server has answered."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.methods = collections.defaultdict(int)
+        self.images = self.failed = self.throttled = 0
+        self.started = time.time()
+        # The times of the requests made in the last second
+        self.recent = collections.deque()
+
+    def count(self, what):
+        with self.lock:
+            setattr(self, what, getattr(self, what) + 1)
+
+    def rate(self, now):
+        """Count a request made at now, and return the number made in
+        the second up to it."""
+        with self.lock:
+            self.recent.append(now)
+            while self.recent[0] <= now - 1:
+                self.recent.popleft()
+            return len(self.recent)
+
+    def report(self):
+        elapsed = time.time() - self.started
+        n = sum(self.methods.values())
+        lines = ['%d requests in %.1f s, %.1f a second; %d failed, %d throttled; %d images' %
+                 (n, elapsed, n / elapsed, self.failed, self.throttled, self.images)]
+        lines += ['\t%s\t%d' % item for item in sorted(self.methods.items())]
+        return lines
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Write each response in one piece, so that a client keeping the
+    # connection alive is not held up waiting for a delayed ACK
+    wbufsize = -1
+
+    def do_GET(self):
+        parts = urlparse.urlsplit(self.path)
+        if parts.path.startswith('/images/'):
+            self.server.stats.count('images')
+            self.reply(200, image, 'image/jpeg')
+        else:
+            self.answer(parts.query)
+
+    def do_POST(self):
+        self.answer(self.rfile.read(int(self.headers.get('content-length', 0))))
+
+    def answer(self, query):
+        server = self.server
+        params = dict([(k, v.decode('utf-8'))
+                       for k, v in urlparse.parse_qsl(query, keep_blank_values=True)])
+        if server.latency:
+            time.sleep(random.uniform(0.5, 1.5) * server.latency)
+        if server.rate_limit and server.stats.rate(time.time()) > server.rate_limit:
+            server.stats.count('throttled')
+            response = error_response(29, 'Rate limit exceeded')
+        elif random.random() < server.error_rate:
+            server.stats.count('failed')
+            response = error_response(8, 'Operation failed - Most likely the backend service failed. Please try again.')
+        else:
+            response = server.fixtures.response(params, self.headers.get('host', ''))
+            if response is None:
+                response = error_response(3, 'Invalid Method - No method with that name in this package')
+            else:
+                with server.stats.lock:
+                    server.stats.methods[params.get('method')] += 1
+        self.reply(200, response.encode('utf-8'), 'text/xml; charset=utf-8')
+
+    def reply(self, status, body, content_type):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = 64
+
+    def __init__(self, address, fixtures, latency=0, error_rate=0, rate_limit=None):
+        BaseHTTPServer.HTTPServer.__init__(self, address, Handler)
+        self.fixtures = fixtures
+        self.latency = latency
+        self.error_rate = error_rate
+        self.rate_limit = rate_limit
+        self.stats = Stats()
+
+class LastfmStub(CommandLineApp):
+    def __init__(self):
+        CommandLineApp.__init__(self)
+        op = self.option_parser
+        op.set_usage('usage: %prog [options]')
+
+        op.add_option('', '--port', dest='port', default=8080, type='int',
+                      help='Port to listen on, defaults to 8080.')
+
+        op.add_option('', '--host', dest='host', default='localhost', type='string',
+                      help="Address to listen on, defaults to 'localhost'.")
+
+        op.add_option('', '--latency', dest='latency', default=0.0, type='float',
+                      help='Average number of seconds to take to answer a request,' + \
+                          ' defaults to 0.')
+
+        op.add_option('', '--error-rate', dest='error_rate', default=0.0, type='float',
+                      help="Fraction of requests to fail with last.fm's 'Operation failed'" + \
+                          ' error, defaults to 0.')
+
+        op.add_option('', '--rate-limit', dest='rate_limit', default=None, type='float',
+                      help="Number of requests a second beyond which requests fail with" + \
+                          " last.fm's 'Rate limit exceeded' error. Unlimited by default.")
+
+        op.add_option('', '--fixtures', dest='fixtures', default=fixtures_dir, type='string',
+                      help='Folder of the responses to serve, defaults to fixtures/lastfm.')
+
+        op.add_option('', '--replay', dest='replay', default=None, type='string',
+                      help='Response cache file, such as ~/.dbm-responses, whose recorded' + \
+                          ' responses to serve in place of the fixtures.')
+
+    def main(self):
+        o = self.options
+        server = Server((o.host, o.port), Fixtures(o.fixtures, o.replay),
+                        o.latency, o.error_rate, o.rate_limit)
+        print('Serving last.fm at %s:%d' % (o.host, o.port))
+        sys.stdout.flush()
+        # Report when stopped by a benchmark script, too
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        try:
+            server.serve_forever()
+        finally:
+            for line in server.stats.report():
+                print(line)
+            sys.stdout.flush()
+
+    def handleInterrupt(self):
+        return 0
+
+if __name__ == '__main__':
+    LastfmStub().run()
@@ -0,0 +1,140 @@
+"""An on-disk cache of the responses to last.fm requests.
+
+Requests are keyed by their method and parameters, leaving out the API
+key, session key and signature, so the same request made by another
+run, or another library, is answered from the cache. Each response is
+kept for as long as its method's time to live in `ttls'; the weekly
+charts of weeks that are over never change, so they are kept until
+they are evicted. When the cache grows beyond max_size bytes, the
+responses that were used least recently are evicted. Only successful
+responses are stored."""
+
+import sqlite3, json, time, threading
+
+day = 24 * 60 * 60
+
+# Seconds for which a response to a method is used, keyed by method.
+# None means for ever.
+ttls = {'artist.getInfo': 30 * day,
+        'artist.getSimilar': 30 * day,
+        'artist.getTopTags': 30 * day,
+        'album.getInfo': 90 * day,
+        'user.getWeeklyChartList': day}
+default_ttl = day
+
+# Parameters that do not affect the response
+unkeyed_params = ['api_key', 'api_sig', 'sk']
+
+def request_key(params):
+    """Return the cache key of a request with the dict params, which
+    includes the method."""
+    return json.dumps(sorted([(k, v) for k, v in params.items()
+                              if k not in unkeyed_params]))
+
+def ttl(params, now):
+    """Return the time to live of the response to a request with the
+    dict params."""
+    method = params.get('method')
+    if method == 'user.getWeeklyArtistChart':
+        # A chart for a week that is over is final; without dates
+        # the chart is for the current week
+        try:
+            if float(params['to']) < now:
+                return None
+        except (KeyError, ValueError):
+            pass
+        return day
+    return ttls.get(method, default_ttl)
+
+class ResponseCache(object):
+    # Bytes of responses to keep
+    max_size = 100 * 1024 * 1024
+
+    def __init__(self, path):
+        """Open the cache at path, creating it if need be. The cache
+        may be used from any thread."""
+        self.path = path
+        self.lock = threading.RLock()
+        self.db = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        # Losing the last few responses in a crash does no harm
+        self.db.execute('PRAGMA synchronous = OFF')
+        with self.db:
+            self.db.execute('CREATE TABLE IF NOT EXISTS responses ' +
+                            '(key TEXT PRIMARY KEY, method TEXT, response TEXT, ' +
+                            'expires REAL, used REAL)')
+            self.db.execute('CREATE INDEX IF NOT EXISTS responses_used ON responses (used)')
+        self.size = self.db.execute('SELECT COALESCE(SUM(LENGTH(response)), 0) ' +
+                                    'FROM responses').fetchone()[0]
+        self.hits = self.misses = self.expired = self.evicted = 0
+
+    def close(self):
+        self.db.close()
+
+    def get(self, params):
+        """Return the cached response to a request with the dict
+        params, or None if there is none that has not expired."""
+        now = time.time()
+        key = request_key(params)
+        with self.lock:
+            row = self.db.execute('SELECT response, expires FROM responses WHERE key = ?',
+                                  (key,)).fetchone()
+            if row is not None and row[1] is not None and row[1] < now:
+                self.expired += 1
+                row = None
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            with self.db:
+                self.db.execute('UPDATE responses SET used = ? WHERE key = ?', (now, key))
+        return row[0]
+
+    def recorded(self, params):
+        """Return the response to a request with the dict params,
+        whether or not it has expired, or None if there is none. The
+        statistics are left as they are."""
+        with self.lock:
+            row = self.db.execute('SELECT response FROM responses WHERE key = ?',
+                                  (request_key(params),)).fetchone()
+        return row and row[0]
+
+    def put(self, params, response):
+        """Store the response to a request with the dict params, if it
+        is a successful one."""
+        if 'status="ok"' not in response:
+            return
+        now = time.time()
+        expiry = ttl(params, now)
+        key = request_key(params)
+        with self.lock:
+            with self.db:
+                old = self.db.execute('SELECT LENGTH(response) FROM responses WHERE key = ?',
+                                      (key,)).fetchone()
+                self.db.execute('INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?)',
+                                (key, params.get('method'), response,
+                                 expiry and now + expiry, now))
+                self.size += len(response) - (old[0] if old else 0)
+                if self.size > self.max_size:
+                    self.evict()
+
+    def evict(self):
+        """Delete the least recently used responses until the cache is
+        a tenth smaller than max_size."""
+        target = self.max_size * 0.9
+        rows = self.db.execute('SELECT key, LENGTH(response) FROM responses ORDER BY used')
+        keys = []
+        for key, length in rows:
+            if self.size <= target:
+                break
+            keys.append((key,))
+            self.size -= length
+        self.db.executemany('DELETE FROM responses WHERE key = ?', keys)
+        self.evicted += len(keys)
+
+    def report(self):
+        """Return lines of text saying how the cache has been used."""
+        requests = self.hits + self.misses
+        return ['last.fm response cache: %d requests, %d answered from the cache (%.0f%%), ' %
+                (requests, self.hits, 100.0 * self.hits / requests if requests else 0) +
+                '%d expired, %d responses evicted, %.1f MB cached' %
+                (self.expired, self.evicted, self.size / 1e6)]
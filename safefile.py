@@ -0,0 +1,100 @@
+"""Saving library files so that a crash cannot lose them.
+
+A library is written to a temporary file next to the file it replaces,
+which is flushed to disk and then renamed over it, so the file at the
+library's path is always either the old library or the new one, never
+a half-written one. The files that are replaced are kept as rotated
+generations: path.1 is the library as it was before the last save,
+path.2 as it was before the save before that, and so on. Any of them
+can be loaded in place of the library."""
+
+import os, sys, contextlib
+import cPickle as pickle
+
+def temp_path(path):
+    return path + '.tmp'
+
+def generation_path(path, n):
+    return '%s.%d' % (path, n)
+
+def remove(path):
+    if os.path.exists(path):
+        os.remove(path)
+
+def rename(src, dst):
+    """os.rename(), replacing dst on Windows too, where it cannot be
+    done atomically."""
+    if sys.platform == 'win32' and os.path.exists(dst):
+        os.remove(dst)
+    os.rename(src, dst)
+
+def sync_file(path):
+    with open(path, 'rb') as f:
+        os.fsync(f.fileno())
+
+def sync_directory(path):
+    """Flush the entries of the folder holding path to disk, so that
+    renames in it survive a crash. Folders cannot be opened on
+    Windows, which does without."""
+    try:
+        fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+def keep(path, kept):
+    """Make the file at path also available as kept. Where the
+    filesystem has hard links path is left in place; otherwise it is
+    renamed."""
+    remove(kept)
+    if hasattr(os, 'link'):
+        try:
+            os.link(path, kept)
+            return
+        except OSError:
+            # E.g. a FAT filesystem
+            pass
+    rename(path, kept)
+
+def replace(temp, path, generations=0):
+    """Rename the file at temp, which must have been flushed to disk,
+    over the file at path. Up to `generations' of the files that it
+    has replaced are kept, newest first, as path.1, path.2, ..."""
+    if generations > 0 and os.path.exists(path):
+        remove(generation_path(path, generations))
+        for n in range(generations - 1, 0, -1):
+            if os.path.exists(generation_path(path, n)):
+                rename(generation_path(path, n), generation_path(path, n + 1))
+        keep(path, generation_path(path, 1))
+    rename(temp, path)
+    sync_directory(path)
+
+@contextlib.contextmanager
+def atomic_file(path, generations=0):
+    """Open a temporary file for writing in place of the file at path
+    and yield it. If the with block completes, the file is flushed to
+    disk and renamed over path, as by replace(); otherwise it is
+    removed, and path is left as it was."""
+    temp = temp_path(path)
+    f = open(temp, 'wb')
+    try:
+        yield f
+        f.flush()
+        os.fsync(f.fileno())
+        f.close()
+        replace(temp, path, generations)
+    except:
+        f.close()
+        remove(temp)
+        raise
+
+def pickle_object(obj, path, generations=0):
+    """Pickle obj to the file at path, streaming it to the temporary
+    file rather than pickling it to a string first."""
+    with atomic_file(path, generations) as f:
+        pickle.dump(obj, f, pickle.HIGHEST_PROTOCOL)
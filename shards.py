@@ -0,0 +1,262 @@
+"""Saving a library in a compressed file of shards.
+
+A shard file holds the same records as a library store, but as
+compressed pickles, one for each part of the library:
+
+    tree         the folders of the tree and their tracks
+    artists      the artists
+    lastfm       the similar artists, tags and users downloaded from
+                 last.fm
+    biographies  the artists' biographies
+
+Each shard can be read without reading the others, so a shard that is
+not needed yet need not be read at all, and ShardedLibrary reads and
+decompresses the shards it is asked for in parallel. Shards are
+compressed with zlib, or with whichever of the other codecs in
+`codecs' they were saved with.
+
+The file starts with `magic'. The shards follow, one after another,
+and then a pickled dict giving the codec and the offset and length of
+each, keyed by name. The file ends with the offset of that dict.
+
+ShardedLibrary has the reading methods of store.LibraryStore that are
+needed to load a whole library, so dbm.load_library() makes the
+library's objects from either in the same way."""
+
+import os, struct, threading, Queue, zlib
+import cStringIO
+import cPickle as pickle
+import track
+import store
+import safefile
+
+magic = 'dbm-shards\n'
+
+format_version = 2
+
+shard_names = ['tree', 'artists', 'lastfm', 'biographies']
+
+# (compressor factory, decompress function), keyed by name
+codecs = {'zlib': (lambda: zlib.compressobj(6), zlib.decompress)}
+try:
+    import bz2
+    codecs['bz2'] = (lambda: bz2.BZ2Compressor(9), bz2.decompress)
+except ImportError:
+    pass
+try:
+    import lzma
+    codecs['lzma'] = (lzma.LZMACompressor, lzma.decompress)
+except ImportError:
+    pass
+
+# The codec that shards are saved with
+compression = 'zlib'
+
+offset_struct = struct.Struct('>Q')
+
+def is_shard_file(path):
+    """Is the file at path a shard file?"""
+    try:
+        with open(path, 'rb') as f:
+            return f.read(len(magic)) == magic
+    except IOError:
+        return False
+
+#------------------------------------------------------------------------------
+# Writing
+
+class CompressedWriter(object):
+    """A file-like object that compresses what is written to it into
+    file f, so that a shard is never held in memory whole."""
+    def __init__(self, f, codec):
+        self.f = f
+        self.compressor = codecs[codec][0]()
+
+    def write(self, data):
+        self.f.write(self.compressor.compress(data))
+
+    def close(self):
+        self.f.write(self.compressor.flush())
+
+def save_shards(root, path, generations=0):
+    """Save the library at root to a shard file at path, replacing
+    it as safefile.atomic_file() does."""
+    # A library loaded lazily must be read in full first
+    root.materialise()
+    with safefile.atomic_file(path, generations) as f:
+        f.write(magic)
+        index = {}
+        for name, records in [('tree', tree_records(root)),
+                              ('artists', artist_records(root)),
+                              ('lastfm', lastfm_records(root)),
+                              ('biographies', biography_records(root))]:
+            start = f.tell()
+            writer = CompressedWriter(f, compression)
+            pickler = pickle.Pickler(writer, pickle.HIGHEST_PROTOCOL)
+            for record in records:
+                pickler.dump(record)
+                pickler.clear_memo()
+            writer.close()
+            index[name] = (compression, start, f.tell() - start)
+        end = f.tell()
+        pickle.dump(dict(version=format_version, shards=index), f, pickle.HIGHEST_PROTOCOL)
+        f.write(offset_struct.pack(end))
+
+# Each shard is a sequence of pickled records; the first is a dict of
+# things that are not repeated.
+
+def tree_records(root):
+    """Yield a record of the (id, parent id, path, mtime, track rows,
+    untagged paths) of each folder, parents first, as
+    LibraryStore.save_tree() saves them."""
+    yield dict(path=root.path)
+    ids = {}
+    stack = [root]
+    while stack:
+        node = stack.pop()
+        ids[node.path] = i = len(ids) + 1
+        yield (i, node.parent and ids[node.parent.path], node.path, node.mtime,
+               [row[1:] for row in store.track_rows(i, node)], list(node.untagged))
+        stack.extend(node.subtrees)
+
+def artist_records(root):
+    """Yield the (id, name, lastfm_name, in_library) of each artist
+    in the library, or with last.fm data or a biography."""
+    yield {}
+    for aid in set(root.artists) | set(root.biographies) | \
+            set(root.similar_artists) | set(root.tags_by_artist):
+        artist = root.artists.get(aid)
+        if artist is None and aid in root.biographies:
+            artist = root.biographies[aid].artist
+        yield (aid, artist and artist.name, artist and artist.lastfm_name, aid in root.artists)
+
+def lastfm_records(root):
+    yield dict(dirty_artistids=set(root.dirty_artistids),
+               biography_ids=set(root.biographies))
+    yield root.similar_artists
+    yield dict([(aid, [tag.name for tag in tags])
+                for aid, tags in root.tags_by_artist.iteritems()])
+    yield dict([(user.name, [(artist.id, artist.name, count)
+                             for artist, count in user.artist_counts.iteritems()])
+                for user in root.lastfm_users.values()])
+
+def biography_records(root):
+    yield {}
+    for aid, bio in root.biographies.iteritems():
+        yield (aid, bio.biography, bio.metadata, bio.downloaded)
+
+#------------------------------------------------------------------------------
+# Reading
+
+class ShardedLibrary(object):
+    def __init__(self, path, names=shard_names):
+        """Read the shards in the list names from the shard file at
+        path. The rest can be read later with read()."""
+        self.path = path
+        self.lock = threading.RLock()
+        with open(path, 'rb') as f:
+            if f.read(len(magic)) != magic:
+                raise ValueError('%s is not a shard file' % path)
+            f.seek(-offset_struct.size, os.SEEK_END)
+            f.seek(offset_struct.unpack(f.read(offset_struct.size))[0])
+            header = pickle.load(f)
+        if header['version'] > format_version:
+            raise ValueError('%s was saved by a later version of dbm' % path)
+        self.index = header['shards']
+        # Lists of the records of the shards that have been read,
+        # keyed by name
+        self.shards = {}
+        self.read(names)
+
+    def read(self, names):
+        """Read the shards in the list names that have not been read
+        yet. They are decompressed in parallel threads, each of which
+        has its own file handle, and unpickled as each is ready."""
+        with self.lock:
+            names = [name for name in names if name not in self.shards]
+            done = Queue.Queue()
+            for name in names:
+                threading.Thread(target=self.decompress, args=(name, done)).start()
+            for n in range(len(names)):
+                name, data = done.get()
+                if isinstance(data, Exception):
+                    raise data
+                self.shards[name] = self.unpickle(data)
+
+    def decompress(self, name, done):
+        try:
+            codec, start, length = self.index[name]
+            with open(self.path, 'rb') as f:
+                f.seek(start)
+                done.put((name, codecs[codec][1](f.read(length))))
+        except Exception, e:
+            done.put((name, e))
+
+    def unpickle(self, data):
+        unpickler = pickle.Unpickler(cStringIO.StringIO(data))
+        records = []
+        while True:
+            try:
+                records.append(unpickler.load())
+            except EOFError:
+                return records
+
+    def shard(self, name):
+        if name not in self.shards:
+            self.read([name])
+        return self.shards[name]
+
+    def forget(self, name):
+        """Free the records of a shard that has been used."""
+        self.shards.pop(name, None)
+
+    # The reading methods of LibraryStore
+
+    def meta(self, key):
+        if key == 'path':
+            return self.shard('tree')[0]['path']
+        return None
+
+    def dirty_artistids(self):
+        return self.shard('lastfm')[0]['dirty_artistids']
+
+    def biography_ids(self):
+        """Return the set of ids of the artists that have biographies,
+        without reading the biographies shard."""
+        return self.shard('lastfm')[0]['biography_ids']
+
+    def nodes(self):
+        return [record[:4] for record in self.shard('tree')[1:]]
+
+    def tracks(self, node=None):
+        for record in self.shard('tree')[1:]:
+            if node is None or record[0] == node:
+                for row in record[4]:
+                    t = track.Track()
+                    t.__setstate__(dict(zip(store.track_columns, row)))
+                    t.reset_artists()
+                    t.valid = True
+                    yield record[0], t
+
+    def untagged(self, node=None):
+        return [(record[0], path) for record in self.shard('tree')[1:]
+                if node is None or record[0] == node
+                for path in record[5]]
+
+    def artists(self):
+        return self.shard('artists')[1:]
+
+    def similar_artists(self):
+        return self.shard('lastfm')[1]
+
+    def artist_tags(self):
+        return self.shard('lastfm')[2]
+
+    def users(self):
+        return self.shard('lastfm')[3]
+
+    def biographies(self):
+        # Files of version 1, from before download times were
+        # recorded, have none
+        return [r if len(r) == 4 else r + (None,)
+                for r in self.shard('biographies')[1:]]
@@ -0,0 +1,470 @@
+"""Saving a library in an SQLite database.
+
+A library store has a table for each kind of thing in a library:
+the folders of the tree and their tracks, the artists, and the data
+downloaded from last.fm (similar artists, tags, biographies and
+last.fm users). Unlike a pickled library, it contains none of the
+things that are derived from the tree when a library is prepared,
+and none of the GUI's leftovers.
+
+LibraryStore only reads and writes rows. dbm.load_library() makes the
+library's objects from them.
+
+A store is only changed in place by an incremental save, which is a
+single SQLite transaction and so survives a crash. A full save is
+written to a new store, which then replaces the old one: see
+create_library_store()."""
+
+import sqlite3, json, uuid
+import track
+import safefile
+
+# The first bytes of every SQLite database file
+sqlite_header = 'SQLite format 3\0'
+
+format_version = 2
+
+schema = ['CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value)',
+          # Folders, in an order in which parents come before their
+          # children; the root has no parent.
+          'CREATE TABLE IF NOT EXISTS nodes ' +
+          '(id INTEGER PRIMARY KEY, parent INTEGER, path TEXT, mtime REAL)',
+          'CREATE TABLE IF NOT EXISTS tracks ' +
+          '(node INTEGER, path TEXT, size INTEGER, mtime REAL, format TEXT, %s)' %
+          ', '.join(['%s TEXT' % k for k in track.tag_names]),
+          'CREATE TABLE IF NOT EXISTS untagged (node INTEGER, path TEXT)',
+          # The artists in the library, and those that the last.fm
+          # data is stored for. has_similar and has_tags say whether
+          # they have entries in root.similar_artists and
+          # root.tags_by_artist, which may be empty lists.
+          'CREATE TABLE IF NOT EXISTS artists ' +
+          '(id TEXT PRIMARY KEY, name TEXT, lastfm_name TEXT, in_library INTEGER, ' +
+          'has_similar INTEGER, has_tags INTEGER)',
+          'CREATE TABLE IF NOT EXISTS similar_artists ' +
+          '(artist TEXT, rank INTEGER, mbid TEXT, name TEXT)',
+          'CREATE TABLE IF NOT EXISTS artist_tags (artist TEXT, rank INTEGER, tag TEXT)',
+          # downloaded is when the artist's last.fm data was
+          # downloaded, if that is known
+          'CREATE TABLE IF NOT EXISTS biographies ' +
+          '(artist TEXT PRIMARY KEY, biography TEXT, metadata TEXT, downloaded REAL)',
+          'CREATE TABLE IF NOT EXISTS users (name TEXT PRIMARY KEY)',
+          'CREATE TABLE IF NOT EXISTS user_artists ' +
+          '(user TEXT, artist TEXT, name TEXT, count INTEGER)',
+          # The index of a prepared library, from which it can be
+          # loaded without reading the tracks: root.artistids,
+          # root.artistnames, the dbm_artistids of each folder and the
+          # ArtistNodes of each artist in the library.
+          'CREATE TABLE IF NOT EXISTS artist_mbids (name TEXT PRIMARY KEY, mbid TEXT)',
+          'CREATE TABLE IF NOT EXISTS artist_names (artist TEXT, name TEXT, count INTEGER)',
+          'CREATE TABLE IF NOT EXISTS node_artists (node INTEGER, artist TEXT, count INTEGER)',
+          'CREATE TABLE IF NOT EXISTS artist_folders ' +
+          '(artist TEXT, node INTEGER, albumartist TEXT, album TEXT)']
+
+indexes = ['CREATE INDEX IF NOT EXISTS nodes_path ON nodes (path)',
+           'CREATE INDEX IF NOT EXISTS nodes_parent ON nodes (parent)',
+           'CREATE INDEX IF NOT EXISTS tracks_node ON tracks (node)',
+           'CREATE INDEX IF NOT EXISTS untagged_node ON untagged (node)',
+           'CREATE INDEX IF NOT EXISTS similar_artists_artist ON similar_artists (artist)',
+           'CREATE INDEX IF NOT EXISTS artist_tags_artist ON artist_tags (artist)',
+           'CREATE INDEX IF NOT EXISTS user_artists_user ON user_artists (user)',
+           'CREATE INDEX IF NOT EXISTS node_artists_node ON node_artists (node)',
+           'CREATE INDEX IF NOT EXISTS artist_folders_artist ON artist_folders (artist)']
+
+track_columns = ['path', 'size', 'mtime', 'format'] + track.tag_names
+
+def track_rows(node_id, node):
+    return [[node_id] + [getattr(t, k, None) for k in track_columns] for t in node.tracks]
+
+def node_artist_rows(node_id, node):
+    return [(node_id, aid, n) for aid, n in node.dbm_artistids.iteritems()]
+
+class Changes(object):
+    """What has changed in a library since it was saved to, or
+    loaded from, the library store whose contents had the given
+    token: the folders that have been added or modified, as nodes
+    keyed by path, and the paths of those that have been removed,
+    keyed to None; the ids of artists whose names, folders or last.fm
+    data have changed; and the names of last.fm users that have been
+    added."""
+    def __init__(self, token=None):
+        self.token = token
+        self.folders = {}
+        self.artistids = set([])
+        self.users = set([])
+
+    def update(self, other):
+        self.folders.update(other.folders)
+        self.artistids.update(other.artistids)
+        self.users.update(other.users)
+
+def is_library_store(path):
+    """Is the file at path a library store, rather than a pickle?"""
+    try:
+        with open(path, 'rb') as f:
+            return f.read(len(sqlite_header)) == sqlite_header
+    except IOError:
+        return False
+
+def library_token(path):
+    """Return the token of the library store at path, or None if
+    there is none there."""
+    if not is_library_store(path):
+        return None
+    library = LibraryStore(path)
+    try:
+        return library.meta('token')
+    finally:
+        library.close()
+
+def create_library_store(root, path):
+    """Save the library at root in full to a new library store at
+    path, replacing anything there, and return its token. The store
+    has been flushed to disk when this returns, so it can be renamed
+    into place with safefile.replace(); if saving fails, it is
+    removed."""
+    for f in [path, path + '-journal']:
+        safefile.remove(f)
+    library = LibraryStore(path)
+    try:
+        token = library.save(root)
+        library.close()
+        safefile.sync_file(path)
+    except:
+        library.close()
+        safefile.remove(path)
+        raise
+    return token
+
+class LibraryStore(object):
+    def __init__(self, path, check_same_thread=True):
+        self.path = path
+        self.db = sqlite3.connect(path, check_same_thread=check_same_thread)
+        # Every commit reaches the disk before the save returns
+        self.db.execute('PRAGMA synchronous = FULL')
+        for statement in schema + indexes:
+            self.db.execute(statement)
+        columns = [row[1] for row in self.db.execute('PRAGMA table_info(biographies)')]
+        if 'downloaded' not in columns:
+            # A store of version 1, from before download times were
+            # recorded
+            self.db.execute('ALTER TABLE biographies ADD COLUMN downloaded REAL')
+
+    def close(self):
+        self.db.close()
+
+    #--------------------------------------------------------------------------
+    # Writing
+
+    def save(self, root, changes=None):
+        """Save the library at root and return the token that now
+        identifies the store's contents. If changes is given, it is a
+        Changes saying what has changed in the library since it was
+        saved to, or loaded from, the store with the token
+        changes.token, and if the store still has that token only
+        those records are written. Otherwise everything is. The store
+        is changed in a single transaction, so a failed save leaves
+        the library as it was."""
+        token = uuid.uuid4().hex
+        with self.db:
+            if changes is not None and changes.token is not None and \
+                    changes.token == self.meta('token'):
+                self.save_folders(changes.folders)
+                if changes.folders:
+                    self.save_artist_names(root)
+                self.delete_artists(changes.artistids)
+                self.save_artists(root, changes.artistids)
+                self.delete_users(changes.users)
+                self.save_users(root, changes.users)
+            else:
+                for table in ['nodes', 'tracks', 'untagged', 'artists',
+                              'similar_artists', 'artist_tags', 'biographies',
+                              'users', 'user_artists', 'artist_mbids', 'artist_names',
+                              'node_artists', 'artist_folders']:
+                    self.db.execute('DELETE FROM %s' % table)
+                # A library loaded lazily must be read in full first
+                root.materialise()
+                ids = self.save_tree(root)
+                self.save_artist_names(root)
+                self.save_artists(root, set(root.artists) | set(root.biographies) |
+                                  set(root.similar_artists) | set(root.tags_by_artist), ids)
+                self.save_users(root, root.lastfm_users)
+            self.db.execute('DELETE FROM meta')
+            self.db.executemany('INSERT INTO meta VALUES (?, ?)', [
+                    ('version', format_version),
+                    ('indexed', 1),
+                    ('token', token),
+                    ('path', root.path),
+                    ('dirty_artistids', json.dumps(sorted(root.dirty_artistids)))])
+        return token
+
+    def save_tree(self, root):
+        """Insert the rows of every folder and return their ids, keyed
+        by path."""
+        ids = {}
+        nodes, tracks, untagged, artists = [], [], [], []
+        def add_node(node):
+            ids[node.path] = i = len(ids) + 1
+            nodes.append((i, node.parent and ids[node.parent.path], node.path, node.mtime))
+            tracks.extend(track_rows(i, node))
+            untagged.extend([(i, path) for path in node.untagged])
+            artists.extend(node_artist_rows(i, node))
+        root.walk(add_node)
+        self.db.executemany('INSERT INTO nodes VALUES (?, ?, ?, ?)', nodes)
+        self.insert_tracks(tracks, untagged, artists)
+        return ids
+
+    def insert_tracks(self, tracks, untagged, artists):
+        self.db.executemany('INSERT INTO tracks VALUES (%s)' %
+                            ', '.join(['?'] * (len(track_columns) + 1)), tracks)
+        self.db.executemany('INSERT INTO untagged VALUES (?, ?)', untagged)
+        self.db.executemany('INSERT INTO node_artists VALUES (?, ?, ?)', artists)
+
+    def save_artist_names(self, root):
+        """Replace root.artistids and root.artistnames, which change
+        whenever the tracks do."""
+        self.db.execute('DELETE FROM artist_mbids')
+        self.db.execute('DELETE FROM artist_names')
+        self.db.executemany('INSERT INTO artist_mbids VALUES (?, ?)', root.artistids.iteritems())
+        # An artist with no names has a row with a null name
+        self.db.executemany('INSERT INTO artist_names VALUES (?, ?, ?)',
+                            [(aid, name, count)
+                             for aid, names in root.artistnames.iteritems()
+                             for name, count in names.items() or [(None, 0)]])
+
+    def save_folders(self, folders):
+        """Bring the rows of the folders in the dict folders, as
+        Changes.folders, up to date. A folder that has gone from the
+        tree is deleted, with everything below it."""
+        # Parents sort before their children, so a new folder's
+        # parent already has a row.
+        for path, node in sorted(folders.items()):
+            i = self.node_id(path)
+            if node is None:
+                if i is not None:
+                    self.delete_nodes(i)
+                continue
+            parent = self.node_id(node.parent.path) if node.parent else None
+            if i is None:
+                i = self.db.execute('INSERT INTO nodes (parent, path, mtime) VALUES (?, ?, ?)',
+                                    (parent, node.path, node.mtime)).lastrowid
+            else:
+                self.db.execute('UPDATE nodes SET parent = ?, mtime = ? WHERE id = ?',
+                                (parent, node.mtime, i))
+                for table in ['tracks', 'untagged', 'node_artists']:
+                    self.db.execute('DELETE FROM %s WHERE node = ?' % table, (i,))
+                subtrees = set([subtree.path for subtree in node.subtrees])
+                for child, child_path in self.db.execute(
+                    'SELECT id, path FROM nodes WHERE parent = ?', (i,)).fetchall():
+                    if child_path not in subtrees:
+                        self.delete_nodes(child)
+            self.insert_tracks(track_rows(i, node), [(i, p) for p in node.untagged],
+                               node_artist_rows(i, node))
+
+    def node_id(self, path):
+        row = self.db.execute('SELECT id FROM nodes WHERE path = ?', (path,)).fetchone()
+        return row[0] if row else None
+
+    def delete_nodes(self, i):
+        """Delete the folder with id i and all the folders below it."""
+        ids = [i]
+        for i in ids:
+            ids.extend([row[0] for row in self.db.execute(
+                        'SELECT id FROM nodes WHERE parent = ?', (i,))])
+        for table, column in [('nodes', 'id'), ('tracks', 'node'), ('untagged', 'node'),
+                              ('node_artists', 'node')]:
+            self.db.executemany('DELETE FROM %s WHERE %s = ?' % (table, column),
+                                [(i,) for i in ids])
+
+    def delete_artists(self, artistids):
+        for table, column in [('artists', 'id'), ('similar_artists', 'artist'),
+                              ('artist_tags', 'artist'), ('biographies', 'artist'),
+                              ('artist_folders', 'artist')]:
+            self.db.executemany('DELETE FROM %s WHERE %s = ?' % (table, column),
+                                [(aid,) for aid in artistids])
+
+    def save_artists(self, root, artistids, ids=None):
+        """Insert the rows of the artists in artistids that are in the
+        library, or that have last.fm data stored. ids is a dict of
+        the ids of folders, keyed by path, if the caller has one."""
+        artists, similar, tags, biographies, folders = [], [], [], [], []
+        ids = ids or {}
+        for aid in artistids:
+            artist = root.artists.get(aid)
+            bio = root.biographies.get(aid)
+            if artist is None and bio is not None:
+                artist = bio.artist
+            has_similar = aid in root.similar_artists
+            has_tags = aid in root.tags_by_artist
+            if artist is None and not (has_similar or has_tags):
+                continue
+            artists.append((aid, artist and artist.name, artist and artist.lastfm_name,
+                            aid in root.artists, has_similar, has_tags))
+            if has_similar:
+                similar.extend([(aid, rank, mbid, name) for rank, (mbid, name)
+                                in enumerate(root.similar_artists[aid])])
+            if has_tags:
+                tags.extend([(aid, rank, tag.name) for rank, tag
+                             in enumerate(root.tags_by_artist[aid])])
+            if aid in root.artists:
+                for anode in artist.subtrees:
+                    path = anode.node.path
+                    if path not in ids:
+                        ids[path] = self.node_id(path)
+                    folders.append((aid, ids[path], anode.albumartist and anode.albumartist.id,
+                                    anode.album))
+            if bio is not None:
+                biographies.append(
+                    (aid, bio.biography,
+                     json.dumps(dict([(k, sorted(v)) for k, v in bio.metadata.items()])),
+                     bio.downloaded))
+        self.db.executemany('INSERT INTO artists VALUES (?, ?, ?, ?, ?, ?)', artists)
+        self.db.executemany('INSERT INTO similar_artists VALUES (?, ?, ?, ?)', similar)
+        self.db.executemany('INSERT INTO artist_tags VALUES (?, ?, ?)', tags)
+        self.db.executemany('INSERT INTO biographies VALUES (?, ?, ?, ?)', biographies)
+        self.db.executemany('INSERT INTO artist_folders VALUES (?, ?, ?, ?)', folders)
+
+    def delete_users(self, names):
+        for table, column in [('users', 'name'), ('user_artists', 'user')]:
+            self.db.executemany('DELETE FROM %s WHERE %s = ?' % (table, column),
+                                [(name,) for name in names])
+
+    def save_users(self, root, names):
+        users = [root.lastfm_users[name] for name in names if name in root.lastfm_users]
+        self.db.executemany('INSERT INTO users VALUES (?)', [(user.name,) for user in users])
+        self.db.executemany(
+            'INSERT INTO user_artists VALUES (?, ?, ?, ?)',
+            [(user.name, artist.id, artist.name, count)
+             for user in users for artist, count in user.artist_counts.iteritems()])
+
+    #--------------------------------------------------------------------------
+    # Reading
+
+    def meta(self, key):
+        row = self.db.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else None
+
+    def dirty_artistids(self):
+        return set(json.loads(self.meta('dirty_artistids') or '[]'))
+
+    def nodes(self):
+        """Return a list of the (id, parent id, path, mtime) of each
+        folder, parents first."""
+        return self.db.execute('SELECT id, parent, path, mtime FROM nodes ORDER BY id').fetchall()
+
+    def root_node(self):
+        """Return the (id, parent id, path, mtime) of the root folder."""
+        row = self.db.execute('SELECT id, parent, path, mtime FROM nodes ' +
+                              'WHERE parent IS NULL').fetchone()
+        if row is None:
+            raise ValueError('%s holds no library' % self.path)
+        return row
+
+    def node(self, i):
+        """Return the (id, parent id, path, mtime) of a folder."""
+        return self.db.execute('SELECT id, parent, path, mtime FROM nodes WHERE id = ?',
+                               (i,)).fetchone()
+
+    def children(self, i):
+        """Return a list of the (id, parent id, path, mtime) of the
+        sub-folders of a folder."""
+        return self.db.execute('SELECT id, parent, path, mtime FROM nodes ' +
+                               'WHERE parent = ? ORDER BY id', (i,)).fetchall()
+
+    def tracks(self, node=None):
+        """Yield (node id, Track) pairs, in the order in which the
+        tracks were saved, for every folder or only for the folder
+        with id node."""
+        query = 'SELECT node, %s FROM tracks' % ', '.join(track_columns)
+        rows = self.db.execute(query + ' ORDER BY rowid') if node is None else \
+            self.db.execute(query + ' WHERE node = ? ORDER BY rowid', (node,)).fetchall()
+        for row in rows:
+            t = track.Track()
+            t.__setstate__(dict(zip(track_columns, row[1:])))
+            t.reset_artists()
+            t.valid = True
+            yield row[0], t
+
+    def untagged(self, node=None):
+        if node is None:
+            return self.db.execute('SELECT node, path FROM untagged ORDER BY rowid').fetchall()
+        return self.db.execute('SELECT node, path FROM untagged WHERE node = ? ORDER BY rowid',
+                               (node,)).fetchall()
+
+    def node_artists(self, nodes=None):
+        """Return a dict, keyed by folder id, of the folders'
+        dbm_artistids, for every folder or for those in the list
+        nodes."""
+        if nodes is None:
+            rows = self.db.execute('SELECT node, artist, count FROM node_artists')
+        else:
+            rows = []
+            for i in nodes:
+                rows.extend(self.db.execute('SELECT node, artist, count FROM node_artists ' +
+                                            'WHERE node = ?', (i,)).fetchall())
+        counts = {}
+        for i, aid, n in rows:
+            counts.setdefault(i, {})[aid] = n
+        return counts
+
+    def artist_mbids(self):
+        """Return root.artistids as it was saved."""
+        return dict(self.db.execute('SELECT name, mbid FROM artist_mbids').fetchall())
+
+    def artist_names(self):
+        """Return root.artistnames as it was saved."""
+        names = {}
+        for aid, name, count in self.db.execute('SELECT artist, name, count FROM artist_names'):
+            names.setdefault(aid, {})
+            if name is not None:
+                names[aid][name] = count
+        return names
+
+    def artist_folders(self):
+        """Return a list of the (artist id, folder id, album artist
+        id, album) of each ArtistNode."""
+        return self.db.execute(
+            'SELECT artist, node, albumartist, album FROM artist_folders').fetchall()
+
+    def artists(self):
+        """Return a list of the (id, name, lastfm_name, in_library)
+        of each artist."""
+        return self.db.execute(
+            'SELECT id, name, lastfm_name, in_library FROM artists').fetchall()
+
+    def similar_artists(self):
+        """Return a dict of lists of (mbid, name) pairs, keyed by
+        artist id, as root.similar_artists."""
+        similar = dict([(aid, []) for (aid,) in self.db.execute(
+                    'SELECT id FROM artists WHERE has_similar')])
+        for aid, mbid, name in self.db.execute(
+            'SELECT artist, mbid, name FROM similar_artists ORDER BY artist, rank'):
+            similar[aid].append((mbid, name))
+        return similar
+
+    def artist_tags(self):
+        """Return a dict of lists of tag names, keyed by artist id."""
+        tags = dict([(aid, []) for (aid,) in self.db.execute(
+                    'SELECT id FROM artists WHERE has_tags')])
+        for aid, tag in self.db.execute(
+            'SELECT artist, tag FROM artist_tags ORDER BY artist, rank'):
+            tags[aid].append(tag)
+        return tags
+
+    def biographies(self):
+        """Return a list of (artist id, biography, metadata, download
+        time), where metadata is a dict of sets and the download time
+        is None if it is not known."""
+        return [(aid, biography or u'',
+                 dict([(k, set(v)) for k, v in json.loads(metadata).items()]), downloaded)
+                for aid, biography, metadata, downloaded in self.db.execute(
+                'SELECT artist, biography, metadata, downloaded FROM biographies')]
+
+    def users(self):
+        """Return a dict, keyed by user name, of lists of the
+        (artist id, artist name, count) of the artists they have
+        listened to."""
+        users = dict([(name, []) for (name,) in self.db.execute('SELECT name FROM users')])
+        for name, aid, aname, count in self.db.execute(
+            'SELECT user, artist, name, count FROM user_artists'):
+            users[name].append((aid, aname, count))
+        return users
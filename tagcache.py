@@ -0,0 +1,52 @@
+"""An on-disk cache of the tags of music files.
+
+The cache is an SQLite database keyed by file path. An entry is only
+used if the file still has the size and modification time that it had
+when its tags were read, so a scan of a library whose files are in the
+cache does not have to open any of them. The same cache file can be
+used by the GUI and by the command line program."""
+
+import sqlite3
+import track
+
+class TagCache(object):
+    # Number of new entries to accumulate before committing
+    commit_interval = 1000
+
+    def __init__(self, path):
+        self.path = path
+        self.db = sqlite3.connect(path, timeout=60)
+        # Losing the last few entries in a crash does no harm
+        self.db.execute('PRAGMA synchronous = OFF')
+        self.db.execute('CREATE TABLE IF NOT EXISTS tags ' +
+                        '(path TEXT PRIMARY KEY, size INTEGER, mtime REAL, %s)' %
+                        ', '.join(['%s TEXT' % k for k in track.tag_names]))
+        self.uncommitted = 0
+
+    def get(self, path, size, mtime):
+        """Return dict of the cached tags for the file at `path', or
+        None if it is not in the cache or has changed since."""
+        row = self.db.execute('SELECT %s FROM tags WHERE path = ? AND size = ? AND mtime = ?' %
+                              ', '.join(track.tag_names),
+                              (path, size, mtime)).fetchone()
+        if row is None:
+            return None
+        return dict(zip(track.tag_names, row))
+
+    def put(self, t):
+        """Store the tags of Track t."""
+        self.db.execute('INSERT OR REPLACE INTO tags VALUES (?, ?, ?, %s)' %
+                        ', '.join(['?'] * len(track.tag_names)),
+                        [t.path, t.size, t.mtime] +
+                        [getattr(t, k, u'') for k in track.tag_names])
+        self.uncommitted += 1
+        if self.uncommitted >= self.commit_interval:
+            self.commit()
+
+    def commit(self):
+        self.db.commit()
+        self.uncommitted = 0
+
+    def close(self):
+        self.commit()
+        self.db.close()
@@ -0,0 +1,50 @@
+#!/usr/bin/env python
+"""Make a library pickle in the format that dbm saved before Track had
+slots and folders recorded their untagged files, for
+test_legacy_libraries.py.
+
+    python make_baseline_library.py CHECKOUT MUSIC_FOLDER OUTPUT
+
+CHECKOUT is a checkout of dbm as it was then, e.g.
+`git worktree add /tmp/dbm-baseline 080b525'; it is imported in place
+of this tree. The library at MUSIC_FOLDER is scanned and prepared as
+dbm-cmdline.py did then, and pickled to OUTPUT as
+dedpy.ded.pickle_object() pickled it. Rather than querying last.fm,
+each artist is given the last.fm data that a download would have
+stored.
+
+fixtures/libraries/baseline.dbm was made this way."""
+
+import sys, os
+
+def main(checkout, music, output):
+    here = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    sys.path[:] = [p for p in sys.path if os.path.abspath(p or '.') != here]
+    sys.path.insert(0, checkout)
+    import dbm
+    import cPickle as pickle
+    def log(msg, *args):
+        pass
+    dbm.log = dbm.logi = dbm.elog = dbm.warn = log
+    dbm.error = lambda msg, *args: sys.stderr.write(msg + '\n')
+    dbm.settings = settings = dbm.Settings()
+    settings.quiet = True
+    settings.show_tracks = False
+    settings.query_lastfm = False
+    dbm.root = root = dbm.Root(unicode(os.path.abspath(music)), None)
+    root.create_artist_name_to_mbid_mapping()
+    root.set_dbm_artistids()
+    root.create_artists()
+    for i, artist in enumerate(sorted(root.artists.values())):
+        root.similar_artists[artist.id] = [(None, u'Similar %d' % i)]
+        root.tags_by_artist[artist.id] = [dbm.Tag(u'tag %d' % (i % 2))]
+        artist.biography.biography = u'Biography of %s' % artist.name
+        root.biographies[artist.id] = artist.biography
+    root.download_artist_lastfm_data_maybe()
+    with open(output, 'wb') as f:
+        pickle.dump(root, f)
+
+if __name__ == '__main__':
+    if len(sys.argv) != 4:
+        sys.exit(__doc__)
+    main(*sys.argv[1:])
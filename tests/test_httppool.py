@@ -0,0 +1,129 @@
+"""Downloading with httppool from a server on this machine. Run from the
+top of the tree with
+
+    python -m unittest discover tests"""
+
+import sys, os, shutil, tempfile, threading, time, socket, unittest
+import BaseHTTPServer
+
+top = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, top)
+import httppool
+
+image = 'not really a JPEG'
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # The paths requested
+    paths = []
+
+    def do_GET(self):
+        self.paths.append(self.path)
+        if self.path == '/cover.jpg':
+            self.reply(200, image)
+        elif self.path == '/closing.jpg':
+            # The connection is closed without saying so, as a server
+            # closes an idle connection
+            self.reply(200, image)
+            self.close_connection = 1
+        elif self.path == '/slow.jpg':
+            time.sleep(0.5)
+            self.reply(200, image)
+        elif self.path.startswith('/moved/'):
+            # /moved/n/... redirects n times before reaching ...
+            n, rest = self.path[len('/moved/'):].split('/', 1)
+            location = '/moved/%d/%s' % (int(n) - 1, rest) if int(n) > 1 else '/' + rest
+            self.send_response(302)
+            self.send_header('Location', location)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+        else:
+            self.reply(404, 'Not found')
+
+    def reply(self, status, body):
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+class DownloadTest(unittest.TestCase):
+    def setUp(self):
+        self.server = BaseHTTPServer.HTTPServer(('localhost', 0), Handler)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.url = 'http://localhost:%d' % self.server.server_address[1]
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'cover.jpg')
+        del Handler.paths[:]
+
+    def tearDown(self):
+        httppool.pool.close()
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.dir)
+
+    def read(self):
+        with open(self.path, 'rb') as f:
+            return f.read()
+
+    def test_download(self):
+        httppool.download(self.url + '/cover.jpg', self.path)
+        self.assertEqual(self.read(), image)
+
+    def test_redirect(self):
+        httppool.download(self.url + '/moved/3/cover.jpg', self.path)
+        self.assertEqual(self.read(), image)
+
+    def test_too_many_redirects(self):
+        url = '%s/moved/%d/cover.jpg' % (self.url, httppool.max_redirects + 1)
+        self.assertRaises(IOError, httppool.download, url, self.path)
+        self.assertEqual(os.listdir(self.dir), [])
+
+    def test_failed_download(self):
+        self.assertRaises(IOError, httppool.download, self.url + '/missing.jpg', self.path)
+        self.assertEqual(os.listdir(self.dir), [])
+
+    def test_closed_connection(self):
+        """A request over a connection that the server has closed is
+        made again over a new one."""
+        pool = httppool.ConnectionPool()
+        for i in range(2):
+            self.assertEqual(pool.request('GET', self.url + '/closing.jpg').body, image)
+        self.assertEqual(pool.opened, 2)
+        self.assertEqual(Handler.paths, ['/closing.jpg'] * 2)
+        pool.close()
+
+    def test_timeout(self):
+        """A request that times out is not made again, as the server
+        may have acted on it."""
+        pool = httppool.ConnectionPool()
+        pool.timeout = 0.1
+        pool.request('GET', self.url + '/cover.jpg')
+        self.assertRaises(socket.timeout, pool.request, 'GET', self.url + '/slow.jpg')
+        # A request made again would reach the server once it has
+        # answered the first
+        time.sleep(1)
+        self.assertEqual(Handler.paths, ['/cover.jpg', '/slow.jpg'])
+        pool.close()
+
+    def test_failed_write(self):
+        """A download that cannot be written leaves neither the file nor
+        a partial one behind."""
+        def fetch(url):
+            response = original(url)
+            response.body = None
+            return response
+        original = httppool.fetch
+        httppool.fetch = fetch
+        try:
+            self.assertRaises(TypeError, httppool.download, self.url + '/cover.jpg', self.path)
+        finally:
+            httppool.fetch = original
+        self.assertEqual(os.listdir(self.dir), [])
+
+if __name__ == '__main__':
+    unittest.main()
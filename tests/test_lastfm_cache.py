@@ -0,0 +1,102 @@
+"""Keeping the time that each artist's last.fm data was downloaded, in
+saved libraries and in the last.fm cache. Run from the top of the tree
+with
+
+    python -m unittest discover tests"""
+
+import sys, os, shutil, sqlite3, tempfile, unittest
+
+top = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, top)
+import dbm, store, shards, lastfmcache
+
+baseline = os.path.join(top, 'fixtures', 'libraries', 'baseline.dbm')
+
+def quiet(msg, *args, **kwargs):
+    pass
+
+class Settings(dbm.Settings):
+    quiet = True
+    show_tracks = False
+    query_lastfm = False
+    library_generations = 1
+    tag_cache_file = None
+    scan_checkpoint_file = None
+    lastfm_cache_file = None
+
+class DownloadTimeTest(unittest.TestCase):
+    def setUp(self):
+        dbm.log = dbm.logi = dbm.elog = dbm.warn = dbm.error = quiet
+        dbm.settings = Settings()
+        self.dir = tempfile.mkdtemp()
+        path = os.path.join(self.dir, 'library.dbm')
+        shutil.copy(baseline, path)
+        self.root = dbm.load_library(path)
+        # Known download times for all but one artist
+        self.aids = sorted(self.root.biographies)
+        self.assertTrue(len(self.aids) > 1)
+        self.times = dict([(aid, 1e9 + i) for i, aid in enumerate(self.aids[1:])])
+        for aid, t in self.times.items():
+            self.root.biographies[aid].downloaded = t
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def download_times(self, root):
+        return dict([(aid, bio.downloaded) for aid, bio in root.biographies.items()
+                     if bio.downloaded is not None])
+
+    def test_export(self):
+        cache = lastfmcache.LastfmCache(os.path.join(self.dir, 'lastfm'))
+        self.assertEqual(self.root.export_lastfm_data(cache), len(self.aids))
+        self.assertEqual(dict([(aid, cache.get(aid)[6]) for aid in self.aids[1:]]),
+                         self.times)
+        self.assertEqual(cache.get(self.aids[0])[6], None)
+
+        # A cache with later downloads of some of the artists replaces
+        # those, and the artist whose download time is not known
+        other = lastfmcache.LastfmCache(os.path.join(self.dir, 'other'))
+        records = [(aid,) + cache.get(aid)[:6] + (2e9,) for aid in self.aids[:2]]
+        records.append((self.aids[2],) + cache.get(self.aids[2])[:6] + (1,))
+        other.put(records)
+        other.close()
+        self.assertEqual(cache.merge(other.path), 2)
+        self.assertEqual(cache.get(self.aids[0])[6], 2e9)
+        self.assertEqual(cache.get(self.aids[1])[6], 2e9)
+        self.assertEqual(cache.get(self.aids[2])[6], self.times[self.aids[2]])
+        cache.close()
+
+    def test_library_store(self):
+        path = os.path.join(self.dir, 'library.sqlite')
+        store.create_library_store(self.root, path)
+        self.assertEqual(self.download_times(dbm.load_library(path)), self.times)
+
+    def test_version_1_library_store(self):
+        """A store saved before download times were recorded gains a
+        column for them when it is opened."""
+        path = os.path.join(self.dir, 'library.sqlite')
+        store.create_library_store(self.root, path)
+        db = sqlite3.connect(path)
+        with db:
+            db.execute('CREATE TABLE old AS SELECT artist, biography, metadata FROM biographies')
+            db.execute('DROP TABLE biographies')
+            db.execute('ALTER TABLE old RENAME TO biographies')
+        db.close()
+        root = dbm.load_library(path)
+        self.assertEqual(sorted(root.biographies), self.aids)
+        self.assertEqual(self.download_times(root), {})
+        for aid in self.times:
+            root.biographies[aid].downloaded = self.times[aid]
+        store.create_library_store(root, path)
+        self.assertEqual(self.download_times(dbm.load_library(path)), self.times)
+
+    def test_shards(self):
+        path = os.path.join(self.dir, 'library.shards')
+        shards.save_shards(self.root, path)
+        self.assertEqual(self.download_times(dbm.load_library(path)), self.times)
+        lazy = dbm.load_library(path, lazy=True)
+        lazy.materialise()
+        self.assertEqual(self.download_times(lazy), self.times)
+
+if __name__ == '__main__':
+    unittest.main()
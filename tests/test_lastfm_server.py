@@ -0,0 +1,48 @@
+"""Not saving libraries while last.fm requests go to a stand-in for
+last.fm, such as lastfmstub.py. Run from the top of the tree with
+
+    python -m unittest discover tests"""
+
+import sys, os, shutil, tempfile, unittest
+
+top = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, top)
+import dbm
+
+baseline = os.path.join(top, 'fixtures', 'libraries', 'baseline.dbm')
+
+def quiet(msg, *args, **kwargs):
+    pass
+
+class Settings(dbm.Settings):
+    quiet = True
+    show_tracks = False
+    query_lastfm = False
+    library_generations = 1
+    tag_cache_file = None
+    scan_checkpoint_file = None
+    lastfm_server = 'localhost:8080'
+
+class LastfmServerTest(unittest.TestCase):
+    def setUp(self):
+        dbm.log = dbm.logi = dbm.elog = dbm.warn = dbm.error = quiet
+        dbm.settings = Settings()
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'library.dbm')
+        shutil.copy(baseline, self.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_not_saved(self):
+        root = dbm.load_library(self.path)
+        with open(self.path, 'rb') as f:
+            saved = f.read()
+        for format in ['pickle', 'shards', 'sqlite']:
+            dbm.settings.library_format = format
+            self.assertRaises(dbm.DbmError, dbm.save_library, root, self.path)
+            with open(self.path, 'rb') as f:
+                self.assertEqual(f.read(), saved)
+
+if __name__ == '__main__':
+    unittest.main()
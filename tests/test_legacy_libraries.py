@@ -0,0 +1,124 @@
+"""Loading libraries pickled by dbm before library files recorded a
+schema version.
+
+fixtures/libraries/baseline.dbm was pickled by dbm as it was then; see
+make_baseline_library.py. Run from the top of the tree with
+
+    python -m unittest discover tests"""
+
+import sys, os, shutil, tempfile, unittest
+import cPickle as pickle
+
+top = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, top)
+import dbm, store, shards, safefile
+
+baseline = os.path.join(top, 'fixtures', 'libraries', 'baseline.dbm')
+
+def quiet(msg, *args, **kwargs):
+    pass
+
+class Settings(dbm.Settings):
+    quiet = True
+    show_tracks = False
+    query_lastfm = False
+    library_generations = 1
+    tag_cache_file = None
+    scan_checkpoint_file = None
+
+class LegacyLibraryTest(unittest.TestCase):
+    def setUp(self):
+        dbm.log = dbm.logi = dbm.elog = dbm.warn = dbm.error = quiet
+        dbm.settings = Settings()
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'library.dbm')
+        shutil.copy(baseline, self.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def nodes(self, root):
+        nodes = []
+        root.walk(nodes.append)
+        return nodes
+
+    def assertUpToDate(self, root):
+        self.assertEqual(root.schema_version, dbm.library_schema_version)
+        nodes = self.nodes(root)
+        self.assertTrue(len(nodes) > 1)
+        for node in nodes:
+            self.assertEqual(node.untagged, [])
+            self.assertTrue(isinstance(node.path, unicode))
+            for t in node.tracks:
+                self.assertEqual((t.size, t.mtime), (None, None))
+
+    def assertSameLibrary(self, a, b):
+        self.assertEqual(sorted(a.artists), sorted(b.artists))
+        self.assertEqual(sorted([(n.path, len(n.tracks)) for n in self.nodes(a)]),
+                         sorted([(n.path, len(n.tracks)) for n in self.nodes(b)]))
+        self.assertEqual(sorted([(aid, bio.biography) for aid, bio in a.biographies.items()]),
+                         sorted([(aid, bio.biography) for aid, bio in b.biographies.items()]))
+
+    def test_upgrade(self):
+        root = dbm.load_library(self.path)
+        self.assertUpToDate(root)
+        self.assertTrue(os.path.exists(safefile.generation_path(self.path, 1)))
+        # The upgraded library was saved, and needs no upgrade again
+        root = dbm.load_library(self.path)
+        self.assertUpToDate(root)
+        self.assertFalse(dbm.upgrade_library(self.path))
+
+    def test_interned(self):
+        """The tracks loaded share their artist names, and the table
+        that they were shared through is not kept."""
+        tracks = []
+        for node in self.nodes(dbm.load_library(self.path)):
+            tracks.extend(node.tracks)
+        names = {}
+        for t in tracks:
+            self.assertTrue(names.setdefault(t.artistname, t.artistname) is t.artistname)
+        self.assertTrue(len(names) < len(tracks))
+        self.assertTrue(dbm.track.interned is None)
+
+    def test_upgrade_unsaved(self):
+        """A library that cannot be saved once upgraded is loaded all
+        the same."""
+        def fail(*args):
+            raise IOError('Read-only file system')
+        pickle_object = safefile.pickle_object
+        safefile.pickle_object = fail
+        try:
+            self.assertUpToDate(dbm.load_library(self.path))
+        finally:
+            safefile.pickle_object = pickle_object
+        self.assertFalse(os.path.exists(safefile.generation_path(self.path, 1)))
+
+    def test_upgrade_str_paths(self):
+        """Libraries pickled with str paths have them decoded, though
+        their tracks lack slots until they are upgraded."""
+        with open(self.path, 'rb') as f:
+            old = pickle.load(f)
+        old.path = old.path.encode('utf-8')
+        with open(self.path, 'wb') as f:
+            pickle.dump(old, f)
+        self.assertUpToDate(dbm.load_library(self.path))
+
+    def test_migrate(self):
+        pickled = dbm.load_library(self.path)
+        dbm.migrate_library(self.path, pickled)
+        self.assertTrue(store.is_library_store(self.path))
+        self.assertTrue(os.path.exists(self.path + '.pickle'))
+        self.assertSameLibrary(dbm.load_library(self.path), pickled)
+
+    def test_shards(self):
+        pickled = dbm.load_library(self.path)
+        path = os.path.join(self.dir, 'library.shards')
+        shards.save_shards(pickled, path)
+        self.assertTrue(shards.is_shard_file(path))
+        self.assertSameLibrary(dbm.load_library(path), pickled)
+        lazy = dbm.load_library(path, lazy=True)
+        lazy.materialise()
+        self.assertSameLibrary(lazy, pickled)
+
+if __name__ == '__main__':
+    unittest.main()
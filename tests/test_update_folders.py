@@ -0,0 +1,55 @@
+"""Applying changes in library folders to the tree with
+Root.update_folders(). Run from the top of the tree with
+
+    python -m unittest discover tests"""
+
+import sys, os, shutil, tempfile, unittest
+
+top = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, top)
+import dbm
+
+def quiet(msg, *args, **kwargs):
+    pass
+
+class Settings(dbm.Settings):
+    quiet = True
+    show_tracks = False
+    query_lastfm = False
+    scan_workers = 1
+    tag_cache_file = None
+    scan_checkpoint_file = None
+
+class UpdateFoldersTest(unittest.TestCase):
+    def setUp(self):
+        dbm.log = dbm.logi = dbm.elog = dbm.warn = dbm.error = quiet
+        dbm.settings = Settings()
+        self.dir = unicode(tempfile.mkdtemp())
+        self.path = os.path.join(self.dir, u'music')
+        os.makedirs(os.path.join(self.path, u'Artist', u'Album'))
+        self.root = dbm.root = dbm.Root(self.path, None)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def paths(self):
+        return sorted(self.root.nodes_by_path())
+
+    def test_new_folder(self):
+        folder = os.path.join(self.path, u'Artist', u'Other album')
+        os.mkdir(folder)
+        self.root.update_folders([folder])
+        self.assertTrue(folder in self.paths())
+
+    def test_outside_library(self):
+        """Paths outside the library are refused, not dropped, and
+        nothing is changed."""
+        paths = self.paths()
+        os.mkdir(os.path.join(self.path, u'New artist'))
+        for outside in [self.dir, os.path.join(self.dir, u'music2')]:
+            self.assertRaises(dbm.DbmError, self.root.update_folders,
+                              [os.path.join(self.path, u'New artist'), outside])
+            self.assertEqual(self.paths(), paths)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,10 +1,11 @@
-import sys, os
+import sys, os, time
 import mutagen.oggvorbis
 import mutagen.flac
 import mutagen.mp3
 import mutagen.mp4
 import mutagen.musepack
 import dedpy.ded as ded
+import fasttags
 
 mutagen_readtags_function = {'ogg'  : lambda(x): mutagen.oggvorbis.Open(x),
                              'mp3'  : lambda(x): mutagen.mp3.Open(x),
@@ -13,16 +14,136 @@ mutagen_readtags_function = {'ogg'  : lambda(x): mutagen.oggvorbis.Open(x),
                              'm4a'  : lambda(x): mutagen.mp4.Open(x),
                              'flac' : lambda(x): mutagen.flac.Open(x)}
 
+# The tags whose values are shared by the tracks of an artist or album
+shared_tag_names = ['artistname', 'artistid', 'albumartistname', 'albumartistid',
+                    'releasename', 'releaseid']
+tag_names = shared_tag_names + ['trackname', 'trackid']
+
+# A tagcache.TagCache and a ScanStats, set while a library is being
+# scanned
+tag_cache = None
+scan_stats = None
+
+# The same artist, album and ID strings occur in thousands of tracks.
+# While a library is being scanned or loaded, this holds the single
+# copy of each that its tracks share; otherwise it is None, so that
+# the strings of a library are not kept once it is no longer used.
+interned = None
+
+def intern_string(s):
+    if interned is None:
+        return s
+    return interned.setdefault(s, s)
+
+music_extensions = ['.ogg','.flac','.mp3','.mpc','.m4a']
+
 def is_music(path):
     return (os.path.isfile(path) or os.path.islink(path)) \
-        and os.path.splitext(path)[1] in ['.ogg','.flac','.mp3','.mpc','.m4a']
+        and os.path.splitext(path)[1] in music_extensions
+
+def is_music_entry(entry):
+    """As is_music(), for an entry returned by ded.list_directory()."""
+    return os.path.splitext(entry.name)[1] in music_extensions \
+        and (entry.is_file() or entry.is_symlink())
+
+def entry_stat(entry):
+    """Return the stat result of a directory entry, or None if the
+    file cannot be stat'ed."""
+    try:
+        return entry.stat()
+    except OSError:
+        return None
+
+def read_tags(path):
+    """Return a (tags, seconds, nbytes) tuple, where tags is a dict of
+    the tag values of the music file at `path', or None if they could
+    not be read, seconds is the time taken to read them and nbytes is
+    as returned by Track.read_tags(). This is what the worker
+    processes run during a parallel scan, so it must not try to log
+    anything itself."""
+    t = Track(path, tags={})
+    ok, seconds, nbytes = t.read_tags()
+    if not ok:
+        return None, seconds, nbytes
+    return dict([(k, getattr(t, k, u'')) for k in tag_names]), seconds, nbytes
 
-class Track:
-    def __init__(self, path):
+class ScanStats(object):
+    """Numbers of music files read during a scan, the time spent
+    reading them, and the bytes read from those whose tags were read
+    by fasttags, by format."""
+    def __init__(self):
+        self.start = time.time()
+        self.files = {}
+        self.seconds = {}
+        self.fast = {}
+        self.bytes = {}
+        self.cached = 0
+        self.reused = 0
+
+    def add(self, format, seconds, nbytes=None):
+        self.files[format] = self.files.get(format, 0) + 1
+        self.seconds[format] = self.seconds.get(format, 0.0) + seconds
+        if nbytes is not None:
+            self.fast[format] = self.fast.get(format, 0) + 1
+            self.bytes[format] = self.bytes.get(format, 0) + nbytes
+
+    def report(self):
+        lines = []
+        for format in sorted(self.files):
+            n, secs = self.files[format], self.seconds[format]
+            fast = self.fast.get(format, 0)
+            line = '%s\t%d files read\t%.1f ms per file\t%.1f files / s' % (
+                format, n, 1000 * secs / n, n / secs if secs else 0)
+            if fast:
+                line += '\t%.1f KB per file' % (self.bytes[format] / 1024.0 / fast)
+            if fast < n:
+                line += '\t%d by mutagen' % (n - fast)
+            lines.append(line)
+        read = sum(self.files.values())
+        elapsed = time.time() - self.start
+        lines.append('%d files read, %d from tag cache, %d unchanged since last scan, in %.1f s' % (
+                read, self.cached, self.reused, elapsed))
+        return lines
+
+def cached_track(path, st=None):
+    """Return a Track for the music file at `path' if its tags are in
+    the tag cache, otherwise None."""
+    try:
+        st = st or os.stat(path)
+    except OSError:
+        return None
+    tags = tag_cache.get(path, st.st_size, st.st_mtime)
+    if tags is not None:
+        if scan_stats:
+            scan_stats.cached += 1
+        return Track(path, tags, st)
+    return None
+
+class Track(object):
+    # A library holds hundreds of thousands of these, so they have
+    # slots instead of an instance dict.
+    __slots__ = ['path', 'size', 'mtime', 'format',
+                 'dbm_artistid', 'dbm_albumartistid',
+                 'artist', 'albumartist', 'valid'] + tag_names
+
+    def __init__(self, path=None, tags=None, st=None):
+        """If `tags' is given, it is a dict as returned by read_tags()
+        and the file is not opened. Otherwise the tags are taken from
+        the tag cache if possible, and read from the file if not. `st'
+        is the result of os.stat(path), if the caller already has it."""
+        if path is None:
+            # Being unpickled from a library saved when Track was a
+            # classic class; __setstate__ does the work.
+            return
         self.path = path
-        if not os.path.exists(path):
-            raise Exception("path does not exist: %s" % path)
-            
+        if st is None:
+            try:
+                st = os.stat(path)
+            except OSError:
+                raise Exception("path does not exist: %s" % path)
+        self.size = st.st_size
+        self.mtime = st.st_mtime
+
         self.format = os.path.splitext(path)[1][1:]
 
         self.dbm_artistid = u''
@@ -37,22 +158,98 @@ class Track:
         self.releasename = u''
         self.releaseid = u''
 
+        self.trackname = u''
+        self.trackid = u''
+
         self.artist = None
         self.albumartist = None
-        
+
+        if tags is None and tag_cache is not None:
+            tags = tag_cache.get(path, self.size, self.mtime)
+            if tags is not None and scan_stats:
+                scan_stats.cached += 1
+
+        if tags is not None:
+            for k, v in tags.iteritems():
+                if k in shared_tag_names:
+                    v = intern_string(v)
+                setattr(self, k, v)
+        else:
+            ok, seconds, nbytes = self.read_tags()
+            if scan_stats:
+                scan_stats.add(self.format, seconds, nbytes)
+            if not ok:
+                error('failed to read tags for %s' % self.path)
+            elif tag_cache is not None:
+                tag_cache.put(self)
+        self.valid = True if (self.artistid or self.artistname) else False
+
+    def read_tags(self):
+        """Open the file and set the tag attributes. This is the only
+        place that music files are read. Return an (ok, seconds,
+        nbytes) tuple, where nbytes is the number of bytes read, or
+        None if the tags were read by mutagen."""
+        start = time.time()
+        nbytes = None
         try:
-            self.set_tags() # TMP
+            nbytes = self.set_tags()
+            # Some tag values are the raw bytes from the file
+            for k in tag_names:
+                v = getattr(self, k)
+                if isinstance(v, str):
+                    v = v.decode('utf-8')
+                if k in shared_tag_names:
+                    v = intern_string(v)
+                setattr(self, k, v)
+            ok = True
         except:
-            error('failed to read tags for %s' % self.path)
+            ok = False
+        return ok, time.time() - start, nbytes
+
+    def __getstate__(self):
+        return dict([(k, getattr(self, k)) for k in self.__slots__
+                     if hasattr(self, k)])
+
+    def __setstate__(self, state):
+        # Attributes of old versions that no longer exist are dropped
+        for k, v in state.iteritems():
+            if k in shared_tag_names:
+                v = intern_string(v)
+            if k in self.__slots__:
+                setattr(self, k, v)
 
+    def is_unchanged(self, st=None):
+        """Is the file the same size and modification time as when
+        its tags were read? `st' is the current result of
+        os.stat(self.path), if the caller already has it."""
         try:
-            self.set_tags()
-            ded.decode_strings(self)
-        except:
-            error('failed to read tags for %s' % self.path)
-        self.valid = True if (self.artistid or self.artistname) else False
+            st = st or os.stat(self.path)
+        except OSError:
+            return False
+        return getattr(self, 'size', None) == st.st_size and \
+            getattr(self, 'mtime', None) == st.st_mtime
+
+    def reset_artists(self):
+        """Forget the artist information derived from the tags, so that
+        the track can be put in a new library tree."""
+        self.dbm_artistid = u''
+        self.dbm_albumartistid = u''
+        self.artist = None
+        self.albumartist = None
 
     def set_tags(self):
+        """Read metadata tags from the music file, reading only its tag
+        block if fasttags can do that, and otherwise using mutagen.
+        Return the number of bytes read by fasttags, or None."""
+        tags, nbytes = fasttags.read_tags(self.path, self.format)
+        if tags is None:
+            self.set_mutagen_tags()
+            return None
+        for k, v in tags.iteritems():
+            setattr(self, k, v)
+        return nbytes
+
+    def set_mutagen_tags(self):
         """Read metadata tags from music file at `path' using
         mutagen. This creates a rather complicated list structure,
         especially for mp3s, which I parse further using the
@@ -122,13 +122,22 @@ class Ui_Dialog(object):
         self.numSimArtBiogsHelpButton = QtGui.QPushButton(Dialog)
         self.numSimArtBiogsHelpButton.setObjectName("numSimArtBiogsHelpButton")
         self.gridLayout.addWidget(self.numSimArtBiogsHelpButton, 11, 3, 1, 1)
+        self.label_9 = QtGui.QLabel(Dialog)
+        self.label_9.setObjectName("label_9")
+        self.gridLayout.addWidget(self.label_9, 12, 0, 1, 1)
+        self.scanWorkersComboBox = QtGui.QComboBox(Dialog)
+        self.scanWorkersComboBox.setObjectName("scanWorkersComboBox")
+        self.gridLayout.addWidget(self.scanWorkersComboBox, 12, 2, 1, 1)
+        self.scanWorkersHelpButton = QtGui.QPushButton(Dialog)
+        self.scanWorkersHelpButton.setObjectName("scanWorkersHelpButton")
+        self.gridLayout.addWidget(self.scanWorkersHelpButton, 12, 3, 1, 1)
         spacerItem = QtGui.QSpacerItem(17, 144, QtGui.QSizePolicy.Minimum, QtGui.QSizePolicy.Expanding)
-        self.gridLayout.addItem(spacerItem, 12, 2, 1, 1)
+        self.gridLayout.addItem(spacerItem, 13, 2, 1, 1)
         self.buttonBox = QtGui.QDialogButtonBox(Dialog)
         self.buttonBox.setOrientation(QtCore.Qt.Horizontal)
         self.buttonBox.setStandardButtons(QtGui.QDialogButtonBox.Cancel|QtGui.QDialogButtonBox.Ok)
         self.buttonBox.setObjectName("buttonBox")
-        self.gridLayout.addWidget(self.buttonBox, 13, 2, 1, 2)
+        self.gridLayout.addWidget(self.buttonBox, 14, 2, 1, 2)
         self.label.setBuddy(self.targetComboBox)
 
         self.retranslateUi(Dialog)
@@ -161,4 +170,6 @@ class Ui_Dialog(object):
         self.musicspaceDropoffHelpButton.setText(QtGui.QApplication.translate("Dialog", "?", None, QtGui.QApplication.UnicodeUTF8))
         self.label_5.setText(QtGui.QApplication.translate("Dialog", "Similar artist biographies per artist", None, QtGui.QApplication.UnicodeUTF8))
         self.numSimArtBiogsHelpButton.setText(QtGui.QApplication.translate("Dialog", "?", None, QtGui.QApplication.UnicodeUTF8))
+        self.label_9.setText(QtGui.QApplication.translate("Dialog", "Library scan processes", None, QtGui.QApplication.UnicodeUTF8))
+        self.scanWorkersHelpButton.setText(QtGui.QApplication.translate("Dialog", "?", None, QtGui.QApplication.UnicodeUTF8))
 
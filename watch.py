@@ -0,0 +1,195 @@
+"""Watching a music library for changes.
+
+A watcher reports which folders of the library have had music files or
+sub-folders added, removed or modified, so that Root.update_folders()
+can bring the library tree up to date without a full scan. On Linux
+the kernel's inotify interface is used; elsewhere, or if inotify is
+not available, the library is polled."""
+
+import os, sys, time, struct, select, errno
+import ctypes, ctypes.util
+import track
+import dedpy.ded as ded
+
+def make_watcher(path, settle=2.0, interval=30.0):
+    """Return a watcher for the library rooted at path. A batch of
+    changes is only reported once there have been none for `settle'
+    seconds, so that copying an album in is a single update.
+    `interval' is the time between polls if inotify is not
+    available."""
+    try:
+        return InotifyWatcher(path, settle)
+    except Exception:
+        return PollingWatcher(path, interval)
+
+def is_relevant(name, is_dir):
+    """Could a change to the folder entry `name' affect the library
+    tree? Changes to other files, such as album art being downloaded
+    into the library, are ignored."""
+    return is_dir or name == '.ignore' or \
+        os.path.splitext(name)[1] in track.music_extensions
+
+def library_folders(path):
+    """Return a list of the folders in the library rooted at path."""
+    folders = []
+    stack = [path]
+    while stack:
+        folder = stack.pop()
+        folders.append(folder)
+        try:
+            entries = ded.list_directory(folder)
+        except OSError:
+            continue
+        stack.extend([e.path for e in entries
+                      if isinstance(e.name, unicode) and e.is_dir()])
+    return folders
+
+class InotifyWatcher(object):
+    IN_MODIFY      = 0x00000002
+    IN_ATTRIB      = 0x00000004
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM  = 0x00000040
+    IN_MOVED_TO    = 0x00000080
+    IN_CREATE      = 0x00000100
+    IN_DELETE      = 0x00000200
+    IN_DELETE_SELF = 0x00000400
+    IN_MOVE_SELF   = 0x00000800
+    IN_Q_OVERFLOW  = 0x00004000
+    IN_IGNORED     = 0x00008000
+    IN_ISDIR       = 0x40000000
+
+    mask = IN_CLOSE_WRITE | IN_ATTRIB | IN_MOVED_FROM | IN_MOVED_TO | \
+        IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF
+    event_header = struct.Struct('iIII')
+
+    def __init__(self, path, settle=2.0):
+        if not sys.platform.startswith('linux'):
+            raise OSError('inotify is only available on Linux')
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = self.libc.inotify_init()
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init failed')
+        self.path = path
+        self.settle = settle
+        self.encoding = sys.getfilesystemencoding() or 'utf-8'
+        # Folder paths keyed by watch descriptor
+        self.folders = {}
+        for folder in library_folders(path):
+            self.add_watch(folder)
+
+    def add_watch(self, folder):
+        wd = self.libc.inotify_add_watch(self.fd, folder.encode(self.encoding), self.mask)
+        if wd < 0:
+            err = ctypes.get_errno()
+            if err == errno.ENOSPC:
+                raise OSError(err, 'Too many folders to watch: increase ' +
+                              '/proc/sys/fs/inotify/max_user_watches')
+            # The folder has gone already
+            return
+        self.folders[wd] = folder
+
+    def wait(self, timeout=None):
+        """Block until there are changes to the library, or until
+        timeout seconds have passed, and return the set of paths of
+        the folders that have changed."""
+        changed = set([])
+        ready = select.select([self.fd], [], [], timeout)[0]
+        while ready:
+            self.read_events(changed)
+            ready = select.select([self.fd], [], [], self.settle)[0]
+        return changed
+
+    def read_events(self, changed):
+        try:
+            buf = os.read(self.fd, 65536)
+        except OSError, e:
+            if e.errno == errno.EINTR: return
+            raise
+        i = 0
+        while i < len(buf):
+            wd, mask, cookie, length = self.event_header.unpack_from(buf, i)
+            i += self.event_header.size
+            name = buf[i:i + length].rstrip('\0')
+            i += length
+            if mask & self.IN_Q_OVERFLOW:
+                # Events were lost: every folder must be looked at
+                changed.update(self.folders.values())
+                continue
+            folder = self.folders.get(wd)
+            if folder is None:
+                continue
+            if mask & self.IN_IGNORED:
+                del self.folders[wd]
+                continue
+            if mask & (self.IN_DELETE_SELF | self.IN_MOVE_SELF):
+                changed.add(os.path.dirname(folder))
+                continue
+            try:
+                name = name.decode(self.encoding)
+            except UnicodeDecodeError:
+                # The library scan skips these too
+                continue
+            is_dir = bool(mask & self.IN_ISDIR)
+            if not is_relevant(name, is_dir):
+                continue
+            changed.add(folder)
+            if is_dir and mask & (self.IN_CREATE | self.IN_MOVED_TO):
+                for new_folder in library_folders(os.path.join(folder, name)):
+                    self.add_watch(new_folder)
+
+    def close(self):
+        os.close(self.fd)
+
+class PollingWatcher(object):
+    """Finds changes by listing every folder of the library at
+    regular intervals and comparing the sub-folders and music files
+    of each folder, and the sizes and modification times of the
+    music files, with those from the previous listing."""
+    def __init__(self, path, interval=30.0):
+        self.path = path
+        self.interval = interval
+        self.state = self.listing()
+
+    def listing(self):
+        """Return a dict, keyed by folder path, of the contents of
+        each folder that matter to the library tree."""
+        state = {}
+        stack = [self.path]
+        while stack:
+            folder = stack.pop()
+            try:
+                entries = ded.list_directory(folder)
+            except OSError:
+                continue
+            contents = {}
+            for e in entries:
+                if not isinstance(e.name, unicode):
+                    continue
+                if e.is_dir():
+                    stack.append(e.path)
+                    contents[e.name] = None
+                elif e.name == '.ignore':
+                    contents[e.name] = None
+                elif track.is_music_entry(e):
+                    st = track.entry_stat(e)
+                    contents[e.name] = (st.st_size, st.st_mtime) if st else None
+            state[folder] = contents
+        return state
+
+    def wait(self, timeout=None):
+        """Block until there are changes to the library, or until
+        timeout seconds have passed, and return the set of paths of
+        the folders that have changed."""
+        start = time.time()
+        while True:
+            time.sleep(self.interval if timeout is None else
+                       max(0, min(self.interval, start + timeout - time.time())))
+            state = self.listing()
+            changed = set([f for f in set(state) | set(self.state)
+                           if state.get(f) != self.state.get(f)])
+            self.state = state
+            if changed or (timeout is not None and time.time() - start >= timeout):
+                return changed
+
+    def close(self):
+        pass